@@ -0,0 +1,64 @@
+import argparse
+import glob
+import os
+import time
+
+from services.convert import CONVERSIONS, convert_file, detect_file_type
+
+
+def export_all(dataset_dir: str, output_dir: str, file_type: str, columns: list = None):
+    """
+    把数据集目录下所有 JSON 数据集原格式导出为另一种文件类型，如 datasets/*.json -> datasets/parquet/*.parquet
+    :param dataset_dir: 数据集目录
+    :param output_dir: 输出目录
+    :param file_type: jsonl / parquet / arrow
+    :param columns: 只导出这些字段
+    """
+    for path in sorted(glob.glob(os.path.join(dataset_dir, "*.json"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        output_path = os.path.join(output_dir, f"{name}.{file_type}")
+        start = time.time()
+        count = convert_file(path, output_path, columns=columns)
+        print(f"[convert] {path} -> {output_path}: {count} 条，耗时 {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    # python convert-dataset.py datasets/daoguiyixian-sharegpt-qa-v2.json qa.jsonl --from=sharegpt --to=messages
+    # python convert-dataset.py --all --type=parquet
+    formats = sorted({name for pair in CONVERSIONS for name in pair})
+    parser = argparse.ArgumentParser(description="Stream datasets between sharegpt / alpaca / alpaca-dpo / messages "
+                                                 "formats and json / jsonl / parquet / arrow files")
+    parser.add_argument("input", nargs="?", help="Input file (.json / .jsonl / .parquet / .arrow)")
+    parser.add_argument("output", nargs="?", help="Output file, file type is taken from the extension")
+    parser.add_argument("--from", dest="source", choices=formats, help="Source format (default: detect from the first record)")
+    parser.add_argument("--to", dest="target", choices=formats, help="Target format (default: same as source)")
+    parser.add_argument("--columns", help="Comma separated fields to keep, e.g. conversations,capter")
+    parser.add_argument("--instruct", default="请用你理解的《道诡异仙》小说内容解答用户疑惑",
+                        help="Instruction for sharegpt -> alpaca")
+    parser.add_argument("--system", help="System message, only for sharegpt -> messages")
+    parser.add_argument("--compact", action="store_true", help="Write JSON arrays with one record per line instead of indent=2")
+    parser.add_argument("--all", action="store_true", help="Re-export every datasets/*.json to --type under --output-dir")
+    parser.add_argument("--type", default="parquet", choices=["jsonl", "parquet", "arrow"], help="File type for --all")
+    parser.add_argument("--output-dir", help="Output directory for --all (default: datasets/<type>)")
+    args = parser.parse_args()
+
+    columns = args.columns.split(",") if args.columns else None
+    if args.all:
+        export_all("datasets", args.output_dir or os.path.join("datasets", args.type), args.type, columns=columns)
+    else:
+        if not args.input or not args.output:
+            parser.error("input and output are required unless --all is given")
+        options = {}
+        if args.target == "alpaca":
+            options["instruct"] = args.instruct
+        if args.system:
+            options["system"] = args.system
+        start = time.time()
+        count = convert_file(
+            args.input, args.output, args.source, args.target,
+            columns=columns,
+            indent=None if args.compact else 2,
+            **options,
+        )
+        print(f"[convert] {args.input} -> {args.output} ({detect_file_type(args.output)}): "
+              f"{count} 条，耗时 {time.time() - start:.1f}s")
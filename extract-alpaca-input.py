@@ -1,48 +1,197 @@
 import argparse
-from datasets import load_dataset
+import hashlib
+import itertools
+import os
+import random
+from collections import Counter
 
-def extract_input_to_file(dataset_name, dataset_key, output_file):
+from services.convert import iter_records
+
+
+def iter_field_values(dataset_name, dataset_key, field="input", streaming=True):
+    """
+    逐条读取数据集中的一个字段，只加载这一列
+    :param dataset_name: 本地 json / jsonl / parquet / arrow 文件、save_to_disk 保存的目录、本地数据文件目录或 huggingface 数据集名称
+    :param dataset_key: 数据集键名（如train, test等），本地文件忽略
+    :param field: 字段名
+    :param streaming: huggingface 数据集是否流式读取，不下载整个数据集；为 False 时使用本地缓存，可以离线运行
+    """
+    # 本地文件直接流式读取
+    if os.path.isfile(dataset_name):
+        for record in iter_records(dataset_name, columns=[field]):
+            yield record[field]
+        return
+
+    from datasets import DatasetDict, load_dataset, load_from_disk
+
+    if os.path.isdir(dataset_name) and (
+        os.path.exists(os.path.join(dataset_name, "dataset_dict.json"))
+        or os.path.exists(os.path.join(dataset_name, "state.json"))
+    ):
+        # save_to_disk 保存的数据集，Arrow 文件内存映射读取
+        dataset = load_from_disk(dataset_name)
+        if isinstance(dataset, DatasetDict):
+            if dataset_key not in dataset:
+                raise ValueError(f"Dataset key '{dataset_key}' not found in dataset")
+            dataset = dataset[dataset_key]
+    else:
+        # huggingface 数据集名称或本地数据文件目录，只加载指定的 split
+        try:
+            dataset = load_dataset(dataset_name, split=dataset_key, streaming=streaming)
+        except ValueError as e:
+            if "split" in str(e).lower():
+                raise ValueError(f"Dataset key '{dataset_key}' not found in dataset") from e
+            raise
+
+    dataset = dataset.select_columns([field])
+    for batch in dataset.iter(batch_size=1000):
+        yield from batch[field]
+
+
+def normalize_line(value) -> str:
+    """
+    一条输入占一行：合并内部的换行和空白
+    """
+    if value is None:
+        return ""
+    return " ".join(str(value).split())
+
+
+def filter_lines(values, min_length=1, max_length=None, dedup=False, stats=None):
+    """
+    逐条过滤：空行、长度不在范围内、(dedup 时)重复的输入都跳过
+    :param values: 字段值
+    :param min_length: 最少字数
+    :param max_length: 最多字数，为 None 时不限
+    :param dedup: 是否去掉重复的输入，只保存每条的 8 字节摘要
+    :param stats: 统计各类跳过的条数的 Counter
     """
-    从指定数据集中提取input字段，并用换行符分隔保存到目标文件
-    :param dataset_name: 数据集名称
+    stats = stats if stats is not None else Counter()
+    seen = set()
+    for value in values:
+        stats["read"] += 1
+        line = normalize_line(value)
+        if not line:
+            stats["empty"] += 1
+            continue
+        if len(line) < min_length or (max_length is not None and len(line) > max_length):
+            stats["length"] += 1
+            continue
+        if dedup:
+            digest = hashlib.blake2b(line.encode("utf-8"), digest_size=8).digest()
+            if digest in seen:
+                stats["duplicate"] += 1
+                continue
+            seen.add(digest)
+        yield line
+
+
+def sample_lines(lines, size, seed=None):
+    """
+    蓄水池抽样，内存中只保留 size 条，输出保持原来的顺序
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for index, line in enumerate(lines):
+        if index < size:
+            reservoir.append((index, line))
+            continue
+        slot = rng.randint(0, index)
+        if slot < size:
+            reservoir[slot] = (index, line)
+    for _, line in sorted(reservoir):
+        yield line
+
+
+def extract_input_to_file(dataset_name, dataset_key, output_file, field="input", streaming=True, num_shards=1,
+                          shard_index=0, sample=None, limit=None, seed=None, min_length=1, max_length=None,
+                          dedup=False):
+    """
+    从指定数据集中提取input字段，逐行写入目标文件，不把整个数据集或所有输入载入内存
+    :param dataset_name: 数据集名称或本地路径，见 iter_field_values
     :param dataset_key: 数据集键名（如train, test等）
     :param output_file: 输出文件名
+    :param field: 提取的字段
+    :param streaming: huggingface 数据集是否流式读取
+    :param num_shards: 分片数，按行号取模分片，多个进程可以分别提取不同分片
+    :param shard_index: 提取第几个分片(从 0 开始)
+    :param sample: 随机抽取的条数(过滤后)，需要读完整个分片
+    :param limit: 最多写入的条数，达到后停止读取，流式读取时不会下载剩余的数据
+    :param seed: 抽样的随机种子
+    :param min_length: 最少字数
+    :param max_length: 最多字数
+    :param dedup: 是否去掉重复的输入
     """
     try:
-        # 加载数据集
-        dataset = load_dataset(dataset_name)
-        
-        # 检查指定的key是否存在
-        if dataset_key not in dataset:
-            raise ValueError(f"Dataset key '{dataset_key}' not found in dataset")
-        
-        # 提取input字段
-        inputs = [item['input'] for item in dataset[dataset_key]]
-        
-        # 用换行符连接所有input
-        content = "\n".join(inputs)
-        
-        # 写入目标文件
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(content)
-            
-        print(f"Successfully extracted {len(inputs)} inputs from {dataset_key} to {output_file}")
-        
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"shard_index should be in [0, {num_shards})")
+
+        values = iter_field_values(dataset_name, dataset_key, field=field, streaming=streaming)
+        if num_shards > 1:
+            values = itertools.islice(values, shard_index, None, num_shards)
+
+        stats = Counter()
+        lines = filter_lines(values, min_length=min_length, max_length=max_length, dedup=dedup, stats=stats)
+        if sample:
+            lines = sample_lines(lines, sample, seed=seed)
+        if limit:
+            lines = itertools.islice(lines, limit)
+
+        # 先写临时文件，完成后再替换，中断时不会留下不完整的输出
+        count = 0
+        tmp_file = f"{output_file}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                for line in lines:
+                    f.write(line + "\n")
+                    count += 1
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, output_file)
+
+        skipped = ", ".join(f"{key} {stats[key]}" for key in ("empty", "length", "duplicate") if stats[key])
+        print(f"Successfully extracted {count} inputs from {dataset_key} to {output_file} "
+              f"(read {stats['read']}{', skipped ' + skipped if skipped else ''})")
+
     except Exception as e:
         print(f"Error occurred: {str(e)}")
 
 if __name__ == "__main__":
     # 设置命令行参数，python extract-alpaca-input.py --dataset=wj2015/psychology-10k-zh --key=train --output=dpo.txt
+    # 本地文件：python extract-alpaca-input.py --dataset=psychology.parquet --output=datasets/dpo.txt --dedup --max-length=200 --sample=1000
     parser = argparse.ArgumentParser(description="Extract input field from dataset")
-    parser.add_argument("--dataset", type=str, required=True, help="Dataset name")
-    parser.add_argument("--key", type=str, required=True, help="Dataset key (e.g. train, test)")
+    parser.add_argument("--dataset", type=str, required=True,
+                        help="Dataset name, save_to_disk directory or local json / jsonl / parquet / arrow file")
+    parser.add_argument("--key", type=str, default="train", help="Dataset key (e.g. train, test)")
     parser.add_argument("--output", type=str, required=True, help="Output file path")
-    
+    parser.add_argument("--field", type=str, default="input", help="Field to extract")
+    parser.add_argument("--no-streaming", action="store_true",
+                        help="Load the hub dataset through the local cache instead of streaming it (works offline once cached)")
+    parser.add_argument("--num-shards", type=int, default=1, help="Split rows into this many shards")
+    parser.add_argument("--shard-index", type=int, default=0, help="Shard to extract (0-based)")
+    parser.add_argument("--sample", type=int, help="Randomly keep this many inputs (after filtering)")
+    parser.add_argument("--limit", type=int, help="Stop after writing this many inputs")
+    parser.add_argument("--seed", type=int, help="Random seed for --sample")
+    parser.add_argument("--min-length", type=int, default=1, help="Drop inputs shorter than this many characters")
+    parser.add_argument("--max-length", type=int, help="Drop inputs longer than this many characters")
+    parser.add_argument("--dedup", action="store_true", help="Drop duplicate inputs")
+
     args = parser.parse_args()
-    
+
     # 调用提取函数
     extract_input_to_file(
         dataset_name=args.dataset,
         dataset_key=args.key,
-        output_file=args.output
+        output_file=args.output,
+        field=args.field,
+        streaming=not args.no_streaming,
+        num_shards=args.num_shards,
+        shard_index=args.shard_index,
+        sample=args.sample,
+        limit=args.limit,
+        seed=args.seed,
+        min_length=args.min_length,
+        max_length=args.max_length,
+        dedup=args.dedup,
     )
@@ -3,32 +3,106 @@ import os
 from dotenv import load_dotenv
 from typing import List, Dict, Any
 import asyncio
+import inspect
+import re
+import time
 from services.openai import OpenAIHandler
+from services.cache import ResponseCache
+from services.limiter import RateLimiter
+from services.endpoints import parse_endpoints
+from services.batch import BatchOpenAIHandler
+from services.metrics import MetricsRecorder
+from services.chapters import ChapterStore
+from services.retrieval import BM25Index, iter_speech_passages, split_passages
+from services.schema import DPO_DATA_RESPONSE, Schema
+from services.tokens import estimate_text_tokens
+from services.workqueue import run_queue
 
 def read_inputs(file_path: str) -> List[str]:
     """读取输入文件并按换行符拆分"""
     with open(file_path, "r", encoding="utf-8") as f:
         return [line.strip() for line in f.readlines() if line.strip()]
 
-def validate_response(response: Dict[str, Any]) -> bool:
-    """校验GPT返回的数据格式"""
-    if not isinstance(response, dict):
-        raise Exception("Response is not a dictionary")
-    if "data" not in response:
-        raise Exception("Missing 'data' field")
-    if not isinstance(response["data"], list):
-        raise Exception("'data' must be a list")
+def iter_inputs(file_path: str):
+    """逐行读取输入文件，跳过空行，不把整个文件读入内存"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+def iter_batches(inputs, batch_size: int):
+    """把输入按 batch_size 惰性分批"""
+    batch = []
+    for item in inputs:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iter_token_batches(inputs, max_items: int, prompt_token_budget: int = None, completion_token_budget: int = None,
+                       completion_tokens_per_item: int = 150):
+    """
+    按 token 预算惰性分批：在不超过输入预算、输出预算和条数上限的前提下尽量多装输入
+
+    单条输入超过预算时单独成批
+    """
+    batch = []
+    prompt_tokens = 0
+    for item in inputs:
+        # 编号和换行约 3 个 token
+        tokens = estimate_text_tokens(item) + 3
+        full = batch and (
+            len(batch) >= max_items
+            or (prompt_token_budget and prompt_tokens + tokens > prompt_token_budget)
+            or (completion_token_budget and (len(batch) + 1) * completion_tokens_per_item > completion_token_budget)
+        )
+        if full:
+            yield batch
+            batch = []
+            prompt_tokens = 0
+        batch.append(item)
+        prompt_tokens += tokens
+    if batch:
+        yield batch
+
+def align_response(response: Dict[str, Any], count: int) -> Dict[int, Dict]:
+    """
+    按 id 把返回数据与编号的输入一一对齐
+
+    字段不完整(见 DPO_DATA_RESPONSE)、id 超出范围或重复的条目会被丢弃；一条都对不上时抛出异常(触发重试)
+
+    参数:
+        response: 模型返回的 JSON
+        count: 本次请求的输入条数
+
+    返回:
+        {id: item}，id 从1开始
+    """
+    validate_response(response)
+    aligned = {}
+    duplicated = set()
     for item in response["data"]:
-        if not isinstance(item, dict):
-            raise Exception("Data item must be a dictionary")
-        if "chosen" not in item or "rejected" not in item:
-            raise Exception("Missing required fields in data item")
-    return True
-
-async def generate_dpo_data(inputs: List[str], openai_service: OpenAIHandler, batch_size: int = 20) -> List[Dict]:
-    """生成DPO数据"""
-    dpo_data = []
-    instruction = """《道诡异仙》是一部融合了玄幻、修真、恐怖和心理悬疑元素的小说，主要讲述了主角李火旺在一个诡异而扭曲的世界中挣扎求生的故事，主角李火旺是心素，掌握迷惘天道，心素可以通过修真大成，实现言出法随的效果，这意味着只要心素认为某件事是真的，那这件事就可能是真的。
+        number = item["id"]
+        if number > count:
+            continue
+        if number in aligned:
+            duplicated.add(number)
+            continue
+        aligned[number] = item
+    # 同一个 id 出现多次时无法判断哪条是对的，全部丢弃
+    for number in duplicated:
+        del aligned[number]
+    if not aligned:
+        raise Exception(f"No item in 'data' matches the {count} numbered inputs")
+    return aligned
+
+# 校验GPT返回的数据格式，字段不完整的条目直接丢弃，缺失的输入由 align_response 之后补请求
+validate_response = Schema(DPO_DATA_RESPONSE, name="dpo", min_yield=0)
+
+# 人设和说话特点，所有请求共用，放在 system 消息的最前面
+PERSONA = """《道诡异仙》是一部融合了玄幻、修真、恐怖和心理悬疑元素的小说，主要讲述了主角李火旺在一个诡异而扭曲的世界中挣扎求生的故事，主角李火旺是心素，掌握迷惘天道，心素可以通过修真大成，实现言出法随的效果，这意味着只要心素认为某件事是真的，那这件事就可能是真的。
 
 主角李火旺分不清虚拟和现实，体内还有很多疯狂的人格，所以一直处于痛苦和挣扎中，请根据人类输入，生成对应的正常人回答和主角李火旺多样化的疯言疯语回答
 
@@ -53,7 +127,10 @@ async def generate_dpo_data(inputs: List[str], openai_service: OpenAIHandler, ba
 例如，他会在同一段对话中表现出丹阳子的狂妄和李火旺的痛苦，这种人格的交替出现使得他的语言充满了张力和矛盾，“对啊！李火旺不会做出此种事情来，但是我会啊，丹阳子会啊，哈哈哈！本道爷我成了！！”。“什么狗屁斩三尸，你以为我还会信你的鬼话吗？！想要我的身体就直说！我能骗的了你，不代表你你能骗我！”
 
 
-角色关系参考如下：
+"""
+
+# 角色关系
+CHARACTER_NOTES = """角色关系参考如下：
 
 现代世界：
 父:李建成 母:孙晓琴
@@ -70,7 +147,10 @@ async def generate_dpo_data(inputs: List[str], openai_service: OpenAIHandler, ba
 欺骗主角的坐忘道骗子：骰子、北风、大三元、小四喜
 
 
-势力简介：
+"""
+
+# 势力简介
+FACTION_NOTES = """势力简介：
 
 1、正德寺：主角遇到的第一个教派，寺庙里都是严守戒律，不近女色的得道高僧，功法神通主要以血肉方面为主，喜欢举办有大功德的无遮大会，眼中等于男女牲畜一视同仁，有割肉喂鹰的志向，充分发挥了我佛渡世救人之心，功法即可以召唤大肉球，也可以救人。大梁的正德寺信徒很多，例如佛玉炉就是佛家弟子，大齐的正德寺则具有国教地位，实力更强，顶级高手实力也是十分强悍，大齐和尚展露过血肉成山硬抗司命的实力。司命是五智如来。
 2、袄景教：一群热衷自残的抖m，彼此聚集起来研究m的更高境界，该教的主要功法是通过痛苦获得力量，让敌人感同身受等，十分实用，即使是个废材，拿起大千录就能杀人。顶级神通有苍蜣登阶，闰置五行等，威力巨大。司命是巴虺，如果能登阶真正得到巴虺另眼相看，那就可以迈入陆地神仙的境界，获得超高的回血能力了。教徒数量相比于正德寺不算多，但是也势力广大，教中顶级高手是几个五劫大长老，实力很强。
@@ -80,7 +160,10 @@ async def generate_dpo_data(inputs: List[str], openai_service: OpenAIHandler, ba
 5、安慈庵：位于后蜀，都是爱干净的漂亮尼姑，善于从事养殖业，牙口很好，连骰子设计的天书都能咬出牙印来。后蜀的百姓对她们貌似不感冒，但是官方的人对安慈庵还是比较客气的。功法以苍蝇、老鼠、自身的肥肉为主，信仰腐烂司命。顶级高手有几位师太山。
 
 
-小说内容节选1：
+"""
+
+# 小说内容节选
+EXCERPTS = """小说内容节选1：
 
 可是他很快冷静下来，一把甩开了他的手，向着远处的红色拼命追赶。
 　　“幻觉！！这都是幻觉！！你们休想骗我！这都是假的！！”
@@ -198,55 +281,204 @@ async def generate_dpo_data(inputs: List[str], openai_service: OpenAIHandler, ba
 　　“我他妈要你出手了？就是因为你!!我会活得这般般痛苦！！”
 　　“好！好的很！！”丹阳子三双眼中露出极致的杀意，这种杀意也同时感染了李火旺。
 
-用户输入会以换行隔开，请以 JSON 格式返回每行用户输入对应的 chosen/reject，具体返回格式要求如下：
+"""
+
+# 返回格式
+OUTPUT_FORMAT = """用户输入会逐行编号，如“1. 用户输入”，请以 JSON 格式为每一行用户输入返回一条 chosen/rejected，id 为该行的编号，不可遗漏、合并或调换顺序，具体返回格式要求如下：
 {
     "data": [
         {
+            "id": 1,
             "chosen": "李火旺的回答",
             "rejected": "正常人回答"
         }
     ]
 }"""
-    
-    # 创建任务列表
-    tasks = []
-    semaphore = asyncio.Semaphore(50)  # 限制并发数
-    
-    async def process_batch(index: int, batch: List[str]):
-        async with semaphore:
+
+# 不检索时的完整 instruction，与拆分前逐字相同(保持响应缓存和前缀缓存有效)
+INSTRUCTION = PERSONA + CHARACTER_NOTES + FACTION_NOTES + EXCERPTS + OUTPUT_FORMAT
+
+def build_context_index(novel_path: str = None, passage_chars: int = 300) -> BM25Index:
+    """
+    为 DPO 请求建立检索索引：角色关系、势力简介拆成一条条设定，内置节选和小说中李火旺说话的片段作为节选
+
+    参数:
+        novel_path: 小说文件路径，不存在时只索引内置的设定和节选
+        passage_chars: 每个节选片段的最大字数
+
+    返回:
+        建好的 BM25Index
+    """
+    started_at = time.monotonic()
+    index = BM25Index()
+
+    # 角色关系按行拆分，带上所属世界
+    world = ""
+    for line in CHARACTER_NOTES.splitlines()[1:]:
+        line = line.strip()
+        if line.endswith("："):
+            world = line[:-1]
+        elif line:
+            index.add(f"{world} {line}", kind="note")
+
+    # 势力简介按序号拆分
+    for note in re.split(r"\n\s*(?=\d+、)", FACTION_NOTES.split("\n", 1)[1]):
+        if note.strip():
+            index.add(note.strip(), kind="note")
+
+    for excerpt in re.split(r"小说内容节选\d+：", EXCERPTS):
+        for passage in split_passages(excerpt, passage_chars):
+            index.add(passage, kind="excerpt")
+
+    if novel_path and os.path.exists(novel_path):
+        with ChapterStore.open(novel_path) as chapters:
+            for chapter in chapters:
+                for passage in iter_speech_passages(chapter.text, passage_chars):
+                    index.add(passage, kind="excerpt", source=f"第{chapter.number}章")
+
+    index.build()
+    kinds = {kind: sum(1 for document in index.documents if document.kind == kind) for kind in ("note", "excerpt")}
+    print(f"[retrieval] 索引 {len(index.documents)} 个文档(设定 {kinds['note']}，节选 {kinds['excerpt']})，"
+          f"耗时 {time.monotonic() - started_at:.1f}s")
+    return index
+
+def format_context(documents: list) -> str:
+    """把检索到的设定和节选拼成参考资料"""
+    notes = [document.text for document in documents if document.kind == "note"]
+    excerpts = [document for document in documents if document.kind == "excerpt"]
+    sections = []
+    if notes:
+        sections.append("角色与势力参考：\n" + "\n".join(f"- {note}" for note in notes))
+    for number, document in enumerate(excerpts, 1):
+        source = f"({document.source})" if document.source else ""
+        sections.append(f"小说内容节选{number}{source}：\n{document.text}")
+    return "\n\n".join(sections)
+
+async def generate_dpo_data(inputs, openai_service: OpenAIHandler, batch_size: int = 20, warm_prefix: bool = True,
+                            sink=None, concurrency: int = None, prompt_token_budget: int = None,
+                            completion_token_budget: int = None, completion_tokens_per_item: int = 150,
+                            max_rounds: int = 3, context_index: BM25Index = None,
+                            context_token_budget: int = 500) -> List[Dict]:
+    """
+    生成DPO数据
+
+    instruction 很长且对所有批次完全相同，作为 system 消息放在最前面，用户输入放在最后，
+    这样除第一个请求外都能命中服务端的前缀缓存。warm_prefix 为True时先单独跑完第一个批次写入缓存，
+    避免所有请求同时冷启动都未命中；批处理模式下第一个批次会单独成为一个批处理任务，等待时间翻倍，因此不预热
+
+    输入通过有界工作队列按需分批读取，同时处理的批次数只与并发上限有关，每个批次完成后立即交给 sink
+
+    批内输入逐行编号，返回结果按 id 一一对齐，对不上的条目丢弃，缺失的输入在下一轮单独重新请求，
+    因此可以放心地用大批次：instruction 每批只付一次，请求数也成倍减少
+
+    参数:
+        inputs: 用户输入的列表或惰性的可迭代对象(如 iter_inputs)
+        openai_service: OpenAI服务实例
+        batch_size: 每次请求包含的输入数(按 token 预算分批时为上限)
+        warm_prefix: 是否先单独请求第一个批次预热前缀缓存，openai_service 为批处理模式时忽略
+        sink: 可选的 sink(batch_index, records)，按完成顺序接收每个批次的结果，batch_index 可用于恢复输入顺序；
+              指定后不再在内存中汇总结果
+        concurrency: 同时处理的批次数，默认由 openai_service.worker_concurrency() 决定
+        prompt_token_budget: 每批用户输入的 token 预算，与 completion_token_budget 任一指定时按预算分批
+        completion_token_budget: 每批返回内容的 token 预算，应小于模型的最大输出长度
+        completion_tokens_per_item: 估算每条输入返回的 token 数
+        max_rounds: 每批最多请求几轮(第一轮之后只请求缺失的输入)
+        context_index: 可选的检索索引(见 build_context_index)，指定后 system 消息只保留人设和返回格式，
+                       每批按输入检索最相关的设定和节选放在用户消息中，不再每次携带全部节选
+        context_token_budget: 每批检索内容的 token 预算
+
+    返回:
+        未指定 sink 时为所有DPO数据，否则为空列表
+    """
+    dpo_data = []
+
+    async def process_batch(index: int, batch: List[str]) -> List[Dict]:
+        # 批内位置 -> 结果；每轮只请求还没有结果的输入，重新从1编号
+        results = {}
+        pending = list(range(len(batch)))
+        for round_index in range(max_rounds):
             try:
-                messages = [{
-                    "role": "system",
-                    "content": instruction
-                }]
-                
-                # 添加用户输入
-                messages.append({
-                    "role": "user",
-                    "content": "用户输入如下：\n" + "\n".join(batch)
-                })
-                
-                # 调用GPT生成数据
-                response = await openai_service.request_json(messages, validator_callback=validate_response, temp=0.7)
-                
-                # 处理返回数据
-                for idx, item in enumerate(response["data"]):
-                    dpo_data.append({
-                        "input": batch[idx],
-                        "instruction": "主角李火旺分不清虚拟和现实，体内还有很多疯狂的人格，所以一直处于痛苦和挣扎中，请用主角李火旺多样化的疯言疯语进行回答",
-                        "chosen": item["chosen"],
-                        "rejected": item["rejected"]
-                    })
-                    
+                numbered = "\n".join(f"{number}. {batch[position]}" for number, position in enumerate(pending, 1))
+                if context_index is None:
+                    messages = [{
+                        "role": "system",
+                        "content": INSTRUCTION
+                    }, {
+                        "role": "user",
+                        "content": "用户输入如下：\n" + numbered
+                    }]
+                else:
+                    # system 消息对所有批次相同，仍可命中前缀缓存；检索到的参考资料随输入变化，放在用户消息中。
+                    # 检索要遍历倒排表打分，放到线程中执行，不阻塞事件循环里其他批次的请求
+                    documents = await asyncio.to_thread(
+                        context_index.select,
+                        "\n".join(batch[position] for position in pending),
+                        context_token_budget,
+                        limits={"note": 6, "excerpt": 4},
+                    )
+                    messages = [{
+                        "role": "system",
+                        "content": PERSONA + OUTPUT_FORMAT
+                    }, {
+                        "role": "user",
+                        "content": f"{format_context(documents)}\n\n用户输入如下：\n{numbered}"
+                    }]
+
+                # 调用GPT生成数据，一条都对不上时按校验失败重试
+                count = len(pending)
+                response = await openai_service.request_json(
+                    messages,
+                    validator_callback=lambda response: align_response(response, count),
+                    temp=0.7,
+                    tag="dpo",
+                )
             except Exception as e:
                 print(f"Error processing batch {index}: {str(e)}")
-    
-    # 分批处理
-    for i in range(0, len(inputs), batch_size):
-        batch = inputs[i:i + batch_size]
-        tasks.append(process_batch(i // batch_size, batch))
-    
-    await asyncio.gather(*tasks)
+                break
+
+            # 按 id 对齐返回数据
+            for number, item in align_response(response, len(pending)).items():
+                results[pending[number - 1]] = item
+            pending = [position for position in pending if position not in results]
+            if not pending:
+                break
+            print(f"批次 {index} 第 {round_index + 1} 轮缺少 {len(pending)}/{len(batch)} 条结果" +
+                  ("，重新请求缺失的部分" if round_index + 1 < max_rounds else "，已丢弃"))
+
+        return [{
+            "input": batch[position],
+            "instruction": "主角李火旺分不清虚拟和现实，体内还有很多疯狂的人格，所以一直处于痛苦和挣扎中，请用主角李火旺多样化的疯言疯语进行回答",
+            "chosen": results[position]["chosen"],
+            "rejected": results[position]["rejected"]
+        } for position in sorted(results)]
+
+    if sink is None:
+        sink = lambda index, records: dpo_data.extend(records)
+
+    async def process_entry(entry):
+        index, batch = entry
+        return index, await process_batch(index, batch)
+
+    # 分批处理，批次序号随结果一起交给 sink
+    if prompt_token_budget or completion_token_budget:
+        batches = enumerate(iter_token_batches(
+            inputs, batch_size, prompt_token_budget, completion_token_budget, completion_tokens_per_item
+        ))
+    else:
+        batches = enumerate(iter_batches(inputs, batch_size))
+    if warm_prefix and not openai_service.is_batch:
+        first = next(batches, None)
+        if first is not None:
+            outcome = sink(*await process_entry(first))
+            if inspect.isawaitable(outcome):
+                await outcome
+
+    await run_queue(
+        batches,
+        process_entry,
+        sink=lambda _, result: sink(*result),
+        concurrency=concurrency or openai_service.worker_concurrency(),
+    )
     return dpo_data
 
 def save_dpo_data(data: List[Dict], output_path: str):
@@ -260,18 +492,48 @@ def save_dpo_data(data: List[Dict], output_path: str):
 
 async def main():
     load_dotenv()
-    # 初始化OpenAI服务
-    openai_service = OpenAIHandler(
-        openai_key=os.getenv("OPENAI_API_KEY"),
-        openai_url=os.getenv("OPENAI_BASE_URL"),
-        model="deepseek-chat"
-    )
-    
     # 读取输入数据
-    inputs = read_inputs("datasets/dpo.txt")
+    inputs = iter_inputs("datasets/dpo.txt")
+
+    # 在本地检索每批相关的设定和节选，代替每次都携带的全部节选，DPO_RETRIEVAL=0 时使用完整 instruction
+    context_index = None
+    if os.getenv("DPO_RETRIEVAL") != "0":
+        context_index = build_context_index(os.getenv("DPO_NOVEL_PATH") or "./novel.txt")
     
-    # 生成DPO数据
-    dpo_data = await generate_dpo_data(inputs, openai_service, batch_size=1)
+    # 初始化OpenAI服务，所有批次复用同一个连接池
+    # OPENAI_BATCH_MODE=1 时改为离线批处理，走 /v1/files + /v1/batches，更便宜但延迟高
+    handler_class = BatchOpenAIHandler if os.getenv("OPENAI_BATCH_MODE") == "1" else OpenAIHandler
+    # 记录每次调用的延迟、token 和费用，运行结束后导出报告
+    metrics = MetricsRecorder()
+    async with handler_class(
+        openai_key=os.getenv("OPENAI_API_KEY"),
+        openai_url=os.getenv("OPENAI_BASE_URL"),
+        model="deepseek-chat",
+        cache=ResponseCache(os.getenv("OPENAI_CACHE_PATH", ".cache/openai-responses.sqlite")),
+        cache_bypass=os.getenv("OPENAI_CACHE_BYPASS") == "1",
+        rate_limiter=RateLimiter(
+            rpm=int(os.getenv("OPENAI_RPM") or 0) or None,
+            tpm=int(os.getenv("OPENAI_TPM") or 0) or None,
+        ),
+        endpoints=parse_endpoints(os.getenv("OPENAI_ENDPOINTS")),
+        metrics=metrics,
+    ) as openai_service:
+        # 生成DPO数据
+        # 按 token 预算把尽可能多的输入装进一个请求，instruction 每批只付一次
+        dpo_data = await generate_dpo_data(
+            inputs,
+            openai_service,
+            batch_size=int(os.getenv("DPO_BATCH_SIZE") or 40),
+            prompt_token_budget=int(os.getenv("DPO_PROMPT_TOKEN_BUDGET") or 2000),
+            completion_token_budget=int(os.getenv("DPO_COMPLETION_TOKEN_BUDGET") or 3000),
+            context_index=context_index,
+            context_token_budget=int(os.getenv("DPO_CONTEXT_TOKEN_BUDGET") or 500),
+        )
+
+    # 导出调用指标报告
+    print(metrics.format_stages())
+    metrics.export_json(".cache/metrics/generate-dpo.json")
+    metrics.export_prometheus(".cache/metrics/generate-dpo.prom")
     
     # 打乱数据顺序后再保存
     import random
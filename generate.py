@@ -1,232 +1,277 @@
-import random
+import argparse
 from datasets import Dataset
 import os
 from dotenv import load_dotenv
 import asyncio
-import json
-from services.novel import split_novel_to_pretrain_data, lihuowang_sharegpt_and_save, summarize_qa_and_save
+from services.novel import lihuowang_sharegpt_and_save, summarize_qa_and_save
+from services.pretrain import load_tokenizer, write_pretrain_jsonl
 from services.openai import OpenAIHandler
-
-async def clean_dataset(data):
-    """
-    清理数据集
-    :param data: 原始数据集
-    :return: 清理后的数据集
-    """
-    import random
-    cleaned_data = []
-    
-    # 定义随机内容
-    random_human = ["火旺", "说话", "你还好吧", "醒醒", "李火旺！！"]
-    random_gpt = lambda: "艹" * random.randint(1, 10)
-    
-    for item in data:
-        try:
-            # 合并连续相同from的内容
-            merged_conversations = []
-            prev_from = None
-            for conv in item["conversations"]:
-                if conv["from"] == prev_from:
-                    merged_conversations[-1]["value"] += " " + conv["value"]
-                else:
-                    merged_conversations.append(conv)
-                prev_from = conv["from"]
-            
-            # 过滤空值并处理
-            filtered_conversations = []
-            for conv in merged_conversations:
-                if conv["from"] == "human" and not conv["value"].strip():
-                    continue
-                if conv["from"] == "gpt" and not conv["value"].strip():
-                    conv["value"] = random_gpt()
-                filtered_conversations.append(conv)
-            
-            # 处理开头和结尾
-            if filtered_conversations and filtered_conversations[0]["from"] == "gpt":
-                filtered_conversations.insert(0, {
-                    "from": "human",
-                    "value": random.choice(random_human)
-                })
-            
-            # 如果结尾是human，移除最后一条human
-            if filtered_conversations and filtered_conversations[-1]["from"] == "human":
-                filtered_conversations.pop()
-                
-            # 如果移除后只剩下human，跳过这段对话
-            if all(conv["from"] == "human" for conv in filtered_conversations):
-                continue
-            
-            # 检查对话有效性
-            if not filtered_conversations:
-                print(f"Warning: Empty conversations in item {item}")
-                continue
-                
-            if (len(filtered_conversations) < 2 or 
-                filtered_conversations[0]["from"] != "human" or
-                filtered_conversations[1]["from"] != "gpt" or
-                filtered_conversations[-1]["from"] != "gpt"):
-                print(f"Warning: Invalid conversation structure in item {item}")
-                continue
-                
-            # 保存有效数据
-            cleaned_data.append({
-                "conversations": filtered_conversations,
-                "capter": item["capter"]
-            })
-            
-        except Exception as e:
-            print(f"Error processing item {item}: {str(e)}")
-    
-    print(f"Final dataset size: {len(cleaned_data)}")
-    return cleaned_data
+from services.cache import ResponseCache
+from services.limiter import RateLimiter
+from services.endpoints import parse_endpoints
+from services.batch import BatchOpenAIHandler
+from services.metrics import MetricsRecorder
+from services.pipeline import Pipeline
+from services.dedup import dedup_file
+from services.prescan import DialoguePrescan
+from services.convert import convert_file, iter_records
+from services.cleaning import clean_file
 
 async def convert_sharegpt_to_alpaca(sharegpt_path: str, alpaca_path: str, instruct: str) -> None:
-    """将sharegpt格式数据转换为alpaca格式
+    """将sharegpt格式数据转换为alpaca格式，逐条读取和写出，不把整个文件载入内存
     
     参数:
         sharegpt_path: sharegpt格式数据文件路径
-        alpaca_path: 输出alpaca格式数据文件路径
+        alpaca_path: 输出alpaca格式数据文件路径，扩展名可以是 .json / .jsonl / .parquet / .arrow
         instruct: 指令模板
     """
-    # 读取sharegpt数据
-    with open(sharegpt_path, "r", encoding="utf-8") as f:
-        sharegpt_data = json.load(f)
-    
-    alpaca_data = []
-    for item in sharegpt_data:
-        # 确保对话格式正确
-        if len(item["conversations"]) < 2:
-            continue
-        if item["conversations"][0]["from"] != "human" or item["conversations"][1]["from"] != "gpt":
-            continue
-            
-        # 构建alpaca格式
-        alpaca_item = {
-            "instruction": instruct,
-            "input": item["conversations"][0]["value"],
-            "output": item["conversations"][1]["value"]
-        }
-        alpaca_data.append(alpaca_item)
-    
-    # 保存转换后的数据
-    with open(alpaca_path, "w", encoding="utf-8") as f:
-        json.dump(alpaca_data, f, ensure_ascii=False, indent=2)
+    await asyncio.to_thread(convert_file, sharegpt_path, alpaca_path, "sharegpt", "alpaca", instruct=instruct)
 
 
 async def convert_summary_to_sharegpt(summary_path, output_path):
-    """将章节摘要转换为sharegpt格式"""
-    with open(summary_path, "r", encoding="utf-8") as f:
-        summary_data = json.load(f)
-    
-    # 问题模板
-    question_templates = [
-        "《道诡异仙》第{chapter}章主要讲了什么内容",
-        "《道诡异仙》第{chapter}章主要内容是什么",
-        "《道诡异仙》第{chapter}章主要写了啥",
-        "《道诡异仙》第{chapter}章讲了什么",
-        "《道诡异仙》第{chapter}章主要是什么剧情",
-        "《道诡异仙》第{chapter}章剧情是什么",
-        "《道诡异仙》第{chapter}章内容是什么",
-        "《道诡异仙》第{chapter}章他们做了什么事",
-        "《道诡异仙》第{chapter}章他们干了什么事"
-    ]
-    
-    sharegpt_data = []
-    for item in summary_data:
-        chapter = item["chapter"] + 1  # 章节号+1
-        question = random.choice(question_templates).format(chapter=chapter)
-        
-        sharegpt_data.append({
-            "conversations": [
-                {"from": "human", "value": question},
-                {"from": "gpt", "value": item["summary"]}
-            ],
-            "chapter": item["chapter"]
-        })
-    
-    # 保存转换后的数据
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(sharegpt_data, f, ensure_ascii=False, indent=2)
+    """将章节摘要转换为sharegpt格式，问题模板见 services/convert.py 的 SUMMARY_QUESTION_TEMPLATES"""
+    await asyncio.to_thread(convert_file, summary_path, output_path, "summary", "sharegpt")
 
-async def main():
-    # 加载环境变量
-    load_dotenv()
+def build_pipeline(openai_service: OpenAIHandler) -> Pipeline:
+    """
+    定义生成流程的各个阶段，依赖关系由输入输出文件推导
 
-    # 调用分割函数生成预训练数据
-    pretrain_data = split_novel_to_pretrain_data("./novel.txt")
-    
-    # 创建datasets目录（如果不存在）
-    os.makedirs("datasets", exist_ok=True)
-    
-    # 保存预训练数据
-    with open("datasets/daoguiyixian-pretrain.json", "w", encoding="utf-8") as f:
-        json.dump(pretrain_data, f, ensure_ascii=False, indent=2)
-    
-    # 初始化openai服务
-    openai_service = OpenAIHandler(
-        openai_key=os.getenv("OPENAI_API_KEY"),
-        openai_url=os.getenv("OPENAI_BASE_URL"),
-        model="deepseek-chat"
+    QA 和对话两条链路互不依赖，会同时请求，共用 openai_service 的并发和速率限制；
+    LLM 阶段把 services/novel.py 也作为输入，修改提示词后会重新执行(只重新生成指纹变化的部分)
+    :param openai_service: OpenAI服务实例
+    :return: Pipeline
+    """
+    pipeline = Pipeline()
+    novel_path = "./novel.txt"
+    prompts_path = "services/novel.py"
+    instruct = "请用你理解的《道诡异仙》小说内容解答用户疑惑"
+
+    # 流式切分小说生成预训练数据，逐条写入 JSONL；纯本地计算，放到线程中执行，不阻塞其他阶段的请求
+    # PRETRAIN_TOKENIZER 可以指定 transformers 分词器(如 Qwen/Qwen2.5-7B-Instruct)，默认粗略估算 token 数
+    async def pretrain():
+        pretrain_count = await asyncio.to_thread(
+            write_pretrain_jsonl,
+            novel_path,
+            "datasets/daoguiyixian-pretrain.jsonl",
+            target_tokens=int(os.getenv("PRETRAIN_TARGET_TOKENS") or 1200),
+            tokenizer=load_tokenizer(os.getenv("PRETRAIN_TOKENIZER")),
+            overlap=int(os.getenv("PRETRAIN_OVERLAP_TOKENS") or 0),
+            snap=os.getenv("PRETRAIN_SNAP") or "line",
+            optimal=os.getenv("PRETRAIN_OPTIMAL") == "1",
+        )
+        print(f"预训练数据共 {pretrain_count} 块")
+
+    pipeline.add(
+        "pretrain", pretrain,
+        inputs=[novel_path],
+        outputs=["datasets/daoguiyixian-pretrain.jsonl"],
     )
-    
-    
+
     # 调用QA总结函数
-    await summarize_qa_and_save(
-        novel_path="./novel.txt",
-        conv_output_path="datasets/daoguiyixian-sharegpt-qa-v2.json",
-        summary_output_path="datasets/daoguiyixian-summary-v2.json",
-        openai_service=openai_service,
-        # force=True
+    pipeline.add(
+        "qa",
+        lambda: summarize_qa_and_save(
+            novel_path=novel_path,
+            conv_output_path="datasets/daoguiyixian-sharegpt-qa-v2.json",
+            summary_output_path="datasets/daoguiyixian-summary-v2.json",
+            openai_service=openai_service,
+            # QA_COMBINED_ANGLES=1 时每章只发一次携带全文的提问请求
+            combined_angles=os.getenv("QA_COMBINED_ANGLES") == "1",
+            # QA_WARM_PREFIX=1 时每章先请求摘要预热前缀缓存，再请求各个角度
+            warm_prefix=os.getenv("QA_WARM_PREFIX") == "1",
+            # force=True
+        ),
+        inputs=[novel_path, prompts_path],
+        outputs=["datasets/daoguiyixian-sharegpt-qa-v2.json", "datasets/daoguiyixian-summary-v2.json"],
     )
-    
+
     # 将摘要转换为sharegpt格式
-    await convert_summary_to_sharegpt(
-        summary_path="datasets/daoguiyixian-summary-v2.json",
-        output_path="datasets/daoguiyixian-sharegpt-summary-v2.json"
+    pipeline.add(
+        "summary-sharegpt",
+        lambda: convert_summary_to_sharegpt(
+            summary_path="datasets/daoguiyixian-summary-v2.json",
+            output_path="datasets/daoguiyixian-sharegpt-summary-v2.json"
+        ),
+        inputs=["datasets/daoguiyixian-summary-v2.json"],
+        outputs=["datasets/daoguiyixian-sharegpt-summary-v2.json"],
     )
+
     # 将sharegpt格式的摘要数据转换为alpaca格式
-    await convert_sharegpt_to_alpaca(
-        sharegpt_path="datasets/daoguiyixian-sharegpt-summary-v2.json",
-        alpaca_path="datasets/daoguiyixian-alpaca-summary-v2.json",
-        instruct="请用你理解的《道诡异仙》小说内容解答用户疑惑"
+    pipeline.add(
+        "summary-alpaca",
+        lambda: convert_sharegpt_to_alpaca(
+            sharegpt_path="datasets/daoguiyixian-sharegpt-summary-v2.json",
+            alpaca_path="datasets/daoguiyixian-alpaca-summary-v2.json",
+            instruct=instruct
+        ),
+        inputs=["datasets/daoguiyixian-sharegpt-summary-v2.json"],
+        outputs=["datasets/daoguiyixian-alpaca-summary-v2.json"],
     )
-    
+
+    # 近似去重：多个提问角度和相邻章节会问出大量换了说法的重复问题
+    # MinHash + LSH，DEDUP_THRESHOLD 为 Jaccard 相似度阈值，DEDUP_NGRAM 为按字切分的 n-gram 长度
+    dedup_options = {
+        "threshold": float(os.getenv("DEDUP_THRESHOLD") or 0.7),
+        "ngram": int(os.getenv("DEDUP_NGRAM") or 3),
+    }
+    pipeline.add(
+        "dedup-qa",
+        lambda: asyncio.to_thread(
+            dedup_file,
+            "datasets/daoguiyixian-sharegpt-qa-v2.json",
+            "datasets/daoguiyixian-sharegpt-qa-v2-dedup.json",
+            ".cache/dedup/daoguiyixian-sharegpt-qa-v2.json",
+            group_of=lambda item: item.get("chapter_number", item["chapter"]),
+            **dedup_options,
+        ),
+        inputs=["datasets/daoguiyixian-sharegpt-qa-v2.json"],
+        outputs=["datasets/daoguiyixian-sharegpt-qa-v2-dedup.json"],
+    )
+
     # 将sharegpt格式的QA数据转换为alpaca格式
-    await convert_sharegpt_to_alpaca(
-        sharegpt_path="datasets/daoguiyixian-sharegpt-qa-v2.json",
-        alpaca_path="datasets/daoguiyixian-alpaca-qa-v2.json",
-        instruct="请用你理解的《道诡异仙》小说内容解答用户疑惑"
+    pipeline.add(
+        "qa-alpaca",
+        lambda: convert_sharegpt_to_alpaca(
+            sharegpt_path="datasets/daoguiyixian-sharegpt-qa-v2-dedup.json",
+            alpaca_path="datasets/daoguiyixian-alpaca-qa-v2.json",
+            instruct=instruct
+        ),
+        inputs=["datasets/daoguiyixian-sharegpt-qa-v2-dedup.json"],
+        outputs=["datasets/daoguiyixian-alpaca-qa-v2.json"],
     )
-    
-    # 调用封装后的函数
-    await lihuowang_sharegpt_and_save(
-        novel_path="./novel.txt",
-        output_path="datasets/lihuowang-sharegpt-origin.json",
-        openai_service=openai_service
+
+    # 李火旺的对话数据
+    # 先在本地扫描引语，DIALOGUE_PRESCAN=0 关闭；评分低于 DIALOGUE_PRESCAN_THRESHOLD 的章节跳过，
+    # 配置了 DIALOGUE_CHEAP_MODEL 时改用该模型
+    prescan = None
+    if os.getenv("DIALOGUE_PRESCAN") != "0":
+        prescan = DialoguePrescan(
+            model=openai_service.model,
+            threshold=float(os.getenv("DIALOGUE_PRESCAN_THRESHOLD") or 0.5),
+            cheap_model=os.getenv("DIALOGUE_CHEAP_MODEL") or None,
+        )
+    pipeline.add(
+        "dialogue",
+        lambda: lihuowang_sharegpt_and_save(
+            novel_path=novel_path,
+            output_path="datasets/lihuowang-sharegpt-origin.json",
+            openai_service=openai_service,
+            prescan=prescan,
+        ),
+        inputs=[novel_path, prompts_path],
+        outputs=["datasets/lihuowang-sharegpt-origin.json"],
     )
 
-    # 读取原始数据
-    with open("datasets/lihuowang-sharegpt-origin.json", "r", encoding="utf-8") as f:
-        origin_data = json.load(f)
-    
-    # 清理数据
-    cleaned_data = await clean_dataset(origin_data)
+    # 清理是纯 CPU 计算，按块分给多个进程(PARALLEL_WORKERS，默认 CPU 核数)，随机补全的内容按块固定种子，输出与进程数无关
+    pipeline.add(
+        "clean",
+        lambda: asyncio.to_thread(
+            clean_file,
+            "datasets/lihuowang-sharegpt-origin.json",
+            "datasets/lihuowang-sharegpt.json",
+        ),
+        inputs=["datasets/lihuowang-sharegpt-origin.json", "services/cleaning.py"],
+        outputs=["datasets/lihuowang-sharegpt.json"],
+    )
+
+    pipeline.add(
+        "dedup-dialogue",
+        lambda: asyncio.to_thread(
+            dedup_file,
+            "datasets/lihuowang-sharegpt.json",
+            "datasets/lihuowang-sharegpt-dedup.json",
+            ".cache/dedup/lihuowang-sharegpt.json",
+            group_of=lambda item: item["capter"],
+            **dedup_options,
+        ),
+        inputs=["datasets/lihuowang-sharegpt.json"],
+        outputs=["datasets/lihuowang-sharegpt-dedup.json"],
+    )
+
+    def iter_dialogue_rows(path: str, version: tuple):
+        # version 只用于 datasets 的缓存指纹：from_generator 按生成函数和参数缓存，不含文件内容，文件变化后需要不同的参数
+        yield from iter_records(path, columns=["conversations", "capter"])
+
+    def save_dataset():
+        # 从 JSON 流式生成，datasets 按批写入 Arrow 缓存，不需要先把整个数据集载入内存
+        path = "datasets/lihuowang-sharegpt-dedup.json"
+        stat = os.stat(path)
+        dataset = Dataset.from_generator(
+            iter_dialogue_rows,
+            gen_kwargs={"path": path, "version": (stat.st_size, stat.st_mtime_ns)},
+        )
 
-    # 保存清理后的数据为json文件
-    with open("datasets/lihuowang-sharegpt.json", "w", encoding="utf-8") as f:
-        json.dump(cleaned_data, f, ensure_ascii=False, indent=2)
+        # 保存数据集
+        dataset.save_to_disk("datasets/lihuowang-sharegpt")
+
+    pipeline.add(
+        "save-dataset", lambda: asyncio.to_thread(save_dataset),
+        inputs=["datasets/lihuowang-sharegpt-dedup.json"],
+        outputs=["datasets/lihuowang-sharegpt"],
+    )
+    return pipeline
+
+
+async def main(targets: list = None, force: bool = False, dry_run: bool = False, list_stages: bool = False):
+    """
+    执行生成流程
+    :param targets: 要执行的阶段(会同时执行其上游阶段)，为空时执行全部阶段
+    :param force: 忽略文件时间执行所有选中的阶段(LLM 阶段仍会复用断点中指纹未变的结果)
+    :param dry_run: 只打印各阶段是否需要执行
+    :param list_stages: 只列出所有阶段
+    """
+    # 加载环境变量
+    load_dotenv()
     
-    # 使用datasets库保存清理后的数据
-    dataset = Dataset.from_dict({
-        "conversations": [item["conversations"] for item in cleaned_data],
-        "capter": [item["capter"] for item in cleaned_data]
-    })
+    # 创建datasets目录（如果不存在）
+    os.makedirs("datasets", exist_ok=True)
     
-    # 保存数据集
-    dataset.save_to_disk("datasets/lihuowang-sharegpt")
+    # 初始化openai服务，整个流程复用同一个连接池
+    # OPENAI_BATCH_MODE=1 时改为离线批处理，走 /v1/files + /v1/batches，更便宜但延迟高
+    handler_class = BatchOpenAIHandler if os.getenv("OPENAI_BATCH_MODE") == "1" else OpenAIHandler
+    # 记录每次调用的延迟、token 和费用，运行结束后导出报告
+    metrics = MetricsRecorder()
+    async with handler_class(
+        openai_key=os.getenv("OPENAI_API_KEY"),
+        openai_url=os.getenv("OPENAI_BASE_URL"),
+        model="deepseek-chat",
+        cache=ResponseCache(os.getenv("OPENAI_CACHE_PATH", ".cache/openai-responses.sqlite")),
+        cache_bypass=os.getenv("OPENAI_CACHE_BYPASS") == "1",
+        rate_limiter=RateLimiter(
+            rpm=int(os.getenv("OPENAI_RPM") or 0) or None,
+            tpm=int(os.getenv("OPENAI_TPM") or 0) or None,
+        ),
+        endpoints=parse_endpoints(os.getenv("OPENAI_ENDPOINTS")),
+        metrics=metrics,
+    ) as openai_service:
+        pipeline = build_pipeline(openai_service)
+        if list_stages:
+            for stage in pipeline.stages.values():
+                dependencies = pipeline.dependencies(stage)
+                print(stage.name + (f" <- {', '.join(dependencies)}" if dependencies else ""))
+            return
+        await pipeline.run(targets, force=force, dry_run=dry_run)
+
+    # 导出调用指标报告
+    if metrics.stages:
+        print(metrics.format_stages())
+        metrics.export_json(".cache/metrics/generate.json")
+        metrics.export_prometheus(".cache/metrics/generate.prom")
 
 if __name__ == "__main__":
+    # python generate.py                 执行全部阶段，输出已是最新的阶段会跳过
+    # python generate.py qa-alpaca       只执行 qa-alpaca 及其上游阶段
+    # python generate.py --list          列出所有阶段和依赖
+    parser = argparse.ArgumentParser(description="Generate datasets from novel.txt")
+    parser.add_argument("targets", nargs="*", help="Stages to run together with their upstream stages (default: all)")
+    parser.add_argument("--force", action="store_true", help="Run selected stages even if their outputs are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="Print which stages would run without running them")
+    parser.add_argument("--list", action="store_true", help="List stages and their dependencies")
+    args = parser.parse_args()
+
     try:
-        asyncio.run(main=main())
+        asyncio.run(main(targets=args.targets, force=args.force, dry_run=args.dry_run, list_stages=args.list))
+    except KeyboardInterrupt:
+        print("已中断，重新运行会从断点继续")
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -0,0 +1,44 @@
+import argparse
+import json
+from aiohttp import web
+from services.mock_server import MockOpenAIServer
+
+if __name__ == "__main__":
+    # 启动本地模拟服务，python mock-server.py --port=8000 --latency=lognormal:1.5:0.6 --rate-429=0.05
+    # 然后把 .env 中的 OPENAI_BASE_URL 改为 http://127.0.0.1:8000 即可离线跑 generate.py / generate-dpo.py
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server for offline load testing")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Listen host")
+    parser.add_argument("--port", type=int, default=8000, help="Listen port")
+    parser.add_argument("--latency", type=str, default="fixed:0", help="Latency distribution, e.g. fixed:0.5, uniform:0.2:2, normal:1:0.3, lognormal:1.5:0.6")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Probability of returning HTTP 429")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="Probability of returning HTTP 500")
+    parser.add_argument("--rate-malformed", type=float, default=0.0, help="Probability of returning truncated JSON in json mode")
+    parser.add_argument("--rate-partial", type=float, default=0.0, help="Probability of dropping each numbered item in DPO batch responses")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429 responses")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="Return 429 above this many concurrent requests (0 = unlimited)")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Simulated batch processing time (seconds)")
+    parser.add_argument("--canned", type=str, default=None, help="JSON file with fixed responses keyed by prompt type (summary/qa/dialogue/dpo)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducible latency and faults")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="Disable simulated prefix caching (prompt_cache_hit_tokens)")
+
+    args = parser.parse_args()
+
+    canned = None
+    if args.canned:
+        with open(args.canned, "r", encoding="utf-8") as f:
+            canned = json.load(f)
+
+    server = MockOpenAIServer(
+        latency=args.latency,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        rate_malformed=args.rate_malformed,
+        retry_after=args.retry_after,
+        max_concurrency=args.max_concurrency,
+        batch_delay=args.batch_delay,
+        canned=canned,
+        seed=args.seed,
+        prefix_cache=not args.no_prefix_cache,
+        rate_partial=args.rate_partial,
+    )
+    web.run_app(server.create_app(), host=args.host, port=args.port)
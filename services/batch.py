@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+
+import aiohttp
+
+from services.metrics import merge_usage
+from services.openai import OpenAIHandler
+from services.retry import APIConnectionError, APIError, ResponseValidationError, ServerError, error_for_status
+
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchClient:
+    def __init__(self, session: aiohttp.ClientSession, openai_url: str, openai_key: str):
+        """
+        OpenAI 风格的 /v1/files + /v1/batches 接口客户端
+
+        Args:
+            session: 共享会话
+            openai_url: API 地址
+            openai_key: API 密钥
+        """
+        self.session = session
+        self.openai_url = openai_url
+        self.headers = {"Authorization": f"Bearer {openai_key}"}
+
+    async def _json(self, response: aiohttp.ClientResponse) -> dict:
+        text = await response.text()
+        if response.status >= 400:
+            raise error_for_status(response.status, f"批任务接口错误: {text[:200]}")
+        return json.loads(text)
+
+    async def upload_file(self, path: str) -> str:
+        """
+        上传 JSONL 请求文件
+
+        Args:
+            path: 本地 JSONL 文件路径
+
+        Returns:
+            str: 文件 id
+        """
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        with open(path, "rb") as f:
+            form.add_field("file", f.read(), filename=os.path.basename(path), content_type="application/jsonl")
+        async with self.session.post(f"{self.openai_url}/v1/files", headers=self.headers, data=form) as response:
+            return (await self._json(response))["id"]
+
+    async def create_batch(self, input_file_id: str, completion_window: str = "24h") -> dict:
+        """
+        创建批任务
+
+        Args:
+            input_file_id: 已上传的请求文件 id
+            completion_window: 完成时限
+
+        Returns:
+            dict: 批任务对象
+        """
+        payload = {
+            "input_file_id": input_file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": completion_window,
+        }
+        async with self.session.post(f"{self.openai_url}/v1/batches", headers=self.headers, json=payload) as response:
+            return await self._json(response)
+
+    async def get_batch(self, batch_id: str) -> dict:
+        """
+        查询批任务状态
+
+        Args:
+            batch_id: 批任务 id
+
+        Returns:
+            dict: 批任务对象
+        """
+        async with self.session.get(f"{self.openai_url}/v1/batches/{batch_id}", headers=self.headers) as response:
+            return await self._json(response)
+
+    async def download_file(self, file_id: str) -> str:
+        """
+        下载文件内容
+
+        Args:
+            file_id: 文件 id
+
+        Returns:
+            str: 文件文本
+        """
+        async with self.session.get(f"{self.openai_url}/v1/files/{file_id}/content", headers=self.headers) as response:
+            text = await response.text()
+            if response.status >= 400:
+                raise error_for_status(response.status, f"下载批任务结果失败: {text[:200]}")
+            return text
+
+
+class BatchOpenAIHandler(OpenAIHandler):
+    is_batch = True
+
+    def __init__(self, *args, batch_dir: str = ".cache/batches", flush_interval: float = 2.0,
+                 poll_interval: float = 30.0, completion_window: str = "24h", max_batch_size: int = 50000, **kwargs):
+        """
+        离线批处理模式的 OpenAIHandler，接口与 OpenAIHandler 完全一致，可以直接传给现有流水线
+
+        request/request_json 不会立即发请求，而是进入待提交队列；队列在 flush_interval 秒内没有新请求
+        (或达到 max_batch_size)时整体写成 JSONL，通过 /v1/files + /v1/batches 提交并轮询，
+        拿到结果后按 custom_id 唤醒对应的调用方。校验失败的请求会进入下一个批次重试。
+        custom_id 由请求内容哈希得到，相同请求在同一批次中只提交一次
+
+        Args:
+            batch_dir: 保存请求/结果 JSONL 的目录
+            flush_interval: 队列空闲多久后提交(秒)
+            poll_interval: 轮询批任务状态的间隔(秒)
+            completion_window: 批任务完成时限
+            max_batch_size: 单个批次的最大请求数
+            其余参数同 OpenAIHandler，批任务使用第一个端点
+        """
+        super().__init__(*args, **kwargs)
+        self.batch_dir = batch_dir
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._flush_handle = None
+        self._batch_tasks = set()
+
+    def worker_concurrency(self, requests_per_item: int = 1) -> int:
+        """
+        批处理模式下请求只是进入队列，并发数要足够大，才能让一个批次装下尽可能多的请求
+        """
+        return max(1, math.ceil(self.max_batch_size / requests_per_item))
+
+    @staticmethod
+    def make_custom_id(data: dict) -> str:
+        """
+        根据请求体计算稳定的 custom_id
+        """
+        payload = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return "req-" + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    async def _chat_attempts(self, data: dict, parse, cache_key: str, log_prefix: str, error_prefix: str, trace: dict):
+        policy = self.retry_policy
+        temperature = data["temperature"]
+        validation_failures = 0
+        attempt = 0
+        # 批任务都提交到第一个端点，见 _run_batch
+        trace["model"] = self.pool.endpoints[0].model or data["model"]
+        while True:
+            trace["attempts"] += 1
+            try:
+                content, usage = await self._submit(data)
+                merge_usage(trace["usage"], usage)
+                try:
+                    parsed = parse(content)
+                except Exception as e:
+                    raise ResponseValidationError(str(e)) from e
+
+                if cache_key is not None:
+                    self.cache.set(cache_key, content)
+                return parsed
+
+            except APIError as e:
+                print(f"{log_prefix} [batch] 第 {attempt + 1} 次请求失败，{type(e).__name__}: {str(e)}")
+                if not policy.should_retry(e, attempt):
+                    raise APIError(f"{error_prefix}(重试{attempt + 1}次): {str(e)}", e.status) from e
+                if isinstance(e, ResponseValidationError):
+                    validation_failures += 1
+                    data = {**data, "temperature": policy.get_temperature(temperature, validation_failures)}
+                attempt += 1
+
+    async def _submit(self, data: dict) -> tuple:
+        """
+        把请求放入待提交队列，等待批任务返回
+
+        Returns:
+            tuple: (message content, usage)
+        """
+        custom_id = self.make_custom_id(data)
+        future = self._pending.get(custom_id, (None, None))[1]
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[custom_id] = (data, future)
+        self._schedule_flush()
+        return await asyncio.shield(future)
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        else:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if not self._pending:
+            return
+        items, self._pending = self._pending, {}
+        task = asyncio.ensure_future(self._run_batch(items))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, items: dict):
+        """
+        提交一个批次并等待结果，结果按 custom_id 分发给等待中的请求
+        """
+        endpoint = self.pool.endpoints[0]
+        digest = hashlib.sha256("".join(sorted(items)).encode("utf-8")).hexdigest()[:8]
+        name = f"batch-{time.strftime('%Y%m%d-%H%M%S')}-{digest}"
+        os.makedirs(self.batch_dir, exist_ok=True)
+        input_path = os.path.join(self.batch_dir, f"{name}.jsonl")
+
+        try:
+            with open(input_path, "w", encoding="utf-8") as f:
+                for custom_id, (data, _) in items.items():
+                    body = {**data, "model": endpoint.model} if endpoint.model else data
+                    f.write(json.dumps({
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": body,
+                    }, ensure_ascii=False) + "\n")
+
+            client = BatchClient(await self._get_session(), endpoint.url, endpoint.key)
+            file_id = await client.upload_file(input_path)
+            batch = await client.create_batch(file_id, self.completion_window)
+            print(f"已提交批任务 {batch['id']}，共 {len(items)} 条请求，请求文件 {input_path}")
+
+            while batch["status"] not in BATCH_TERMINAL_STATUSES:
+                await asyncio.sleep(self.poll_interval)
+                batch = await client.get_batch(batch["id"])
+            print(f"批任务 {batch['id']} 结束，状态 {batch['status']}，统计 {batch.get('request_counts')}")
+
+            lines = []
+            for file_key in ("output_file_id", "error_file_id"):
+                if batch.get(file_key):
+                    lines.extend((await client.download_file(batch[file_key])).splitlines())
+            with open(os.path.join(self.batch_dir, f"{name}.output.jsonl"), "w", encoding="utf-8") as f:
+                f.write("\n".join(lines))
+
+            results = {}
+            for line in lines:
+                if line.strip():
+                    record = json.loads(line)
+                    results[record["custom_id"]] = record
+
+            for custom_id, (_, future) in items.items():
+                if future.done():
+                    continue
+                record = results.get(custom_id)
+                if record is None:
+                    future.set_exception(ServerError(f"批任务 {batch['id']} 未返回结果，状态 {batch['status']}"))
+                    continue
+                response = record.get("response") or {}
+                status = response.get("status_code", 500)
+                if record.get("error") or status >= 400:
+                    message = record.get("error") or (response.get("body") or {}).get("error")
+                    future.set_exception(error_for_status(status if status >= 400 else 500, f"批任务请求失败: {message}"))
+                    continue
+                try:
+                    body = response["body"]
+                    future.set_result((body["choices"][0]["message"]["content"], body.get("usage")))
+                except (KeyError, IndexError, TypeError):
+                    future.set_exception(ServerError(f"批任务响应缺少内容: {str(response)[:200]}"))
+
+        except Exception as e:
+            error = e if isinstance(e, APIError) else APIConnectionError(f"批任务执行失败: {type(e).__name__} {str(e)}")
+            for _, future in items.values():
+                if not future.done():
+                    future.set_exception(error)
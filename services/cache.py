@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_entries: int = 200000, max_bytes: int = 2 * 1024 ** 3, ttl: float = None,
+                 flush_every: int = 500):
+        """
+        基于 SQLite 的 LLM 响应缓存，按请求内容的哈希寻址
+
+        Args:
+            path: SQLite 文件路径
+            max_entries: 最多保留的条目数，超出后按最近访问时间淘汰(LRU)
+            max_bytes: 响应内容总字节数上限，超出后按最近访问时间淘汰(LRU)
+            ttl: 条目有效期(秒)，默认None表示永不过期
+            flush_every: 命中时的访问时间先记在内存中，累计这么多条(或写入、关闭时)再一次性提交，
+                         避免每次命中都在事件循环线程上同步提交事务
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._accessed = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: list, temperature: float, seed: int = 0, response_format: dict = None) -> str:
+        """
+        计算请求的缓存键
+
+        Args:
+            model: 模型名称
+            messages: 消息列表
+            temperature: 温度参数
+            seed: 随机种子
+            response_format: 响应格式，如 {"type": "json_object"}
+
+        Returns:
+            str: sha256 十六进制摘要
+        """
+        payload = json.dumps({
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "seed": seed,
+            "response_format": response_format,
+        }, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        读取缓存，过期条目视为未命中并删除
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            str | None: 缓存的响应内容
+        """
+        row = self._conn.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None:
+            self.misses += 1
+            return None
+        content, created_at = row
+        if self.ttl is not None and now - created_at > self.ttl:
+            self.delete(key)
+            self.misses += 1
+            return None
+        self._accessed[key] = now
+        if len(self._accessed) >= self.flush_every:
+            self.flush()
+        self.hits += 1
+        return content
+
+    def set(self, key: str, content: str):
+        """
+        写入缓存，并在超出容量时淘汰最久未访问的条目
+
+        Args:
+            key: 缓存键
+            content: 响应内容
+        """
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, content, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, content, len(content.encode("utf-8")), now, now),
+        )
+        # 淘汰前先写入待提交的访问时间，保证按最新的访问时间淘汰
+        self._accessed.pop(key, None)
+        self._write_accessed()
+        self._evict()
+        self._conn.commit()
+
+    def delete(self, key: str):
+        """
+        删除缓存条目
+
+        Args:
+            key: 缓存键
+        """
+        self._accessed.pop(key, None)
+        self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._conn.commit()
+
+    def flush(self):
+        """
+        提交内存中累计的访问时间
+        """
+        if self._accessed:
+            self._write_accessed()
+            self._conn.commit()
+
+    def _write_accessed(self):
+        """
+        把累计的访问时间写入当前事务，不提交
+        """
+        if not self._accessed:
+            return
+        self._conn.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                               [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+        self._accessed = {}
+
+    def _evict(self):
+        """
+        淘汰过期条目，再按 LRU 淘汰到条目数和字节数都在上限以内
+        """
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # 从最久未访问的条目开始删除，直到满足两个上限
+        removed = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            removed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", removed)
+
+    def close(self):
+        """
+        提交累计的访问时间并关闭数据库连接
+        """
+        self.flush()
+        self._conn.close()
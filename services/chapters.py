@@ -0,0 +1,303 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+
+# 索引格式或章节标题规则变化时加1，旧索引会自动重建
+INDEX_VERSION = 1
+
+CHINESE_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+CHINESE_UNITS = {"十": 10, "百": 100, "千": 1000, "万": 10000}
+
+
+def parse_chapter_number(value: str) -> int:
+    """
+    解析章节号，支持阿拉伯数字和中文数字(如 一百二十三、两千零五)
+
+    Args:
+        value: 章节号文本
+
+    Returns:
+        int: 章节号
+    """
+    if value.isdigit():
+        return int(value)
+    total, section, digit = 0, 0, 0
+    for char in value:
+        if char in CHINESE_DIGITS:
+            digit = CHINESE_DIGITS[char]
+        elif char == "万":
+            total += (section + digit) * 10000
+            section, digit = 0, 0
+        else:
+            # 「十二」这种省略了「一」的写法
+            section += (digit or 1) * CHINESE_UNITS[char]
+            digit = 0
+    return total + section + digit
+
+
+def detect_encoding(path: str, sample_size: int = 65536) -> str:
+    """
+    检测小说文件编码，只区分 UTF-8(可带 BOM) 和 GB18030(兼容 GBK/GB2312)
+
+    Args:
+        path: 文件路径
+        sample_size: 用于检测的字节数
+
+    Returns:
+        str: utf-8-sig / utf-8 / gb18030
+    """
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    if sample.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    try:
+        sample.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        # 采样截断在多字节字符中间不算错误
+        if e.reason == "unexpected end of data" and len(sample) == sample_size:
+            return "utf-8"
+        return "gb18030"
+
+
+def compile_header_pattern(encoding: str) -> re.Pattern:
+    """
+    按文件编码构造匹配章节标题行(如 `第96章 痛楚`)的字节正则
+
+    只在行首匹配：0x0A 在 UTF-8 和 GBK 中都不会出现在多字节字符内部，行首一定是字符边界，
+    因此可以直接在原始字节上搜索而不用先解码整个文件
+
+    Args:
+        encoding: 文件编码
+
+    Returns:
+        re.Pattern: 分组1为章节号，分组2为标题
+    """
+    codec = "utf-8" if encoding == "utf-8-sig" else encoding
+
+    def alternation(chars) -> bytes:
+        return b"|".join(re.escape(char.encode(codec)) for char in chars)
+
+    numerals = alternation(list(CHINESE_DIGITS) + list(CHINESE_UNITS))
+    spaces = alternation([" ", "\t", "　"])
+    bom = b"(?:\xef\xbb\xbf)?" if codec == "utf-8" else b""
+    return re.compile(
+        b"(?m)^" + bom + b"(?:" + spaces + b")*"
+        + re.escape("第".encode(codec))
+        + b"([0-9]+|(?:" + numerals + b")+)"
+        + re.escape("章".encode(codec))
+        + b"([^\r\n]*)\r?\n?"
+    )
+
+
+class Chapter:
+    __slots__ = ("store", "index", "number", "title", "start", "end", "sha1")
+
+    def __init__(self, store: "ChapterStore", index: int, number: int, title: str, start: int, end: int, sha1: str):
+        """
+        章节元数据，正文在访问 text 时才从映射的文件中解码
+
+        Args:
+            store: 所属的 ChapterStore
+            index: 在文件中的顺序(从0开始)
+            number: 标题中的章节号
+            title: 章节标题
+            start: 正文起始字节偏移(标题行之后)
+            end: 正文结束字节偏移(不含)
+            sha1: 正文字节的 sha1
+        """
+        self.store = store
+        self.index = index
+        self.number = number
+        self.title = title
+        self.start = start
+        self.end = end
+        self.sha1 = sha1
+
+    @property
+    def text(self) -> str:
+        """章节正文"""
+        return self.store.read(self.start, self.end)
+
+    def __repr__(self) -> str:
+        return f"Chapter(number={self.number}, title={self.title!r}, bytes={self.end - self.start})"
+
+
+class ChapterStore:
+    def __init__(self, novel_path: str, index_path: str = None, rebuild: bool = False):
+        """
+        小说章节索引：一次扫描记录每章的字节偏移、章节号、标题和内容哈希并持久化，
+        之后通过 mmap 按需读取章节正文，不再整本读入内存
+
+        索引文件记录了小说的大小和修改时间，小说变化后会自动重建。
+        标题前的内容(书名、简介等)不算作章节
+
+        Args:
+            novel_path: 小说文件路径，支持 UTF-8 和 GBK/GB18030 编码
+            index_path: 索引文件路径，默认 .cache/chapters/<文件名>.index.json
+            rebuild: 是否强制重建索引
+        """
+        self.novel_path = novel_path
+        self.index_path = index_path or os.path.join(
+            ".cache", "chapters", os.path.basename(novel_path) + ".index.json"
+        )
+        self._file = open(novel_path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        self._source = {
+            "path": os.path.abspath(novel_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+        index = None if rebuild else self._load_index()
+        if index is None:
+            index = self._build_index()
+            self._save_index(index)
+        self.encoding = index["encoding"]
+        self.chapters = [
+            Chapter(self, i, item["number"], item["title"], item["start"], item["end"], item["sha1"])
+            for i, item in enumerate(index["chapters"])
+        ]
+        self._by_number = {}
+        for chapter in self.chapters:
+            # 章节号重复时按号查询返回第一次出现的章节
+            self._by_number.setdefault(chapter.number, chapter)
+
+    @classmethod
+    def open(cls, novel_path: str, **kwargs) -> "ChapterStore":
+        """
+        打开小说并加载(或构建)章节索引，参数同构造函数
+        """
+        return cls(novel_path, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """
+        关闭文件映射
+        """
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get("version") != INDEX_VERSION or index.get("source") != self._source:
+            return None
+        return index
+
+    def _save_index(self, index: dict):
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _build_index(self) -> dict:
+        """
+        扫描整个文件，定位所有章节标题行
+        """
+        encoding = detect_encoding(self.novel_path)
+        codec = "utf-8" if encoding == "utf-8-sig" else encoding
+        pattern = compile_header_pattern(encoding)
+
+        headers = list(pattern.finditer(self._mmap))
+        chapters = []
+        for i, match in enumerate(headers):
+            start = match.end()
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(self._mmap)
+            chapters.append({
+                "number": parse_chapter_number(match.group(1).decode(codec)),
+                "title": match.group(2).decode(codec, errors="replace").strip(),
+                "start": start,
+                "end": end,
+                "sha1": hashlib.sha1(self._mmap[start:end]).hexdigest(),
+            })
+
+        numbers = [chapter["number"] for chapter in chapters]
+        duplicates = len(numbers) - len(set(numbers))
+        disordered = sum(1 for prev, cur in zip(numbers, numbers[1:]) if cur <= prev)
+        print(f"已建立章节索引 {self.index_path}，共 {len(chapters)} 章，编码 {encoding}"
+              + (f"，{disordered} 处章节号不递增，{duplicates} 个重复章节号" if disordered else ""))
+        return {
+            "version": INDEX_VERSION,
+            "source": self._source,
+            "encoding": encoding,
+            "chapters": chapters,
+        }
+
+    def read(self, start: int, end: int) -> str:
+        """
+        解码指定字节范围的文本
+
+        Args:
+            start: 起始字节偏移
+            end: 结束字节偏移(不含)
+
+        Returns:
+            str: 文本
+        """
+        codec = "utf-8" if self.encoding == "utf-8-sig" else self.encoding
+        return self._mmap[start:end].decode(codec, errors="replace")
+
+    def __len__(self) -> int:
+        return len(self.chapters)
+
+    def __iter__(self):
+        return iter(self.chapters)
+
+    def __getitem__(self, item):
+        """
+        按文件中的顺序取章节，支持切片，如 store[start:start + 20]
+
+        Returns:
+            Chapter | list: 章节或章节列表
+        """
+        return self.chapters[item]
+
+    def get(self, number: int) -> Chapter:
+        """
+        按章节号取章节
+
+        Args:
+            number: 章节号
+
+        Returns:
+            Chapter | None: 章节，不存在时返回 None
+        """
+        return self._by_number.get(number)
+
+    def range(self, start: int, stop: int) -> list:
+        """
+        按章节号范围取章节，缺失的章节号会被跳过
+
+        Args:
+            start: 起始章节号(含)
+            stop: 结束章节号(不含)
+
+        Returns:
+            list: Chapter 列表
+        """
+        return [self._by_number[number] for number in range(start, stop) if number in self._by_number]
+
+    def texts(self) -> list:
+        """
+        所有章节的正文
+
+        Returns:
+            list: 章节内容字符串列表
+        """
+        return [chapter.text for chapter in self.chapters]
@@ -0,0 +1,129 @@
+import json
+import os
+import time
+
+
+class Checkpoint:
+    def __init__(self, path: str, fsync_interval: float = 1.0):
+        """
+        追加写入的 JSONL 断点文件，每完成一个工作单元(如某章的摘要)就写入一条记录
+
+        每条记录写入后立即 flush 到操作系统，进程崩溃、Ctrl-C 或 OOM 都不会丢失已完成的结果；
+        fsync 最多每 fsync_interval 秒做一次(关闭时也会做)，避免频繁 fsync 阻塞事件循环。
+        同一个 key 的多条记录以最后一条为准，文件末尾写了一半的记录会被忽略
+
+        Args:
+            path: 断点文件路径
+            fsync_interval: fsync 的最小间隔(秒)，0 表示每条记录都 fsync
+        """
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.records = {}
+        self._last_fsync = time.monotonic()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._load()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的行
+                    continue
+                self.records[record["key"]] = record
+        if self.records:
+            print(f"从断点 {self.path} 恢复了 {len(self.records)} 条结果")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.records
+
+    def get(self, key: str, fingerprint: dict = None):
+        """
+        取出已完成的结果
+
+        Args:
+            key: 工作单元标识，如 summary:12
+            fingerprint: 当前的输入指纹(见 services.planner.make_fingerprint)，与记录中的不一致时视为没有结果
+
+        Returns:
+            dict | None: 记录 {key, fingerprint, result, created_at}，没有时返回 None
+        """
+        record = self.records.get(key)
+        if record is None:
+            return None
+        if fingerprint is not None and record.get("fingerprint") != fingerprint:
+            return None
+        return record
+
+    def put(self, key: str, result, fingerprint: dict = None):
+        """
+        写入一个已完成的结果
+
+        Args:
+            key: 工作单元标识
+            result: 可 JSON 序列化的结果
+            fingerprint: 生成该结果的输入指纹
+        """
+        record = {"key": key, "fingerprint": fingerprint, "result": result, "created_at": time.time()}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.records[key] = record
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+
+    def clear(self):
+        """
+        清空断点(用于强制重新生成)
+        """
+        self._file.close()
+        self._file = open(self.path, "w", encoding="utf-8")
+        self.records = {}
+
+    def compact(self, keys):
+        """
+        只保留指定 key 的记录并重写断点文件，用于清理已不再需要的结果(如被删除或修改过的提问角度)
+
+        Args:
+            keys: 需要保留的 key
+        """
+        keys = set(keys)
+        self._file.close()
+        self.records = {key: record for key, record in self.records.items() if key in keys}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        """
+        fsync 并关闭文件
+        """
+        if self._file.closed:
+            return
+        self._file.flush()
+        self._fsync()
+        self._file.close()
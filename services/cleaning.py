@@ -0,0 +1,157 @@
+import json
+import random
+from collections import Counter
+
+from services.convert import iter_records, open_writer
+from services.parallel import map_chunks
+
+# gpt 在开头时补上的 human 消息
+RANDOM_HUMAN = ["火旺", "说话", "你还好吧", "醒醒", "李火旺！！"]
+
+# 统计项的说明，用于打印
+CLEAN_REASONS = {
+    "empty": "对话为空",
+    "human_only": "只剩 human",
+    "invalid": "结构不合格",
+    "error": "处理出错",
+}
+
+
+def clean_conversation(item: dict, rng: random.Random):
+    """
+    清理一段对话：合并连续相同 from 的消息，去掉空的 human，空的 gpt 换成 1 ~ 10 个「艹」，
+    以 gpt 开头时补一条 human，去掉结尾的 human
+
+    Args:
+        item: {"conversations": [...], "capter": ...}
+        rng: 随机数生成器
+
+    Returns:
+        tuple: (清理后的记录, None) 或 (None, 跳过原因)，原因见 CLEAN_REASONS
+    """
+    # 合并连续相同from的内容
+    merged_conversations = []
+    prev_from = None
+    for conv in item["conversations"]:
+        if conv["from"] == prev_from:
+            merged_conversations[-1]["value"] += " " + conv["value"]
+        else:
+            merged_conversations.append(dict(conv))
+        prev_from = conv["from"]
+
+    # 过滤空值并处理
+    filtered_conversations = []
+    for conv in merged_conversations:
+        if conv["from"] == "human" and not conv["value"].strip():
+            continue
+        if conv["from"] == "gpt" and not conv["value"].strip():
+            conv["value"] = "艹" * rng.randint(1, 10)
+        filtered_conversations.append(conv)
+
+    # 处理开头和结尾
+    if filtered_conversations and filtered_conversations[0]["from"] == "gpt":
+        filtered_conversations.insert(0, {
+            "from": "human",
+            "value": rng.choice(RANDOM_HUMAN)
+        })
+
+    # 如果结尾是human，移除最后一条human
+    if filtered_conversations and filtered_conversations[-1]["from"] == "human":
+        filtered_conversations.pop()
+
+    # 检查对话有效性
+    if not filtered_conversations:
+        return None, "empty"
+
+    # 如果移除后只剩下human，跳过这段对话
+    if all(conv["from"] == "human" for conv in filtered_conversations):
+        return None, "human_only"
+
+    if (len(filtered_conversations) < 2 or
+            filtered_conversations[0]["from"] != "human" or
+            filtered_conversations[1]["from"] != "gpt" or
+            filtered_conversations[-1]["from"] != "gpt"):
+        return None, "invalid"
+
+    return {
+        "conversations": filtered_conversations,
+        "capter": item["capter"]
+    }, None
+
+
+class CleanReport:
+    def __init__(self):
+        """清理的统计：输入、保留和各跳过原因的条数，每种原因保留第一个示例"""
+        self.counts = Counter()
+        self.examples = {}
+
+    def update(self, other: "CleanReport"):
+        """合并另一块的统计，示例保留先出现的"""
+        self.counts.update(other.counts)
+        for reason, example in other.examples.items():
+            self.examples.setdefault(reason, example)
+
+    def skip(self, reason: str, item):
+        self.counts[reason] += 1
+        self.examples.setdefault(reason, item)
+
+    def summary(self) -> str:
+        """
+        如 `[clean] 输入 1200 条，保留 1100 条，只剩 human 80 条，结构不合格 20 条`
+        """
+        skipped = "".join(
+            f"，{label} {self.counts[reason]} 条" for reason, label in CLEAN_REASONS.items() if self.counts[reason]
+        )
+        return f"[clean] 输入 {self.counts['input']} 条，保留 {self.counts['kept']} 条{skipped}"
+
+
+def clean_chunk(chunk: list, chunk_index: int, seed: int = 0):
+    """
+    清理一块对话，由 map_chunks 在子进程中调用；随机数按 (seed, chunk_index) 生成，结果与进程数无关
+
+    Returns:
+        tuple: (清理后的记录列表, CleanReport)
+    """
+    rng = random.Random(f"{seed}:{chunk_index}")
+    cleaned = []
+    report = CleanReport()
+    report.counts["input"] = len(chunk)
+    for item in chunk:
+        try:
+            result, reason = clean_conversation(item, rng)
+        except Exception as e:
+            report.skip("error", {"error": str(e), "item": item})
+            continue
+        if result is None:
+            report.skip(reason, item)
+            continue
+        cleaned.append(result)
+    report.counts["kept"] = len(cleaned)
+    return cleaned, report
+
+
+def clean_file(input_path: str, output_path: str, workers: int = None, chunk_size: int = 500,
+               seed: int = 0) -> CleanReport:
+    """
+    流式清理对话数据集，按块分给多个进程处理，输出顺序与输入一致，打印汇总和每种跳过原因的一个示例
+
+    Args:
+        input_path: 原始对话数据(sharegpt，含 capter)
+        output_path: 输出路径
+        workers: 进程数，为 None 时见 services/parallel.py 的 default_workers
+        chunk_size: 每块的对话数
+        seed: 随机种子，相同的输入和种子输出相同
+
+    Returns:
+        CleanReport: 统计
+    """
+    report = CleanReport()
+    records = map_chunks(clean_chunk, iter_records(input_path), chunk_size=chunk_size, workers=workers,
+                         stats=report, seed=seed)
+    with open_writer(output_path) as writer:
+        writer.write_all(records)
+
+    print(report.summary())
+    for reason, example in report.examples.items():
+        print(f"[clean] {CLEAN_REASONS[reason]}示例: {json.dumps(example, ensure_ascii=False)[:200]}")
+    return report
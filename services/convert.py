@@ -0,0 +1,521 @@
+import json
+import os
+import random
+import re
+from json.encoder import encode_basestring
+
+# 数组元素之间的空白和逗号
+_SEPARATOR = re.compile(r"[\s,]*")
+_WHITESPACE = re.compile(r"\s*")
+
+# 章节摘要转 sharegpt 时的问题模板
+SUMMARY_QUESTION_TEMPLATES = [
+    "《道诡异仙》第{chapter}章主要讲了什么内容",
+    "《道诡异仙》第{chapter}章主要内容是什么",
+    "《道诡异仙》第{chapter}章主要写了啥",
+    "《道诡异仙》第{chapter}章讲了什么",
+    "《道诡异仙》第{chapter}章主要是什么剧情",
+    "《道诡异仙》第{chapter}章剧情是什么",
+    "《道诡异仙》第{chapter}章内容是什么",
+    "《道诡异仙》第{chapter}章他们做了什么事",
+    "《道诡异仙》第{chapter}章他们干了什么事"
+]
+
+
+def detect_file_type(path: str) -> str:
+    """
+    按扩展名判断文件类型
+
+    Args:
+        path: 文件路径
+
+    Returns:
+        str: json / jsonl / parquet / arrow
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".parquet":
+        return "parquet"
+    if extension in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+    return "json"
+
+
+def iter_json_array(path: str, chunk_size: int = 1 << 20):
+    """
+    增量读取 JSON 数组文件(如 json.dump(indent=2) 的输出)，每次只解析一个元素，内存占用与文件大小无关
+
+    Args:
+        path: JSON 文件路径，顶层必须是数组
+        chunk_size: 每次读取的字符数，单个元素超过时自动加大
+
+    Yields:
+        数组中的元素
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size)
+        eof = len(buffer) < chunk_size
+        buffer = buffer.lstrip("﻿")
+        position = _WHITESPACE.match(buffer).end()
+        if position >= len(buffer) or buffer[position] != "[":
+            raise ValueError(f"{path} 的顶层不是 JSON 数组")
+        position += 1
+
+        while True:
+            position = _SEPARATOR.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError("数据不完整", buffer, position)
+                item, end = decoder.raw_decode(buffer, position)
+                # 元素后面必须是逗号或 ]，否则是被截断的数字(如 "2." 会被解析为 2)，读到更多内容再解析
+                following = _WHITESPACE.match(buffer, end).end()
+                if following == len(buffer) and not eof or following < len(buffer) and buffer[following] not in ",]":
+                    raise json.JSONDecodeError("数据不完整", buffer, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # 丢掉已解析的部分，按当前缓冲区大小加倍读取，超大元素也只需重试对数次
+                buffer = buffer[position:]
+                more = f.read(max(chunk_size, len(buffer)))
+                eof = not more
+                buffer += more
+                position = 0
+                continue
+            yield item
+            position = end
+
+
+def iter_jsonl(path: str):
+    """
+    逐行读取 JSONL 文件，跳过空行
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_records(path: str, columns: list = None, batch_size: int = 1024):
+    """
+    按文件类型流式读取记录
+
+    Args:
+        path: json / jsonl / parquet / arrow 文件
+        columns: 只读取这些字段(列投影)，Parquet 和 Arrow 只解码这些列
+        batch_size: Parquet 每次读取的行数
+
+    Yields:
+        dict: 记录
+    """
+    file_type = detect_file_type(path)
+    if file_type in ("parquet", "arrow"):
+        pa, pq, ipc = _import_pyarrow()
+        if file_type == "parquet":
+            batches = pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+            for batch in batches:
+                yield from batch.to_pylist()
+            return
+        # Arrow IPC 文件通过内存映射读取，不复制到内存
+        with pa.memory_map(path, "r") as source:
+            reader = ipc.open_file(source)
+            for index in range(reader.num_record_batches):
+                batch = reader.get_batch(index)
+                if columns:
+                    batch = batch.select(columns)
+                yield from batch.to_pylist()
+        return
+
+    records = iter_jsonl(path) if file_type == "jsonl" else iter_json_array(path)
+    yield from project(records, columns) if columns else records
+
+
+def project(records, columns: list):
+    """
+    只保留指定字段，记录中没有的字段为 None
+    """
+    for record in records:
+        yield {column: record.get(column) for column in columns}
+
+
+def _encode_indented(value, indent: str) -> str:
+    """
+    与 json.dumps(value, ensure_ascii=False, indent=2) 输出相同；字符串用 C 实现编码，
+    最常见的字符串、整数字段直接拼接不再递归，比标准库带缩进时的纯 Python 编码器快一倍
+    """
+    kind = type(value)
+    if kind is str:
+        return encode_basestring(value)
+    if kind is dict:
+        if not value:
+            return "{}"
+        inner = indent + "  "
+        parts = []
+        for key, item in value.items():
+            # 与 json.dumps 一样把非字符串的键转为 JSON 字面量，如 True -> "true"
+            key = encode_basestring(key if type(key) is str else json.dumps(key).strip('"'))
+            item_kind = type(item)
+            if item_kind is str:
+                parts.append(f"{inner}{key}: {encode_basestring(item)}")
+            elif item_kind is int:
+                parts.append(f"{inner}{key}: {int.__repr__(item)}")
+            else:
+                parts.append(f"{inner}{key}: {_encode_indented(item, inner)}")
+        return "{\n" + ",\n".join(parts) + "\n" + indent + "}"
+    if kind is list or kind is tuple:
+        if not value:
+            return "[]"
+        inner = indent + "  "
+        items = [encode_basestring(item) if type(item) is str else _encode_indented(item, inner) for item in value]
+        return "[\n" + inner + (",\n" + inner).join(items) + "\n" + indent + "]"
+    return json.dumps(value, ensure_ascii=False)
+
+
+class _RecordWriter:
+    def __init__(self, path: str):
+        """
+        先写入同目录下的临时文件，close 时再替换目标文件，中断时不会留下不完整的输出
+        """
+        self.path = path
+        self.count = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._tmp_path = f"{path}.tmp"
+
+    def write(self, record: dict):
+        raise NotImplementedError
+
+    def write_all(self, records) -> int:
+        """
+        写入所有记录
+
+        Returns:
+            int: 写入的记录数
+        """
+        for record in records:
+            self.write(record)
+        return self.count
+
+    def _finish(self):
+        raise NotImplementedError
+
+    def close(self):
+        self._finish()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        放弃写入，删除临时文件，保留原有的目标文件
+        """
+        self._finish()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JsonArrayWriter(_RecordWriter):
+    def __init__(self, path: str, indent: int = 2):
+        """
+        增量写入 JSON 数组
+
+        Args:
+            path: 输出路径
+            indent: 2 时与 json.dump(data, ensure_ascii=False, indent=2) 逐字节相同；None 时每条记录一行，写得更快
+        """
+        super().__init__(path)
+        if indent not in (2, None):
+            raise ValueError("indent 只支持 2 或 None")
+        self.indent = indent
+        self._file = open(self._tmp_path, "w", encoding="utf-8")
+
+    def write(self, record: dict):
+        self._file.write("[\n" if not self.count else ",\n")
+        if self.indent:
+            self._file.write("  " + _encode_indented(record, "  "))
+        else:
+            self._file.write(json.dumps(record, ensure_ascii=False))
+        self.count += 1
+
+    def _finish(self):
+        if self._file.closed:
+            return
+        self._file.write("\n]" if self.count else "[]")
+        self._file.close()
+
+
+class JsonlWriter(_RecordWriter):
+    def __init__(self, path: str):
+        """
+        逐行写入 JSONL
+        """
+        super().__init__(path)
+        self._file = open(self._tmp_path, "w", encoding="utf-8")
+
+    def write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def _finish(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class ArrowWriter(_RecordWriter):
+    def __init__(self, path: str, file_type: str = "parquet", batch_size: int = 1000, compression: str = "zstd"):
+        """
+        按批写入 Parquet 或 Arrow IPC 文件，内存中最多缓存 batch_size 条记录；
+        Arrow IPC 文件可以用 pyarrow.memory_map 或 datasets 直接内存映射读取
+
+        表结构由第一批记录推断，之后的批次按该结构转换
+
+        Args:
+            path: 输出路径
+            file_type: parquet / arrow
+            batch_size: 每批(Parquet 的 row group)的记录数
+            compression: Parquet 压缩算法
+        """
+        super().__init__(path)
+        self._pa, self._pq, self._ipc = _import_pyarrow()
+        self.file_type = file_type
+        self.batch_size = batch_size
+        self.compression = compression
+        self._rows = []
+        self._writer = None
+        self._schema = None
+        self._finished = False
+
+    def write(self, record: dict):
+        self._rows.append(record)
+        self.count += 1
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        table = self._pa.Table.from_pylist(self._rows, schema=self._schema)
+        if self._writer is None:
+            self._schema = table.schema
+            if self.file_type == "parquet":
+                self._writer = self._pq.ParquetWriter(self._tmp_path, self._schema, compression=self.compression)
+            else:
+                self._writer = self._ipc.new_file(self._tmp_path, self._schema)
+        self._writer.write_table(table)
+        self._rows = []
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._flush()
+        if self._writer is None:
+            # 没有记录时写一个没有列的空文件
+            table = self._pa.table({})
+            if self.file_type == "parquet":
+                self._pq.write_table(table, self._tmp_path)
+            else:
+                with self._ipc.new_file(self._tmp_path, table.schema) as writer:
+                    writer.write_table(table)
+            return
+        self._writer.close()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("读写 Parquet / Arrow 文件需要先安装 pyarrow: pip install pyarrow")
+    return pyarrow, pyarrow.parquet, pyarrow.ipc
+
+
+def open_writer(path: str, indent: int = 2, batch_size: int = 1000) -> _RecordWriter:
+    """
+    按扩展名创建写入器(.json / .jsonl / .parquet / .arrow)，用法：
+
+        with open_writer("datasets/x.parquet") as writer:
+            writer.write_all(records)
+
+    Args:
+        path: 输出路径
+        indent: JSON 数组的缩进，见 JsonArrayWriter
+        batch_size: Parquet / Arrow 每批的记录数
+    """
+    file_type = detect_file_type(path)
+    if file_type == "jsonl":
+        return JsonlWriter(path)
+    if file_type in ("parquet", "arrow"):
+        return ArrowWriter(path, file_type, batch_size=batch_size)
+    return JsonArrayWriter(path, indent=indent)
+
+
+def sharegpt_to_alpaca(records, instruct: str):
+    """
+    sharegpt 转 alpaca：取第一轮 human/gpt 作为 input/output，开头不是 human、gpt 的对话跳过
+    """
+    for item in records:
+        conversations = item["conversations"]
+        if len(conversations) < 2:
+            continue
+        if conversations[0]["from"] != "human" or conversations[1]["from"] != "gpt":
+            continue
+        yield {
+            "instruction": instruct,
+            "input": conversations[0]["value"],
+            "output": conversations[1]["value"]
+        }
+
+
+def summary_to_sharegpt(records, question_templates: list = None):
+    """
+    章节摘要转 sharegpt：随机选一个问题模板提问本章讲了什么，回答为摘要
+    """
+    question_templates = question_templates or SUMMARY_QUESTION_TEMPLATES
+    for item in records:
+        # 优先使用标题中的真实章节号，旧数据没有时按位置+1
+        chapter = item.get("chapter_number", item["chapter"] + 1)
+        question = random.choice(question_templates).format(chapter=chapter)
+        yield {
+            "conversations": [
+                {"from": "human", "value": question},
+                {"from": "gpt", "value": item["summary"]}
+            ],
+            "chapter": item["chapter"],
+            "chapter_number": chapter
+        }
+
+
+def sharegpt_to_messages(records, system: str = None):
+    """
+    sharegpt 转 OpenAI 微调的 messages 格式 {"messages": [{"role", "content"}, ...]}
+    """
+    roles = {"human": "user", "gpt": "assistant", "system": "system"}
+    for item in records:
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.extend({"role": roles[conv["from"]], "content": conv["value"]} for conv in item["conversations"])
+        yield {"messages": messages}
+
+
+def alpaca_to_messages(records):
+    """
+    alpaca 转 messages 格式：instruction 作为 system，input 和 output 为一问一答
+    """
+    for item in records:
+        messages = [{"role": "system", "content": item["instruction"]}] if item.get("instruction") else []
+        messages.append({"role": "user", "content": item["input"]})
+        messages.append({"role": "assistant", "content": item["output"]})
+        yield {"messages": messages}
+
+
+def alpaca_dpo_to_preference(records):
+    """
+    alpaca-DPO(instruction/input/chosen/rejected) 转 OpenAI 偏好微调格式
+    {"input": {"messages": [...]}, "preferred_output": [...], "non_preferred_output": [...]}
+    """
+    for item in records:
+        messages = [{"role": "system", "content": item["instruction"]}] if item.get("instruction") else []
+        messages.append({"role": "user", "content": item["input"]})
+        yield {
+            "input": {"messages": messages},
+            "preferred_output": [{"role": "assistant", "content": item["chosen"]}],
+            "non_preferred_output": [{"role": "assistant", "content": item["rejected"]}],
+        }
+
+
+# (源格式, 目标格式) -> 转换函数，源和目标相同时只转换文件类型
+CONVERSIONS = {
+    ("sharegpt", "alpaca"): sharegpt_to_alpaca,
+    ("summary", "sharegpt"): summary_to_sharegpt,
+    ("sharegpt", "messages"): sharegpt_to_messages,
+    ("alpaca", "messages"): alpaca_to_messages,
+    ("alpaca-dpo", "messages"): alpaca_dpo_to_preference,
+}
+
+
+def detect_format(record: dict) -> str:
+    """
+    按字段推断记录的数据格式
+
+    Returns:
+        str: sharegpt / alpaca / alpaca-dpo / summary / messages
+    """
+    if "conversations" in record:
+        return "sharegpt"
+    if "chosen" in record and "rejected" in record:
+        return "alpaca-dpo"
+    if "messages" in record or "preferred_output" in record:
+        return "messages"
+    if "summary" in record:
+        return "summary"
+    if "output" in record:
+        return "alpaca"
+    raise ValueError(f"无法识别的数据格式，字段为 {', '.join(record)}")
+
+
+def convert_records(records, source: str, target: str, **options):
+    """
+    在数据格式之间转换
+
+    Args:
+        records: 记录的可迭代对象
+        source: 源格式
+        target: 目标格式，与源格式相同时原样返回
+        options: 转换函数的参数，如 sharegpt_to_alpaca 的 instruct
+
+    Returns:
+        转换后的记录生成器
+    """
+    if source == target:
+        return iter(records)
+    converter = CONVERSIONS.get((source, target))
+    if converter is None:
+        supported = ", ".join(f"{a}->{b}" for a, b in CONVERSIONS)
+        raise ValueError(f"不支持从 {source} 转换为 {target}，可选: {supported}")
+    return converter(records, **options)
+
+
+def convert_file(input_path: str, output_path: str, source: str = None, target: str = None, columns: list = None,
+                 indent: int = 2, batch_size: int = 1000, **options) -> int:
+    """
+    流式转换数据集文件：逐条读取、转换并写出，内存中只有当前批次
+
+    Args:
+        input_path: 输入文件(json / jsonl / parquet / arrow)
+        output_path: 输出文件，类型由扩展名决定
+        source: 源格式，为 None 时按第一条记录推断
+        target: 目标格式，为 None 时与源格式相同(只转换文件类型)
+        columns: 只保留这些字段(对转换后的记录)，读取 Parquet / Arrow 且不转换格式时只解码这些列
+        indent: 输出 JSON 数组的缩进
+        batch_size: Parquet / Arrow 每批的记录数
+        options: 转换函数的参数
+
+    Returns:
+        int: 写出的记录数
+    """
+    records = iter_records(input_path, columns=None if target else columns, batch_size=batch_size)
+    if target:
+        first = next(records, None)
+        if first is not None:
+            records = convert_records(_prepend(first, records), source or detect_format(first), target, **options)
+        if columns:
+            records = project(records, columns)
+
+    with open_writer(output_path, indent=indent, batch_size=batch_size) as writer:
+        return writer.write_all(records)
+
+
+def _prepend(first, records):
+    yield first
+    yield from records
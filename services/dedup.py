@@ -0,0 +1,328 @@
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+# 归一化时去掉的字符：空白、标点和符号，只保留汉字、字母和数字
+_STRIP_PATTERN = re.compile(r"[\W_]+")
+
+# 致密化空桶时每次处理的签名行数，限制临时矩阵的内存
+_DENSIFY_ROWS = 1 << 14
+
+def normalize_text(text: str) -> str:
+    """
+    去掉空白和标点并转为小写，「李火旺为什么……」和「李火旺 为什么？」视为相同
+
+    Args:
+        text: 文本
+
+    Returns:
+        str: 归一化后的文本
+    """
+    return _STRIP_PATTERN.sub("", text).lower()
+
+
+def conversation_text(item: dict, roles=("human", "gpt")) -> str:
+    """
+    ShareGPT 格式数据中用于查重的文本
+
+    Args:
+        item: {"conversations": [{"from", "value"}, ...]}
+        roles: 参与查重的角色，如只比较问题时为 ("human",)
+
+    Returns:
+        str: 各条消息拼接后的文本
+    """
+    return "\n".join(conv["value"] for conv in item["conversations"] if conv["from"] in roles)
+
+
+def optimal_bands(num_perm: int, threshold: float) -> tuple:
+    """
+    选择 LSH 的分段方式：b 段、每段 r 行(b*r=num_perm)，使候选概率曲线的拐点 (1/b)^(1/r) 最接近阈值
+
+    Args:
+        num_perm: MinHash 签名长度
+        threshold: 相似度阈值
+
+    Returns:
+        tuple: (bands, rows)
+    """
+    candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(candidates, key=lambda band: abs((1 / band[0]) ** (1 / band[1]) - threshold))
+
+
+def _shingle_hashes(texts: list, ngram: int, seed: int):
+    """
+    把所有文本切分为字符 n-gram 并计算64位哈希，整体向量化计算，不逐个 shingle 调用 Python
+
+    Returns:
+        tuple: (哈希数组, 每个文本的 shingle 数)，归一化后为空的文本 shingle 数为0
+    """
+    # 不足 n 个字的文本整体作为一个 shingle，用 \0 补齐
+    padded = [text.ljust(ngram, "\0") if text else "" for text in texts]
+    lengths = np.fromiter((len(text) for text in padded), dtype=np.int64, count=len(padded))
+    codes = np.frombuffer("".join(padded).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    counts = np.where(lengths > 0, lengths - ngram + 1, 0)
+    if not len(codes):
+        return np.zeros(0, dtype=np.uint64), counts
+
+    # 位置 i 的 n-gram 哈希：从种子开始依次混入 codes[i..i+n-1]，溢出按 2^64 回绕
+    with np.errstate(over="ignore"):
+        hashes = codes[:len(codes) - ngram + 1] ^ np.uint64(seed)
+        for offset in range(1, ngram):
+            hashes *= np.uint64(0x100000001B3)
+            hashes ^= codes[offset:len(codes) - ngram + 1 + offset]
+        # splitmix64 的混合函数，使高低位都均匀分布
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= np.uint64(0xBF58476D1CE4E5B9)
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= np.uint64(0x94D049BB133111EB)
+        hashes ^= hashes >> np.uint64(31)
+
+    # 去掉跨越文本边界的 n-gram：每个文本最后 n-1 个位置
+    ends = np.cumsum(lengths)[lengths > 0]
+    crossing = (ends[:, None] - np.arange(1, ngram)).reshape(-1)
+    valid = np.ones(len(hashes), dtype=bool)
+    valid[crossing[crossing < len(hashes)]] = False
+    return hashes[valid], counts
+
+
+def minhash_signatures(texts: list, num_perm: int = 128, ngram: int = 3, seed: int = 42):
+    """
+    计算文本的 MinHash 签名，签名中相同位置取值相等的比例近似于两个文本 n-gram 集合的 Jaccard 相似度
+
+    使用单次置换哈希(one permutation hashing)：每个 shingle 只哈希一次，按高位分到 num_perm 个桶中，
+    每个桶取最小值，计算量与 shingle 总数成正比而不是再乘以 num_perm；
+    短文本的空桶按旋转致密化(rotation densification)从右侧最近的非空桶借值
+
+    Args:
+        texts: 归一化后的文本列表
+        num_perm: 签名长度(桶数)
+        ngram: 字符 n-gram 的 n，中文按字切分
+        seed: 哈希种子，相同种子的签名才可以比较
+
+    Returns:
+        tuple: (签名矩阵 uint32[文本数, num_perm], 是否有 shingle 的布尔数组)
+    """
+    empty = np.iinfo(np.uint32).max
+    hashes, counts = _shingle_hashes(texts, ngram, seed)
+    present = counts > 0
+    signatures = np.full((len(texts), num_perm), empty, dtype=np.uint32)
+    if not len(hashes):
+        return signatures, present
+
+    # 高32位决定桶，低32位作为取值
+    slots = ((hashes >> np.uint64(32)) * np.uint64(num_perm) >> np.uint64(32)).astype(np.int64)
+    slots += np.repeat(np.arange(len(texts), dtype=np.int64) * num_perm, counts)
+    np.minimum.at(signatures.reshape(-1), slots, hashes.astype(np.uint32))
+
+    # 空桶取右侧(循环)最近的非空桶的值，加上与距离相关的偏移，使不同位置借到的值不同；分块处理限制临时矩阵的内存
+    sparse = np.flatnonzero(present & (signatures == empty).any(axis=1))
+    columns = np.arange(2 * num_perm, dtype=np.int32)
+    for start in range(0, len(sparse), _DENSIFY_ROWS):
+        rows = sparse[start:start + _DENSIFY_ROWS]
+        block = signatures[rows]
+        filled = np.where(np.tile(block != empty, 2), columns, 2 * num_perm)
+        nearest = np.minimum.accumulate(filled[:, ::-1], axis=1)[:, ::-1][:, :num_perm]
+        distance = (nearest - columns[:num_perm]).astype(np.uint32)
+        borrowed = np.take_along_axis(block, nearest % num_perm, axis=1)
+        with np.errstate(over="ignore"):
+            signatures[rows] = np.where(block == empty, borrowed + distance * np.uint32(0x9E3779B1), block)
+    return signatures, present
+
+
+def candidate_pairs(signatures, present, bands: int, rows: int):
+    """
+    LSH 分段：签名按段哈希到桶中，任一段落入同一个桶的文本成为候选对，复杂度与文本数近似线性
+
+    同一个桶中的文本都只和桶中第一个文本组成候选对，避免大桶产生平方级的候选
+
+    Returns:
+        ndarray: int64[候选对数, 2]，每行 (较小序号, 较大序号)，已去重
+    """
+    doc_ids = np.flatnonzero(present)
+    if len(doc_ids) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    multipliers = np.random.default_rng(0).integers(1, 2 ** 63, size=rows, dtype=np.uint64) | np.uint64(1)
+
+    pairs = []
+    for band in range(bands):
+        block = signatures[doc_ids, band * rows:(band + 1) * rows].astype(np.uint64)
+        with np.errstate(over="ignore"):
+            keys = (block * multipliers).sum(axis=1) + np.uint64(band)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        # 每个桶的起点，以及每个元素所在桶的第一个元素
+        is_head = np.empty(len(order), dtype=bool)
+        is_head[0] = True
+        is_head[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        heads = order[np.maximum.accumulate(np.where(is_head, np.arange(len(order)), 0))]
+        members = ~is_head
+        if members.any():
+            pairs.append(np.stack([doc_ids[heads[members]], doc_ids[order[members]]], axis=1))
+
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def _find(parents: list, index: int) -> int:
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+
+def cluster_pairs(count: int, pairs) -> list:
+    """
+    用并查集把相似对合并为重复簇
+
+    Args:
+        count: 文本数
+        pairs: 相似对 [(i, j), ...]
+
+    Returns:
+        list: 重复簇列表，每个簇是按序号升序排列的文本序号列表(至少2个)，簇按第一个序号排序
+    """
+    parents = list(range(count))
+    for i, j in pairs:
+        root_i, root_j = _find(parents, int(i)), _find(parents, int(j))
+        if root_i != root_j:
+            # 序号小的作为根，簇中保留的总是最先出现的条目
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = {}
+    for index in range(count):
+        root = _find(parents, index)
+        if root != index:
+            clusters.setdefault(root, [root]).append(index)
+    return sorted(clusters.values(), key=lambda members: members[0])
+
+
+def find_near_duplicates(texts: list, threshold: float = 0.7, num_perm: int = 128, ngram: int = 3,
+                         seed: int = 42) -> tuple:
+    """
+    找出近似重复的文本：MinHash + LSH 找候选对，再用签名估计的相似度过滤掉低于阈值的候选
+
+    Args:
+        texts: 文本列表(未归一化)
+        threshold: Jaccard 相似度阈值
+        num_perm: MinHash 签名长度
+        ngram: 字符 n-gram 的 n
+        seed: 随机种子
+
+    Returns:
+        tuple: (重复簇列表, 候选对数, 相似对数)
+    """
+    signatures, present = minhash_signatures([normalize_text(text) for text in texts], num_perm, ngram, seed)
+    bands, rows = optimal_bands(num_perm, threshold)
+    candidates = candidate_pairs(signatures, present, bands, rows)
+    if len(candidates):
+        similarity = (signatures[candidates[:, 0]] == signatures[candidates[:, 1]]).mean(axis=1)
+        similar = candidates[similarity >= threshold]
+    else:
+        similar = candidates
+    return cluster_pairs(len(texts), similar), len(candidates), len(similar)
+
+
+def dedup_records(records: list, text_of=conversation_text, group_of=None, threshold: float = 0.7,
+                  num_perm: int = 128, ngram: int = 3, seed: int = 42, examples: int = 20) -> tuple:
+    """
+    近似去重：每个重复簇只保留最先出现的一条，其余按原顺序移除
+
+    Args:
+        records: 数据列表
+        text_of: 取查重文本的函数，默认拼接 ShareGPT 对话的全部消息
+        group_of: 取分组(如章节)的函数，报告中按组内/跨组统计重复
+        threshold: Jaccard 相似度阈值
+        num_perm: MinHash 签名长度
+        ngram: 字符 n-gram 的 n
+        seed: 随机种子
+        examples: 报告中附带的重复簇示例数(按簇大小降序，每个簇最多列出3条被移除的文本)
+
+    Returns:
+        tuple: (去重后的数据列表, 报告)
+    """
+    started_at = time.monotonic()
+    texts = [text_of(record) for record in records]
+    clusters, candidate_count, similar_count = find_near_duplicates(texts, threshold, num_perm, ngram, seed)
+
+    removed = set()
+    same_group = 0
+    cross_group = 0
+    for members in clusters:
+        removed.update(members[1:])
+        if group_of is not None:
+            groups = {group_of(records[index]) for index in members}
+            if len(groups) == 1:
+                same_group += 1
+            else:
+                cross_group += 1
+    kept = [record for index, record in enumerate(records) if index not in removed]
+
+    report = {
+        "total": len(records),
+        "kept": len(kept),
+        "removed": len(removed),
+        "clusters": len(clusters),
+        "largest_cluster": max((len(members) for members in clusters), default=0),
+        "candidate_pairs": candidate_count,
+        "similar_pairs": similar_count,
+        "params": {
+            "threshold": threshold,
+            "num_perm": num_perm,
+            "bands": optimal_bands(num_perm, threshold)[0],
+            "ngram": ngram,
+            "seed": seed,
+        },
+        "seconds": round(time.monotonic() - started_at, 3),
+        "examples": [
+            {
+                "size": len(members),
+                "kept": texts[members[0]],
+                "removed": [texts[index] for index in members[1:4]],
+                **({"groups": sorted({group_of(records[index]) for index in members})} if group_of else {}),
+            }
+            for members in sorted(clusters, key=len, reverse=True)[:examples]
+        ],
+    }
+    if group_of is not None:
+        report["same_group_clusters"] = same_group
+        report["cross_group_clusters"] = cross_group
+    return kept, report
+
+
+def dedup_file(input_path: str, output_path: str, report_path: str, **kwargs) -> dict:
+    """
+    对 JSON 数据集文件去重并写出去重报告，参数同 dedup_records
+
+    Args:
+        input_path: 输入 JSON 文件(列表)
+        output_path: 去重后的 JSON 文件
+        report_path: 去重报告 JSON 文件
+
+    Returns:
+        dict: 报告
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        records = json.load(f)
+
+    kept, report = dedup_records(records, **kwargs)
+    report = {"input": input_path, "output": output_path, **report}
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(kept, f, ensure_ascii=False, indent=2)
+    if os.path.dirname(report_path):
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    line = (f"[dedup] {input_path}: 共 {report['total']} 条，保留 {report['kept']} 条，"
+            f"移除 {report['removed']} 条({report['clusters']} 个重复簇")
+    if "same_group_clusters" in report:
+        line += f"，组内 {report['same_group_clusters']}，跨组 {report['cross_group_clusters']}"
+    print(line + f")，耗时 {report['seconds']}s")
+    return report
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import time
+
+from services.limiter import AdaptiveLimiter, RateLimiter
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        熔断器：连续失败达到阈值后熔断，reset_timeout 秒后放行一个探测请求，探测成功则恢复
+
+        Args:
+            failure_threshold: 触发熔断的连续失败次数
+            reset_timeout: 熔断后多久允许探测(秒)
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_id = 0
+
+    def available(self) -> bool:
+        """
+        当前是否可以向该端点派发请求(不改变状态)
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at >= self.reset_timeout
+        return not self._probing
+
+    def retry_in(self) -> float:
+        """
+        熔断状态下距离允许探测还有多少秒，其他状态返回0
+        """
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def on_dispatch(self):
+        """
+        派发请求前调用，熔断到期时转为半开状态并占用唯一的探测名额
+
+        Returns:
+            int | None: 占用了探测名额时返回本次探测的编号，由该请求在归还名额时传给 on_release，否则为 None
+        """
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            self._probe_id += 1
+            return self._probe_id
+        return None
+
+    def on_release(self, probe: int = None):
+        """
+        请求结束、归还名额时调用：占用探测名额的请求被取消或抛出意外异常、没有记录成功或失败时，
+        释放探测名额并退回熔断状态(熔断时间不变，已经到期，下一个请求可以立即探测)，
+        否则半开的端点再也不会被选中；其他请求归还名额不影响正在进行的探测
+
+        Args:
+            probe: on_dispatch 返回的探测编号
+        """
+        if probe is not None and probe == self._probe_id and self._probing:
+            self._probing = False
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self):
+        """
+        记录一次成功，关闭熔断
+        """
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probing = False
+
+    def record_failure(self, trip: bool = False):
+        """
+        记录一次失败
+
+        Args:
+            trip: 为True时直接熔断(如鉴权失败)
+        """
+        self._failures += 1
+        self._probing = False
+        if trip or self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                print(f"端点连续失败 {self._failures} 次，熔断 {self.reset_timeout} 秒")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class Endpoint:
+    def __init__(self, url: str, key: str, model: str = None, weight: float = 1.0, max_concurrency: int = 50,
+                 rpm: int = None, tpm: int = None, limiter: AdaptiveLimiter = None, rate_limiter: RateLimiter = None,
+                 breaker: CircuitBreaker = None, name: str = None):
+        """
+        一个 OpenAI 兼容的服务端点(一个 base url + 一个 key)
+
+        Args:
+            url: API 地址，如 https://api.deepseek.com
+            key: API 密钥
+            model: 可选，覆盖请求中的模型名称(如本地 vLLM 的模型名)
+            weight: 权重，越大分到的请求越多
+            max_concurrency: 并发上限，自适应限制器不会超过该值
+            rpm: 每分钟请求数上限
+            tpm: 每分钟 token 数上限
+            limiter: 可选的自适应并发限制器，默认初始并发为 min(50, max_concurrency)
+            rate_limiter: 可选的 RPM/TPM 限速器，默认按 rpm/tpm 创建
+            breaker: 可选的熔断器
+            name: 日志中显示的名称，默认为 url
+        """
+        self.url = url
+        self.key = key
+        self.model = model
+        self.weight = weight
+        self.name = name or url
+        self.limiter = limiter or AdaptiveLimiter(initial=min(50, max_concurrency), max_limit=max_concurrency)
+        self.rate_limiter = rate_limiter or (RateLimiter(rpm, tpm) if rpm or tpm else None)
+        self.breaker = breaker or CircuitBreaker()
+        self.assigned = 0
+        self.latency = None
+
+    @classmethod
+    def from_dict(cls, config: dict) -> "Endpoint":
+        """
+        从配置字典创建端点，字段与构造函数参数同名
+        """
+        return cls(**config)
+
+    def score(self) -> float:
+        """
+        负载得分，越小越优先：按权重折算的排队数乘以平均延迟
+        """
+        return (self.assigned + 1) / self.weight * (self.latency or 1.0)
+
+    def record_latency(self, latency: float):
+        """
+        记录一次成功请求的延迟(指数加权平均)
+        """
+        self.latency = latency if self.latency is None else 0.2 * latency + 0.8 * self.latency
+
+
+class EndpointPool:
+    def __init__(self, endpoints: list):
+        """
+        端点池，把请求分配给健康端点中负载得分最低的一个
+
+        Args:
+            endpoints: Endpoint 列表
+        """
+        if not endpoints:
+            raise ValueError("endpoints 不能为空")
+        self.endpoints = endpoints
+        self._condition = None
+
+    @property
+    def concurrency_limit(self) -> int:
+        """所有端点当前并发上限之和"""
+        return sum(endpoint.limiter.limit for endpoint in self.endpoints)
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _pick(self):
+        candidates = [
+            endpoint for endpoint in self.endpoints
+            if endpoint.breaker.available() and endpoint.assigned < endpoint.limiter.limit
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda endpoint: endpoint.score())
+
+    async def acquire(self) -> tuple:
+        """
+        选出一个端点并占用其名额，没有可用端点时等待
+
+        Returns:
+            tuple: (选中的端点, 探测编号)，探测编号见 CircuitBreaker.on_dispatch，用完后必须连同探测编号调用 release
+        """
+        condition = self._get_condition()
+        while True:
+            endpoint = self._pick()
+            if endpoint is not None:
+                endpoint.assigned += 1
+                return endpoint, endpoint.breaker.on_dispatch()
+
+            # 所有端点都满载或熔断：等待有名额释放，或最早的熔断到期
+            retry_in = [e.breaker.retry_in() for e in self.endpoints if e.breaker.state == CircuitBreaker.OPEN]
+            # 熔断已到期(0 秒)但端点满载时也要限时等待，0 不能当作不限时；下限避免空转
+            timeout = max(min(retry_in), 0.05) if retry_in else None
+            async with condition:
+                try:
+                    await asyncio.wait_for(condition.wait(), timeout=timeout if timeout is not None else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, endpoint: Endpoint, probe: int = None):
+        """
+        归还端点名额并唤醒等待者，请求无论成功、失败还是被取消都必须调用
+
+        Args:
+            endpoint: acquire 返回的端点
+            probe: acquire 返回的探测编号
+        """
+        endpoint.assigned -= 1
+        endpoint.breaker.on_release(probe)
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
+
+
+def parse_endpoints(value: str) -> list:
+    """
+    从 JSON 字符串解析端点列表，例如 OPENAI_ENDPOINTS 环境变量
+
+    示例：[{"url": "https://api.deepseek.com", "key": "sk-xxx", "weight": 2},
+          {"url": "http://127.0.0.1:8000", "key": "local", "model": "qwen2.5-7b", "max_concurrency": 16}]
+
+    Args:
+        value: JSON 字符串，为空时返回 None
+
+    Returns:
+        list | None: Endpoint 列表
+    """
+    if not value:
+        return None
+    return [Endpoint.from_dict(config) for config in json.loads(value)]
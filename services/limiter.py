@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: int = 50, min_limit: int = 1, max_limit: int = 200, increase: int = 1,
+                 decrease: float = 0.5, latency_threshold: float = 2.0, cooldown: float = 5.0):
+        """
+        AIMD 自适应并发限制器
+
+        每完成约 limit 个健康请求(一个"轮次")并发上限加 increase；
+        遇到 429/5xx/超时等过载信号时并发上限乘以 decrease，cooldown 秒内只下调一次，
+        避免同一波失败被重复惩罚
+
+        Args:
+            initial: 初始并发上限
+            min_limit: 并发上限的下界
+            max_limit: 并发上限的上界
+            increase: 每轮加性增长的步长
+            decrease: 过载时的乘性下调系数
+            latency_threshold: 短期平均延迟超过长期平均延迟的多少倍时视为变慢，不再增长
+            cooldown: 两次下调之间的最短间隔(秒)
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.cooldown = cooldown
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self._inflight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._short_latency = None
+        self._long_latency = None
+        self._condition = None
+
+    @property
+    def limit(self) -> int:
+        """当前并发上限"""
+        return int(self._limit)
+
+    @property
+    def inflight(self) -> int:
+        """当前正在执行的请求数"""
+        return self._inflight
+
+    def _get_condition(self) -> asyncio.Condition:
+        # 惰性创建，保证绑定到实际运行的事件循环
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        """
+        等待直到有空闲的并发名额
+        """
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._inflight < self.limit)
+            self._inflight += 1
+
+    async def release(self):
+        """
+        归还并发名额
+        """
+        condition = self._get_condition()
+        async with condition:
+            self._inflight -= 1
+            condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def on_success(self, latency: float):
+        """
+        记录一次健康的响应，延迟稳定时加性增长并发上限
+
+        Args:
+            latency: 本次请求耗时(秒)
+        """
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+        else:
+            self._short_latency = 0.3 * latency + 0.7 * self._short_latency
+            self._long_latency = 0.02 * latency + 0.98 * self._long_latency
+
+        self._successes += 1
+        if self._successes < self.limit:
+            return
+        self._successes = 0
+
+        if self._short_latency > self._long_latency * self.latency_threshold:
+            return
+        self._limit = min(self.max_limit, self._limit + self.increase)
+
+    def on_overload(self):
+        """
+        记录一次过载信号(429/5xx/超时)，乘性下调并发上限
+        """
+        now = time.monotonic()
+        self._successes = 0
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        print(f"检测到服务过载，并发上限下调至 {self.limit}")
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        """
+        令牌桶
+
+        Args:
+            capacity: 桶容量
+            refill_per_second: 每秒补充的令牌数
+        """
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = None
+
+    @property
+    def level(self) -> float:
+        """当前令牌数，预扣超出时可能为负数"""
+        self._refill()
+        return self._level
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    async def take(self, amount: float):
+        """
+        取出令牌，不足时等待补充；等待按先来后到排队
+
+        Args:
+            amount: 令牌数，超过桶容量时按容量计算，避免永远等不到
+        """
+        amount = min(amount, self.capacity)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                await asyncio.sleep((amount - self._level) / self.refill_per_second)
+
+    def adjust(self, delta: float):
+        """
+        直接增减令牌，用于按实际用量结算预扣
+
+        Args:
+            delta: 正数为退还，负数为补扣
+        """
+        self._refill()
+        self._level = min(self.capacity, self._level + delta)
+
+
+class RateLimiter:
+    def __init__(self, rpm: int = None, tpm: int = None):
+        """
+        客户端 RPM/TPM 限速器，发送前按估算值预扣，拿到响应后按 usage 结算
+
+        Args:
+            rpm: 每分钟请求数上限，None 表示不限制
+            tpm: 每分钟 token 数上限，None 表示不限制
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = TokenBucket(rpm, rpm / 60) if rpm else None
+        self._tokens = TokenBucket(tpm, tpm / 60) if tpm else None
+
+    async def reserve(self, tokens: int) -> int:
+        """
+        预扣一次请求和估算的 token 数
+
+        Args:
+            tokens: 估算的 token 数(prompt + 预期的 completion)
+
+        Returns:
+            int: 实际预扣的 token 数，结算时原样传回 settle
+        """
+        if self._requests is not None:
+            await self._requests.take(1)
+        if self._tokens is None:
+            return 0
+        # 超过桶容量的请求只按容量预扣，结算时再补扣差额
+        tokens = min(tokens, self._tokens.capacity)
+        await self._tokens.take(tokens)
+        return tokens
+
+    def settle(self, reserved: int, actual: int):
+        """
+        按实际用量结算预扣，多退少补
+
+        Args:
+            reserved: reserve 返回的预扣 token 数
+            actual: 响应 usage 中的 total_tokens
+        """
+        if self._tokens is not None:
+            self._tokens.adjust(reserved - actual)
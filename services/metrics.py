@@ -0,0 +1,274 @@
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+# 每百万 token 的价格(人民币)，按 DeepSeek 官方标准时段价格
+MODEL_PRICES = {
+    "deepseek-chat": {"input_cache_hit": 0.5, "input": 2.0, "output": 8.0},
+    "deepseek-reasoner": {"input_cache_hit": 1.0, "input": 4.0, "output": 16.0},
+}
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300]
+
+
+def get_cached_tokens(usage: dict) -> int:
+    """
+    从 usage 中取出命中前缀缓存的 prompt token 数，兼容 DeepSeek 和 OpenAI 的字段
+
+    Args:
+        usage: 响应中的 usage
+
+    Returns:
+        int: 命中缓存的 token 数
+    """
+    if not usage:
+        return 0
+    if "prompt_cache_hit_tokens" in usage:
+        return usage["prompt_cache_hit_tokens"] or 0
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+
+def merge_usage(total: dict, usage: dict) -> dict:
+    """
+    把一次响应的 usage 累加到 total 中，命中缓存的 token 统一记到 prompt_cache_hit_tokens
+
+    Args:
+        total: 累计的 usage，会被原地修改
+        usage: 本次响应的 usage
+
+    Returns:
+        dict: total
+    """
+    if not usage:
+        return total
+    for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        total[key] = total.get(key, 0) + (usage.get(key) or 0)
+    total["prompt_cache_hit_tokens"] = total.get("prompt_cache_hit_tokens", 0) + get_cached_tokens(usage)
+    return total
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    计算分位数(线性插值)
+
+    Args:
+        values: 已排序的数值列表
+        q: 分位，0~1
+
+    Returns:
+        float: 分位数，列表为空时返回0
+    """
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class StageStats:
+    def __init__(self):
+        """单个流水线阶段的累计统计"""
+        self.latencies = []
+        self.ttfbs = []
+        self.outcomes = Counter()
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+
+
+class MetricsRecorder:
+    def __init__(self, prices: dict = None, report_interval: float = 60.0, batch_discount: float = 0.5):
+        """
+        记录每次 LLM 调用的延迟、token 用量、重试次数和费用，按流水线阶段聚合
+
+        Args:
+            prices: 模型价格表，默认 MODEL_PRICES
+            report_interval: 运行中打印汇总的间隔(秒)，0 表示不打印
+            batch_discount: 批处理模式的价格折扣
+        """
+        self.prices = prices or MODEL_PRICES
+        self.report_interval = report_interval
+        self.batch_discount = batch_discount
+        self.stages = defaultdict(StageStats)
+        self.started_at = time.time()
+        self._last_report = time.monotonic()
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> float:
+        """
+        按价格表计算费用(人民币)，未知模型返回0
+        """
+        price = self.prices.get(model)
+        if price is None:
+            return 0.0
+        return (
+            cached_tokens * price["input_cache_hit"]
+            + (prompt_tokens - cached_tokens) * price["input"]
+            + completion_tokens * price["output"]
+        ) / 1_000_000
+
+    def record(self, stage: str, model: str, outcome: str, latency: float, ttfb: float = None, retries: int = 0,
+               usage: dict = None, batch: bool = False):
+        """
+        记录一次逻辑请求(含所有重试)
+
+        Args:
+            stage: 流水线阶段标签，如 summary、dialogue、dpo 或提问角度名
+            model: 模型名称
+            outcome: 结果，ok / cache_hit / 错误类型名
+            latency: 总耗时(秒)，包含重试和退避
+            ttfb: 最后一次尝试的首字节时间(秒)
+            retries: 重试次数
+            usage: 所有尝试累计的 usage
+            batch: 是否为批处理模式
+        """
+        stats = self.stages[stage or "default"]
+        stats.latencies.append(latency)
+        if ttfb is not None:
+            stats.ttfbs.append(ttfb)
+        stats.outcomes[outcome] += 1
+        stats.retries += retries
+
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cached_tokens = get_cached_tokens(usage)
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        stats.cached_tokens += cached_tokens
+        cost = self.cost(model, prompt_tokens, completion_tokens, cached_tokens)
+        stats.cost += cost * self.batch_discount if batch else cost
+
+        if self.report_interval and time.monotonic() - self._last_report >= self.report_interval:
+            self._last_report = time.monotonic()
+            print(self.format_line())
+
+    def summary(self) -> dict:
+        """
+        汇总各阶段的统计
+
+        Returns:
+            dict: {stage: {...}, "total": {...}}
+        """
+        result = {}
+        total = StageStats()
+        for stage, stats in sorted(self.stages.items()):
+            result[stage] = self._summarize(stats)
+            total.latencies.extend(stats.latencies)
+            total.ttfbs.extend(stats.ttfbs)
+            total.outcomes.update(stats.outcomes)
+            total.retries += stats.retries
+            total.prompt_tokens += stats.prompt_tokens
+            total.completion_tokens += stats.completion_tokens
+            total.cached_tokens += stats.cached_tokens
+            total.cost += stats.cost
+        result["total"] = self._summarize(total)
+        result["total"]["wall_seconds"] = round(time.time() - self.started_at, 3)
+        return result
+
+    @staticmethod
+    def _summarize(stats: StageStats) -> dict:
+        latencies = sorted(stats.latencies)
+        ttfbs = sorted(stats.ttfbs)
+        return {
+            "requests": len(latencies),
+            "outcomes": dict(stats.outcomes),
+            "retries": stats.retries,
+            "latency_p50": round(percentile(latencies, 0.5), 3),
+            "latency_p90": round(percentile(latencies, 0.9), 3),
+            "latency_p99": round(percentile(latencies, 0.99), 3),
+            "latency_sum": round(sum(latencies), 3),
+            "ttfb_p50": round(percentile(ttfbs, 0.5), 3),
+            "ttfb_p90": round(percentile(ttfbs, 0.9), 3),
+            "prompt_tokens": stats.prompt_tokens,
+            "completion_tokens": stats.completion_tokens,
+            "cached_tokens": stats.cached_tokens,
+            "cache_hit_rate": round(stats.cached_tokens / stats.prompt_tokens, 4) if stats.prompt_tokens else 0.0,
+            "cost_rmb": round(stats.cost, 6),
+        }
+
+    def format_line(self) -> str:
+        """
+        单行的运行中汇总
+        """
+        total = self.summary()["total"]
+        return (
+            f"[metrics] 请求 {total['requests']} 次，重试 {total['retries']} 次，"
+            f"p50 {total['latency_p50']}s / p99 {total['latency_p99']}s，"
+            f"tokens 输入 {total['prompt_tokens']}(缓存命中 {total['cached_tokens']}) 输出 {total['completion_tokens']}，"
+            f"费用 ￥{total['cost_rmb']:.4f}"
+        )
+
+    def format_stages(self) -> str:
+        """
+        多行的分阶段汇总，用于运行结束时对比各阶段的前缀缓存命中率、延迟和费用
+        """
+        lines = []
+        for stage, stats in self.summary().items():
+            lines.append(
+                f"[metrics] {stage}: 请求 {stats['requests']} 次，重试 {stats['retries']} 次，"
+                f"p50 {stats['latency_p50']}s / p99 {stats['latency_p99']}s，首字节 p50 {stats['ttfb_p50']}s，"
+                f"输入 {stats['prompt_tokens']} tokens(缓存命中率 {stats['cache_hit_rate']:.1%}) "
+                f"输出 {stats['completion_tokens']} tokens，费用 ￥{stats['cost_rmb']:.4f}"
+            )
+        return "\n".join(lines)
+
+    def export_json(self, path: str):
+        """
+        导出 JSON 报告
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+    def export_prometheus(self, path: str):
+        """
+        导出 Prometheus textfile 格式的报告(可供 node_exporter 的 textfile collector 采集)
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        stages = [
+            (stage.replace("\\", "\\\\").replace('"', '\\"'), stats) for stage, stats in sorted(self.stages.items())
+        ]
+
+        # 文本格式要求同一指标族的样本连续出现，# TYPE 紧挨在该族样本之前，所以外层按指标族、内层按阶段
+        lines = ["# TYPE llm_request_duration_seconds histogram"]
+        for label, stats in stages:
+            latencies = sorted(stats.latencies)
+            index = 0
+            for bucket in LATENCY_BUCKETS:
+                while index < len(latencies) and latencies[index] <= bucket:
+                    index += 1
+                lines.append(f'llm_request_duration_seconds_bucket{{stage="{label}",le="{bucket}"}} {index}')
+            lines.append(f'llm_request_duration_seconds_bucket{{stage="{label}",le="+Inf"}} {len(latencies)}')
+            lines.append(f'llm_request_duration_seconds_sum{{stage="{label}"}} {sum(latencies)}')
+            lines.append(f'llm_request_duration_seconds_count{{stage="{label}"}} {len(latencies)}')
+
+        lines.append("# TYPE llm_requests_total counter")
+        for label, stats in stages:
+            for outcome, count in sorted(stats.outcomes.items()):
+                lines.append(f'llm_requests_total{{stage="{label}",outcome="{outcome}"}} {count}')
+
+        lines.append("# TYPE llm_retries_total counter")
+        for label, stats in stages:
+            lines.append(f'llm_retries_total{{stage="{label}"}} {stats.retries}')
+
+        lines.append("# TYPE llm_tokens_total counter")
+        for label, stats in stages:
+            lines.append(f'llm_tokens_total{{stage="{label}",type="prompt"}} {stats.prompt_tokens}')
+            lines.append(f'llm_tokens_total{{stage="{label}",type="completion"}} {stats.completion_tokens}')
+            lines.append(f'llm_tokens_total{{stage="{label}",type="cached"}} {stats.cached_tokens}')
+
+        lines.append("# TYPE llm_cost_rmb_total counter")
+        for label, stats in stages:
+            lines.append(f'llm_cost_rmb_total{{stage="{label}"}} {stats.cost}')
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
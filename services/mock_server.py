@@ -0,0 +1,421 @@
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+from services.tokens import estimate_messages_tokens, estimate_tokens
+
+# 模拟前缀缓存时的块大小(字符)，DeepSeek 按 64 token 为单位缓存
+PREFIX_CACHE_BLOCK = 64
+
+QUOTE_PATTERN = re.compile(r"[“「\"]([^”」\"]{2,80})[”」\"]")
+
+
+def parse_latency(spec: str):
+    """
+    解析延迟分布描述
+
+    支持：
+        fixed:秒数                 例如 fixed:0.5
+        uniform:最小值:最大值       例如 uniform:0.2:2
+        normal:均值:标准差          例如 normal:1:0.3
+        lognormal:中位数:sigma      例如 lognormal:1.5:0.6
+
+    Args:
+        spec: 分布描述
+
+    Returns:
+        callable: 接收 random.Random，返回延迟秒数的函数
+    """
+    kind, *params = spec.split(":")
+    values = [float(value) for value in params]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"不支持的延迟分布: {spec}")
+
+
+def detect_prompt_type(body: dict) -> str:
+    """
+    根据请求内容判断是哪条流水线发来的请求
+
+    Returns:
+        str: dpo / qa / qa_angles / dialogue / json / summary
+    """
+    text = "\n".join(message.get("content") or "" for message in body.get("messages", []))
+    if (body.get("response_format") or {}).get("type") != "json_object":
+        return "summary"
+    if '"chosen"' in text:
+        return "dpo"
+    if '"talk"' in text:
+        return "dialogue"
+    if '"angles"' in text:
+        return "qa_angles"
+    if "提问角度" in text:
+        return "qa"
+    return "json"
+
+
+class MockOpenAIServer:
+    def __init__(self, latency: str = "fixed:0", rate_429: float = 0.0, rate_500: float = 0.0,
+                 rate_malformed: float = 0.0, retry_after: float = 1.0, max_concurrency: int = 0,
+                 batch_delay: float = 1.0, canned: dict = None, seed: int = None, prefix_cache: bool = True,
+                 rate_partial: float = 0.0):
+        """
+        本地 OpenAI 兼容服务，用于离线压测和测试 chat completions、批任务流程
+
+        Args:
+            latency: 延迟分布描述，见 parse_latency
+            rate_429: 返回 429 的概率
+            rate_500: 返回 500 的概率
+            rate_malformed: JSON 模式下返回残缺 JSON 的概率
+            retry_after: 429 响应中 Retry-After 的秒数
+            max_concurrency: 模拟服务端容量，并发超过该值时返回 429，0 表示不限制
+            batch_delay: 批任务从提交到完成的模拟耗时(秒)
+            canned: 可选的固定响应，键为 detect_prompt_type 的返回值，值为响应内容(字符串或 JSON 对象)
+            seed: 随机种子，固定后注入的延迟和错误序列可复现
+            prefix_cache: 是否模拟 DeepSeek 的前缀缓存，在 usage 中返回 prompt_cache_hit_tokens
+            rate_partial: DPO 批量请求中每条输入被漏掉的概率，用于测试按 id 对齐和补请求
+        """
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.rate_malformed = rate_malformed
+        self.rate_partial = rate_partial
+        self.retry_after = retry_after
+        self.max_concurrency = max_concurrency
+        self.batch_delay = batch_delay
+        self.canned = canned or {}
+        self.rng = random.Random(seed)
+        self.inflight = 0
+        self.prefix_cache = set() if prefix_cache else None
+        self.stats = {"requests": 0, "429": 0, "500": 0, "malformed": 0, "cached_tokens": 0, "dropped_items": 0}
+        self.files = {}
+        self.batches = {}
+
+    def create_app(self) -> web.Application:
+        """
+        创建 aiohttp 应用
+        """
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/v1/chat/completions", self.handle_chat)
+        app.router.add_post("/v1/files", self.handle_upload)
+        app.router.add_get("/v1/files/{file_id}/content", self.handle_file_content)
+        app.router.add_post("/v1/batches", self.handle_create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.handle_get_batch)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    def generate_content(self, body: dict) -> str:
+        """
+        按请求类型生成符合 schema 的响应内容
+
+        Args:
+            body: 请求体
+
+        Returns:
+            str: message content
+        """
+        prompt_type = detect_prompt_type(body)
+        if prompt_type in self.canned:
+            content = self.canned[prompt_type]
+            return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+
+        messages = body.get("messages", [])
+        user_text = "\n".join(message.get("content") or "" for message in messages if message.get("role") == "user")
+        all_text = "\n".join(message.get("content") or "" for message in messages)
+        snippets = [line.strip() for line in all_text.splitlines() if len(line.strip()) >= 8] or ["这是一段模拟内容"]
+
+        if prompt_type == "summary":
+            return "\n".join(self.rng.choice(snippets)[:60] for _ in range(3))
+
+        if prompt_type == "dpo":
+            lines = user_text.split("用户输入如下：\n", 1)[-1].splitlines()
+            data = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                # 编号的输入(如 `3. 输入`)返回对应的 id
+                match = re.match(r"^(\d+)\. (.*)$", line.strip())
+                if match and self.rate_partial and self.rng.random() < self.rate_partial:
+                    self.stats["dropped_items"] += 1
+                    continue
+                text = match.group(2) if match else line.strip()
+                item = {
+                    "chosen": f"幻觉！！这都是幻觉！！{text[:20]}都是假的！！",
+                    "rejected": f"关于“{text[:20]}”，建议保持冷静，寻求专业帮助。",
+                }
+                if match:
+                    item = {"id": int(match.group(1)), **item}
+                data.append(item)
+            return json.dumps({"data": data}, ensure_ascii=False)
+
+        if prompt_type == "qa":
+            return json.dumps({"conversations": self._qa_pairs(snippets)}, ensure_ascii=False)
+
+        if prompt_type == "qa_angles":
+            numbers = [int(number) for number in re.findall(r"^(\d+)\. ", user_text, re.M)] or [1]
+            angles = [{"angle": number, "conversations": self._qa_pairs(snippets)} for number in numbers]
+            return json.dumps({"angles": angles}, ensure_ascii=False)
+
+        if prompt_type == "dialogue":
+            quotes = QUOTE_PATTERN.findall(user_text)
+            conversations = []
+            for i in range(0, len(quotes) - 1, 2):
+                conversations.append({"talk": [
+                    {"from": "human", "value": quotes[i]},
+                    {"from": "gpt", "value": quotes[i + 1]},
+                ]})
+            return json.dumps({"conversations": conversations[:10]}, ensure_ascii=False)
+
+        return json.dumps({}, ensure_ascii=False)
+
+    def _qa_pairs(self, snippets: list) -> list:
+        conversations = []
+        for _ in range(self.rng.randint(3, 6)):
+            snippet = self.rng.choice(snippets)[:80]
+            conversations.append([
+                {"from": "human", "value": f"这段情节里发生了什么：{snippet[:20]}？"},
+                {"from": "gpt", "value": snippet},
+            ])
+        return conversations
+
+    def complete(self, body: dict, malformed: bool = False, cached_tokens: int = None) -> dict:
+        """
+        生成一个 chat completion 响应体
+
+        Args:
+            body: 请求体
+            malformed: 是否返回残缺的 JSON 内容
+            cached_tokens: 请求到达时查到的前缀缓存命中 token 数，None 时现场查询
+
+        Returns:
+            dict: chat completion 对象
+        """
+        content = self.generate_content(body)
+        if malformed:
+            content = content[:max(1, len(content) // 2)]
+        prompt_tokens = estimate_messages_tokens(body.get("messages", []))
+        completion_tokens = estimate_tokens(content)
+        if cached_tokens is None:
+            cached_tokens = self.prefix_lookup(body.get("messages", []))
+        cached_tokens = min(prompt_tokens, cached_tokens)
+        self.prefix_store(body.get("messages", []))
+        self.stats["cached_tokens"] += cached_tokens
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_cache_hit_tokens": cached_tokens,
+                "prompt_cache_miss_tokens": prompt_tokens - cached_tokens,
+            },
+        }
+
+    @staticmethod
+    def _prefix_blocks(messages: list) -> list:
+        """
+        按固定长度的块切分请求前缀，返回每个块结束位置的(token 数, 前缀哈希)
+        """
+        text = "".join(f"{message.get('role')}\n{message.get('content') or ''}\n" for message in messages)
+        digest = hashlib.sha1()
+        blocks = []
+        tokens = 1
+        for start in range(0, len(text) - PREFIX_CACHE_BLOCK + 1, PREFIX_CACHE_BLOCK):
+            block = text[start:start + PREFIX_CACHE_BLOCK]
+            digest.update(block.encode("utf-8"))
+            # estimate_tokens 每次调用会额外加1，累加时去掉
+            tokens += estimate_tokens(block) - 1
+            blocks.append((tokens, digest.hexdigest()))
+        return blocks
+
+    def prefix_lookup(self, messages: list) -> int:
+        """
+        模拟前缀缓存查询：与之前已完成的请求完全相同的前缀块算作命中
+
+        Returns:
+            int: 命中缓存的 token 数
+        """
+        if self.prefix_cache is None:
+            return 0
+        hit = 0
+        for tokens, key in self._prefix_blocks(messages):
+            if key not in self.prefix_cache:
+                break
+            hit = tokens
+        return hit
+
+    def prefix_store(self, messages: list):
+        """
+        请求完成后把它的前缀块写入缓存，和真实服务一样，同时发出的相同前缀请求不会互相命中
+        """
+        if self.prefix_cache is not None:
+            self.prefix_cache.update(key for _, key in self._prefix_blocks(messages))
+
+    def _roll_fault(self, body: dict):
+        """
+        按配置的概率抽取本次请求要注入的故障
+
+        Returns:
+            str | None: 429 / 500 / malformed / None
+        """
+        roll = self.rng.random()
+        if roll < self.rate_429:
+            return "429"
+        roll -= self.rate_429
+        if roll < self.rate_500:
+            return "500"
+        roll -= self.rate_500
+        if roll < self.rate_malformed and (body.get("response_format") or {}).get("type") == "json_object":
+            return "malformed"
+        return None
+
+    async def handle_chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats["requests"] += 1
+
+        if self.max_concurrency and self.inflight >= self.max_concurrency:
+            self.stats["429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+        self.inflight += 1
+        try:
+            cached_tokens = self.prefix_lookup(body.get("messages", []))
+            await asyncio.sleep(self.latency(self.rng))
+            fault = self._roll_fault(body)
+            if fault == "429":
+                self.stats["429"] += 1
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                    status=429,
+                    headers={"Retry-After": str(self.retry_after)},
+                )
+            if fault == "500":
+                self.stats["500"] += 1
+                return web.Response(status=500, text="<html><body>500 Internal Server Error</body></html>")
+            if fault == "malformed":
+                self.stats["malformed"] += 1
+            return web.json_response(self.complete(body, malformed=fault == "malformed", cached_tokens=cached_tokens))
+        finally:
+            self.inflight -= 1
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "inflight": self.inflight})
+
+    def _save_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "content": content,
+        }
+        return {key: value for key, value in self.files[file_id].items() if key != "content"}
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        return web.json_response(self._save_file(upload.file.read(), upload.filename, form.get("purpose", "batch")))
+
+    async def handle_file_content(self, request: web.Request) -> web.Response:
+        file = self.files.get(request.match_info["file_id"])
+        if file is None:
+            return web.json_response({"error": {"message": "file not found"}}, status=404)
+        return web.Response(body=file["content"], content_type="application/jsonl")
+
+    async def handle_create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get("input_file_id") not in self.files:
+            return web.json_response({"error": {"message": "input file not found"}}, status=400)
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        asyncio.ensure_future(self._run_batch(batch_id))
+        return web.json_response(self.batches[batch_id])
+
+    async def handle_get_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        return web.json_response(batch)
+
+    async def _run_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        batch["status"] = "in_progress"
+        batch["request_counts"]["total"] = len(lines)
+        await asyncio.sleep(self.batch_delay)
+
+        outputs = []
+        errors = []
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # 批任务没有限流的概念，429 和 500 都按单条失败处理
+            fault = self._roll_fault(record["body"])
+            if fault in ("429", "500"):
+                errors.append(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": record["custom_id"],
+                    "response": {"status_code": 500, "request_id": uuid.uuid4().hex, "body": None},
+                    "error": {"code": "server_error", "message": "injected failure"},
+                }, ensure_ascii=False))
+                batch["request_counts"]["failed"] += 1
+                continue
+            outputs.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": record["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": self.complete(record["body"], malformed=fault == "malformed"),
+                },
+                "error": None,
+            }, ensure_ascii=False))
+            batch["request_counts"]["completed"] += 1
+
+        output = self._save_file("\n".join(outputs).encode("utf-8"), f"{batch_id}_output.jsonl", "batch_output")
+        batch["output_file_id"] = output["id"]
+        if errors:
+            error = self._save_file("\n".join(errors).encode("utf-8"), f"{batch_id}_error.jsonl", "batch_output")
+            batch["error_file_id"] = error["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
@@ -1,8 +1,17 @@
+import asyncio
 import json
 import os
 import random
+from collections import Counter
 
+from services.chapters import ChapterStore
+from services.checkpoint import Checkpoint
 from services.openai import OpenAIHandler
+from services.planner import Plan, WorkUnit, hash_text, make_fingerprint
+from services.prescan import DialoguePrescan
+from services.pretrain import iter_pretrain_chunks
+from services.schema import QA_PAIRS_RESPONSE, SHAREGPT_DIALOGUE_RESPONSE, Schema, qa_angles_response
+from services.workqueue import run_queue
 
 def split_novel_to_pretrain_data(novel_path: str, target_length: int = 2000) -> list:
     """
@@ -12,38 +21,8 @@ def split_novel_to_pretrain_data(novel_path: str, target_length: int = 2000) ->
     :return: 包含分割后文本的字典列表 [{text: string}]
     """
     try:
-        with open(novel_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # 按行分割并去除空白
-        lines = [line.strip() for line in content.split('\n') if line.strip()]
-        
-        # 合并行到目标长度
-        chunks = []
-        current_chunk = ""
-        
-        for line in lines:
-            # 如果当前块为空，直接添加
-            if not current_chunk:
-                current_chunk = line
-                continue
-            
-            # 计算添加当前行后的长度
-            potential_length = len(current_chunk) + len(line)
-            
-            # 如果添加后长度接近目标长度（偏差绝对值最小）
-            if abs(potential_length - target_length) < abs(len(current_chunk) - target_length):
-                current_chunk += line
-            else:
-                # 保存当前块并开始新块
-                chunks.append({"text": current_chunk})
-                current_chunk = line
-        
-        # 添加最后一个块
-        if current_chunk:
-            chunks.append({"text": current_chunk})
-            
-        return chunks
+        # 按字符数贪心合并行，大文件请直接用 services.pretrain.write_pretrain_jsonl 流式写入
+        return list(iter_pretrain_chunks(novel_path, target_tokens=target_length, tokenizer=len))
     
     except FileNotFoundError:
         raise Exception("文件未找到")
@@ -58,69 +37,99 @@ def extract_chapters(novel_path):
     :return: 包含各章内容的字符串数组
     """
     try:
-        with open(novel_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # 使用正则表达式匹配章节标题并分割内容
-        import re
-        chapters = re.split(r'第\d+章.*\n', content)
-        
-        # 去除第一个空元素（标题前的内容）
-        if chapters and not chapters[0].strip():
-            chapters = chapters[1:]
-            
-        return chapters
+        with ChapterStore.open(novel_path) as store:
+            return store.texts()
     except FileNotFoundError:
         raise Exception("File not found")
     except Exception as e:
         raise Exception(f"Error reading file: {str(e)}")
 
-async def summarize_chapters(chapters: list, openai_service: OpenAIHandler) -> list:
+
+def chapter_number(index: int, chapter) -> int:
+    """
+    章节号，不读取章节内容
+
+    :param index: 章节在列表中的位置
+    :param chapter: Chapter 或章节内容字符串
+    :return: 章节号，字符串没有章节号时按位置从1开始编号
+    """
+    if isinstance(chapter, str):
+        return index + 1
+    return chapter.number
+
+
+def chapter_ids(chapters: list) -> list:
+    """
+    断点 key 中的章节标识，不读取章节内容
+
+    一般就是章节号，这样插入或删除章节后其他章节的 key 不变；ChapterStore 允许章节号重复，
+    重复的章节号加上章节位置(如 12#305)，否则多章共用一个 key，结果互相覆盖，每次运行都会重新请求
+
+    :param chapters: Chapter 或章节内容字符串的列表
+    :return: 与 chapters 一一对应的标识
+    """
+    numbers = [chapter_number(index, chapter) for index, chapter in enumerate(chapters)]
+    counts = Counter(numbers)
+    return [str(number) if counts[number] == 1 else f"{number}#{index}" for index, number in enumerate(numbers)]
+
+
+def chapter_content(index: int, chapter) -> tuple:
+    """
+    统一章节参数：既可以是 ChapterStore 中的 Chapter，也可以是章节内容字符串
+
+    :param index: 章节在列表中的位置
+    :param chapter: Chapter 或章节内容字符串
+    :return: (章节号, 章节内容)，字符串没有章节号时按位置从1开始编号
+    """
+    if isinstance(chapter, str):
+        return index + 1, chapter
+    return chapter.number, chapter.text
+
+async def run_checkpointed(checkpoint: Checkpoint, unit: WorkUnit, request):
+    """
+    带断点的请求：checkpoint 中已有相同输入指纹的结果时直接返回，否则请求并立即连同指纹写入 checkpoint
+
+    :param checkpoint: 断点，为 None 时直接请求
+    :param unit: 工作单元，提供断点中的标识和输入指纹
+    :param request: 无参数的协程函数，返回可 JSON 序列化的结果
+    :return: 结果
+    """
+    if checkpoint is None:
+        return await request()
+    record = checkpoint.get(unit.key, unit.fingerprint)
+    if record is not None:
+        return record["result"]
+    result = await request()
+    checkpoint.put(unit.key, result, unit.fingerprint)
+    return result
+
+
+async def summarize_chapters(chapters: list, openai_service: OpenAIHandler, checkpoint: Checkpoint = None,
+                             plan_only: bool = False, concurrency: int = None, min_yield: float = 0.8,
+                             scans: list = None):
     """
     并行总结小说章节内容，返回sharegpt格式的列表对象
     
     Args:
-        chapters: 小说章节内容列表
+        chapters: 小说章节列表，元素为 ChapterStore 中的 Chapter 或章节内容字符串
         openai_service: OpenAI服务实例
+        checkpoint: 可选的断点，输入指纹(章节内容、提示词、模型、温度)未变的章节直接从断点读取，新完成的章节立即写入
+        plan_only: 为True时不发请求，只返回需要重新生成的计划
+        concurrency: 同时处理的章节数，默认由 openai_service.worker_concurrency() 决定
+        min_yield: 一次响应中合格对话的最低比例，低于该比例时重新请求，否则只丢弃不合格的对话
+        scans: 可选的预扫描结果(DialoguePrescan.scan)，与 chapters 一一对应；
+               决策为 skip 的章节不发请求直接记为空对话，cheap 的章节使用低价模型，所用模型计入指纹
         
     Returns:
-        list: sharegpt格式的对话列表
+        list | Plan: sharegpt格式的对话列表，plan_only 时为 Plan
     """
     from typing import List, Dict, Any
     import asyncio
     
-    # 定义验证回调函数
-    def validate_response(response: Dict[str, Any]):
-        if not isinstance(response, dict):
-            raise Exception("Response is not a dictionary")
-        if "conversations" not in response:
-            raise Exception("Missing 'conversations' field")
-        if not isinstance(response["conversations"], list):
-            raise Exception("'conversations' must be a list")
-        for conv in response["conversations"]:
-            if not isinstance(conv, dict):
-                raise Exception("Conversation item must be a dictionary")
-            if "talk" not in conv:
-                raise Exception("Missing 'talk' field")
-            if not isinstance(conv["talk"], list):
-                raise Exception("'talk' must be a list")
-            for talk in conv["talk"]:
-                if not isinstance(talk, dict):
-                    raise Exception("Talk item must be a dictionary")
-                if "from" not in talk or "value" not in talk:
-                    raise Exception("Talk item missing required fields")
-                if talk["from"] not in ["gpt", "human"]:
-                    raise Exception("Invalid 'from' value")
-
-    # 创建任务列表
-    tasks = []
-    semaphore = asyncio.Semaphore(50)  # 限制并发数
-    
-    async def process_chapter(index: int, content: str):
-        async with semaphore:
-            messages = [{
-                "role": "system",
-                "content": """你是一个专业的小说对话总结助手。请将小说《道诡异仙》的章节内容总结为主角李火旺的多段对话
+    # 校验回调：格式错误的对话只丢弃该段，合格比例低于 min_yield 才重新生成
+    validate_response = Schema(SHAREGPT_DIALOGUE_RESPONSE, name="dialogue", min_yield=min_yield)
+
+    system_prompt = """你是一个专业的小说对话总结助手。请将小说《道诡异仙》的章节内容总结为主角李火旺的多段对话
 
 返回格式要求如下：
 1. 对话格式为 JSON 对象，包含 conversations 字段
@@ -174,28 +183,62 @@ async def summarize_chapters(chapters: list, openai_service: OpenAIHandler) -> l
     }
   ]
 }"""
-            }, {
-                "role": "user",
-                "content": content,
-            }]
-            try:
-                response = await openai_service.request_json(
-                    messages=messages,
-                    temp = 0,
-                    validator_callback=validate_response,
-                )
-                response["capter"] = index  # 添加章节索引
-                return response
-            except Exception as e:
-                print(f"Error processing chapter {index}: {str(e)}")
-                return {"conversations": [], "capter": index}
-    
-    # 启动所有任务
-    for index, chapter in enumerate(chapters):
-        tasks.append(process_chapter(index, chapter))
+
+    def chapter_model(index: int) -> str:
+        return scans[index].model if scans is not None else openai_service.model
+
+    ids = chapter_ids(chapters)
+
+    def chapter_unit(index: int, chapter) -> WorkUnit:
+        return WorkUnit(f"dialogue:{ids[index]}", "dialogue", chapter_number(index, chapter),
+                        make_fingerprint(chapter, system_prompt, chapter_model(index), 0))
+
+    units = [chapter_unit(index, chapter) for index, chapter in enumerate(chapters)]
+    plan = Plan(units, checkpoint)
+    if plan_only:
+        return plan
+
+    async def process_chapter(index: int, chapter, unit: WorkUnit):
+        number, content = chapter_content(index, chapter)
+        messages = [{
+            "role": "system",
+            "content": system_prompt
+        }, {
+            "role": "user",
+            "content": content,
+        }]
+        decision = scans[index].decision if scans is not None else "full"
+
+        async def request():
+            if decision == "skip":
+                # 预扫描判断李火旺没有说话，不发请求
+                return {"conversations": []}
+            return await openai_service.request_json(
+                messages=messages,
+                model=chapter_model(index),
+                temp = 0,
+                validator_callback=validate_response,
+                tag="dialogue" if decision == "full" else f"dialogue:{decision}",
+            )
+
+        try:
+            response = await run_checkpointed(checkpoint, unit, request)
+            response["capter"] = index  # 添加章节索引
+            response["chapter_number"] = number
+            return response
+        except Exception as e:
+            print(f"Error processing chapter {index}: {str(e)}")
+            return {"conversations": [], "capter": index, "chapter_number": number}
     
-    # 等待所有任务完成
-    results = await asyncio.gather(*tasks)
+    # 有界工作队列按需取章节，同时处理的章节数只与并发上限有关，结果按章节顺序收集
+    results = []
+    await run_queue(
+        enumerate(chapters),
+        lambda entry: process_chapter(entry[0], entry[1], units[entry[0]]),
+        sink=lambda index, result: results.append(result),
+        concurrency=concurrency or openai_service.worker_concurrency(),
+        ordered=True,
+    )
     
     # 合并结果，以talk为维度组织conversations
     final_result = []
@@ -203,38 +246,72 @@ async def summarize_chapters(chapters: list, openai_service: OpenAIHandler) -> l
         for conv in result["conversations"]:
             final_result.append({
                 "conversations": conv['talk'],  # 直接将talk作为conversations的内容
-                "capter": result["capter"]
+                "capter": result["capter"],
+                "chapter_number": result["chapter_number"]
             })
     
     return final_result
 
-async def lihuowang_sharegpt_and_save(novel_path: str, output_path: str, openai_service: OpenAIHandler, force: bool = False):
+def default_checkpoint_path(output_path: str) -> str:
+    """
+    输出文件对应的默认断点路径
+    """
+    return os.path.join(".cache", "checkpoints", os.path.basename(output_path) + ".jsonl")
+
+
+async def lihuowang_sharegpt_and_save(novel_path: str, output_path: str, openai_service: OpenAIHandler, force: bool = False, checkpoint_path: str = None, dry_run: bool = False, prescan: DialoguePrescan = None, prescan_log_path: str = None):
     """
     总结小说内容并保存为JSON文件
     :param novel_path: 小说文件路径
     :param output_path: 输出JSON文件路径
     :param openai_service: OpenAI服务实例
-    :param force: 是否强制重新生成，即使文件已存在
+    :param force: 是否强制重新生成全部章节(清空断点)
+    :param checkpoint_path: 断点路径，默认 .cache/checkpoints/<输出文件名>.jsonl，中断后重新运行会跳过已完成的章节，
+                            章节内容、提示词、模型或温度变化时只重新生成受影响的章节，再用断点中的结果重建输出文件
+    :param dry_run: 只打印需要重新生成的计划，不发请求
+    :param prescan: 可选的本地预扫描，李火旺大概率没有说话的章节跳过或改用低价模型
+    :param prescan_log_path: 预扫描日志路径，默认 .cache/prescan/<输出文件名>.jsonl，记录每章的评分和决策
     """
+    checkpoint_path = checkpoint_path or default_checkpoint_path(output_path)
     try:
-        # 如果文件已存在且不强制重新生成，则跳过
-        if os.path.exists(output_path) and not force:
-            print(f"文件 {output_path} 已存在，跳过生成")
-            return
-        
-        # 获取所有章节内容
-        chapters = extract_chapters(novel_path)
-        
-        # 调用总结函数
-        # 随机选择一个起始索引，确保能取到连续3章
-        # start_index = random.randint(0, len(chapters) - 20)
-        # 获取连续3章内容
-        # selected_chapters = chapters[start_index:start_index+20]
-        # summarized_chapters = await summarize_chapters(selected_chapters, openai_service)
-        # 取第一章测试
-        # summarized_chapters = await summarize_chapters(chapters[:1], openai_service)
-        # 跑全量
-        summarized_chapters = await summarize_chapters(chapters, openai_service)
+        # 获取所有章节，内容在请求时才从映射的文件中读取；每章完成后立即写入断点
+        with Checkpoint(checkpoint_path) as checkpoint, ChapterStore.open(novel_path) as chapters:
+            if force and not dry_run:
+                checkpoint.clear()
+            scans = None
+            if prescan is not None:
+                scans = [prescan.scan(*chapter_content(index, chapter)) for index, chapter in enumerate(chapters[:])]
+                print(prescan.format_report(scans))
+                prescan.write_log(scans, prescan_log_path or os.path.join(
+                    ".cache", "prescan", os.path.basename(output_path) + ".jsonl"))
+            plan = await summarize_chapters(chapters[:], openai_service, checkpoint=checkpoint, plan_only=True,
+                                            scans=scans)
+            print(plan.format_report())
+            if dry_run:
+                return
+            if os.path.exists(output_path) and not force:
+                if not len(checkpoint):
+                    # 没有断点时无法判断已有文件是否过期(如旧版本生成的文件)，保持跳过
+                    print(f"文件 {output_path} 已存在且没有断点，跳过生成，需要重新生成请使用 force")
+                    return
+                if not plan.stale:
+                    print(f"文件 {output_path} 已是最新，跳过生成")
+                    # 更新修改时间，否则流水线会因为输入(如 services/novel.py)更新而每次都重新执行本阶段和下游阶段
+                    os.utime(output_path)
+                    return
+            # 调用总结函数
+            # 随机选择一个起始索引，确保能取到连续3章
+            # start_index = random.randint(0, len(chapters) - 20)
+            # 获取连续3章内容
+            # selected_chapters = chapters[start_index:start_index+20]
+            # summarized_chapters = await summarize_chapters(selected_chapters, openai_service, checkpoint=checkpoint)
+            # 取第一章测试
+            # summarized_chapters = await summarize_chapters(chapters[:1], openai_service, checkpoint=checkpoint)
+            # 跑全量
+            summarized_chapters = await summarize_chapters(chapters[:], openai_service, checkpoint=checkpoint,
+                                                           scans=scans)
+            # 清理不再对应任何工作单元的旧记录
+            checkpoint.compact(unit.key for unit in plan.units)
 
         # 创建datasets目录（如果不存在）
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -243,59 +320,63 @@ async def lihuowang_sharegpt_and_save(novel_path: str, output_path: str, openai_
         with open(output_path, "w", encoding="utf-8") as f:
             json.dump(summarized_chapters, f, ensure_ascii=False, indent=2)
         
+    except asyncio.CancelledError:
+        print(f"已中断，已完成的章节保存在断点 {checkpoint_path}，重新运行会从断点继续")
+        raise
     except Exception as e:
+        # 继续抛出，流水线据此把本阶段标记为失败，不再执行依赖它的下游阶段
         print(f"Error: {str(e)}")
+        raise
 
 
-async def summarize_qa(chapters: list, openai_service: OpenAIHandler) -> list:
+async def summarize_qa(chapters: list, openai_service: OpenAIHandler, combined_angles: bool = False,
+                       warm_prefix: bool = False, checkpoint: Checkpoint = None, plan_only: bool = False,
+                       concurrency: int = None, min_yield: float = 0.8):
     """
     并行总结小说章节内容，返回包含总结和问答的列表对象
+
+    每章的摘要和各个提问角度是独立的请求，一起交给 openai_service 的并发限制器调度，章节通过有界工作队列按需读取；
+    某个角度失败只丢弃该角度，摘要失败时 summary 为 None
     
     Args:
-        chapters: 小说章节内容列表
+        chapters: 小说章节列表，元素为 ChapterStore 中的 Chapter 或章节内容字符串
         openai_service: OpenAI服务实例
+        combined_angles: 为True时在一次请求中返回所有角度的问答，减少携带整章内容的请求数
+        warm_prefix: 为True时每章先完成摘要请求，再并发请求各个角度，让角度请求命中摘要写入的前缀缓存
+        checkpoint: 可选的断点，摘要和每个角度分别记录输入指纹(章节内容、提示词、模型、温度)，
+                    重新运行时只请求缺失、失败或指纹变化的部分，例如只修改了一个提问角度时只重新生成该角度
+        plan_only: 为True时不发请求，只返回需要重新生成的计划
+        concurrency: 同时处理的章节数，默认由 openai_service.worker_concurrency() 按每章的请求数决定
+        min_yield: 一次响应中合格问答对的最低比例，低于该比例时重新请求，否则只丢弃不合格的问答对
         
     Returns:
-        list: 包含总结和问答的列表
+        list | Plan: 包含总结和问答的列表，plan_only 时为 Plan
     """
     from typing import List, Dict, Any
     import asyncio
     
-    # 定义验证回调函数
-    def validate_response(response: Dict[str, Any]):
-        if not isinstance(response, dict):
-            raise Exception("Response is not a dictionary")
-        if "conversations" not in response:
-            raise Exception("Missing 'conversations' field")
-        if not isinstance(response["conversations"], list):
-            raise Exception("'conversations' must be a list")
-        for conv_pair in response["conversations"]:
-            if not isinstance(conv_pair, list) or len(conv_pair) != 2:
-                raise Exception("Conversation pair must be a list of length 2")
-            for conv in conv_pair:
-                if not isinstance(conv, dict):
-                    raise Exception("Conversation item must be a dictionary")
-                if "from" not in conv or "value" not in conv:
-                    raise Exception("Conversation item missing required fields")
-                if conv["from"] not in ["gpt", "human"]:
-                    raise Exception("Invalid 'from' value")
-            # 验证对话顺序：human -> gpt
-            if conv_pair[0]["from"] != "human" or conv_pair[1]["from"] != "gpt":
-                raise Exception("Invalid conversation order: must be human -> gpt")
-
-    # 创建任务列表
-    tasks = []
-    semaphore = asyncio.Semaphore(50)  # 限制并发数
+    ANGLES = [
+        "名词介绍，关注章节中解释过、需要注意的名词，长什么样子，有何作用，为何存在等",
+        "剧情介绍，在具体场景下，何人干了何事",
+        "对话介绍，在具体场景和形式下，何时何地何处说了什么话，以及推断该角色说这话表达了什么意思",
+        "有助于了解本章内容的有深度分析的问题和答案"
+    ]
 
-    
-    async def process_chapter(index: int, content: str):
-        system_message = {
-                "role": "system",
-                "content": """你是一个专业的小说内容分析专家，请根据小说《道诡异仙》的基本介绍和给定待分析的章节内容进行提问。
+    # 校验回调：格式错误的问答对(或合并请求中的某个角度)只丢弃该条，合格比例低于 min_yield 才重新生成
+    validate_response = Schema(QA_PAIRS_RESPONSE, name="qa", min_yield=min_yield)
+    validate_combined_response = Schema(qa_angles_response(len(ANGLES)), name="qa:all", min_yield=min_yield)
+
+    background = """你是一个专业的小说内容分析专家，请根据小说《道诡异仙》的基本介绍和给定待分析的章节内容完成指定的任务。
 《道诡异仙》是一部融合了玄幻、修真、恐怖和心理悬疑元素的小说，主角李火旺分不清大傩世界和现实世界，讲述了李火旺在一个诡异而扭曲的大傩世界与现实世界中不断穿梭挣扎求生的故事。
-通过李火旺的经历，探讨了现实与幻觉、人性与邪恶、生存与反抗等主题。小说充满了恐怖和悬疑的氛围，情节紧凑，充满了反转和意外。作者通过细腻的心理描写和诡异的世界观构建，成功营造了一个令人毛骨悚然的故事世界观。
+通过李火旺的经历，探讨了现实与幻觉、人性与邪恶、生存与反抗等主题。小说充满了恐怖和悬疑的氛围，情节紧凑，充满了反转和意外。作者通过细腻的心理描写和诡异的世界观构建，成功营造了一个令人毛骨悚然的故事世界观。"""
+
+    summary_task = """请对以上章节内容进行总结，总结生成的要求如下：
+1. 纯文本总结，多个方面的内容用换行隔开
+2. 总结包括多个方面，分别是主要剧情发展、人物关系概括、人物心理变化
+3. 模仿章节内容的中的描述手法和风格
+4. 注意区分大傩世界和现实世界"""
 
-请在指定的提问角度下，以独立问答形式尽可能多，尽可能全面的对该章节剧情进行剖析。
+    qa_requirements = """请在指定的提问角度下，以独立问答形式尽可能多，尽可能全面的对该章节剧情进行剖析。
 
 提问的要求：
 - 问题中需要自然的带上事件的上下文背景
@@ -307,9 +388,9 @@ async def summarize_qa(chapters: list, openai_service: OpenAIHandler) -> list:
 - 模仿章节内容的中的描述手法和风格进行回答
 - “大傩世界”和“现实世界” 需要区分开
 - 答案的背景上下文需要用具体的名词或事件进行指代，不可用“在章节中”“在《道诡异仙》中”等太宽泛的代词
-- 直接回答，不可重复问题中的部分内容
+- 直接回答，不可重复问题中的部分内容"""
 
-返回格式要求如下：
+    qa_format = """返回格式要求如下：
 1. 对话格式为 JSON 对象，包含 conversations 字段
 2. conversations 是一个数组，每个元素是一个对话数组
 3. 每个对话数组对象包含 from 和 value 字段
@@ -332,111 +413,232 @@ async def summarize_qa(chapters: list, openai_service: OpenAIHandler) -> list:
         ],
         ...
     ]
-}
-待分析章节内容：
-""" + content
-            }
-        ANGLES = [
-            "名词介绍，关注章节中解释过、需要注意的名词，长什么样子，有何作用，为何存在等",
-            "剧情介绍，在具体场景下，何人干了何事",
-            "对话介绍，在具体场景和形式下，何时何地何处说了什么话，以及推断该角色说这话表达了什么意思",
-            "有助于了解本章内容的有深度分析的问题和答案"
-        ]
-        async with semaphore:
+}"""
+
+    qa_combined_format = """不同角度的问答分开返回，angle 为提问角度的序号，请按照以下 JSON 格式返回响应：
+{
+    "angles": [
+        {
+            "angle": 1,
+            "conversations": [
+                [
+                    {"from": "human", "value": "问题1"},
+                    {"from": "gpt", "value": "答案1"}
+                ],
+                ...
+            ]
+        },
+        ...
+    ]
+}"""
+
+    angle_list = "\n".join(f"{number}. {angle}" for number, angle in enumerate(ANGLES, 1))
+    all_angles_task = f"{qa_requirements}\n\n{qa_combined_format}\n\n提问角度：\n{angle_list}"
+
+    def angle_task(angle: str) -> str:
+        return f"{qa_requirements}\n\n{qa_format}\n\n提问角度：{angle}"
+
+    # 同一章的所有请求共用 背景介绍 + 章节全文 的前缀，只有最后的任务说明不同，
+    # 这样可以命中服务端的前缀缓存(命中部分的输入 token 更便宜、首字更快)
+    def build_messages(content: str, task: str) -> list:
+        return [{
+            "role": "system",
+            "content": background
+        }, {
+            "role": "user",
+            "content": f"待分析章节内容：\n{content}\n\n{task}"
+        }]
+
+    ids = chapter_ids(chapters)
+
+    def chapter_units(index: int, chapter) -> dict:
+        # 每章的摘要和每个提问角度是独立的工作单元，指纹中的提示词是去掉章节内容后的完整消息
+        number = chapter_number(index, chapter)
+        chapter_id = ids[index]
+
+        def unit(key: str, stage: str, task: str, angle: str = None) -> WorkUnit:
+            template = json.dumps(build_messages("", task), ensure_ascii=False)
+            return WorkUnit(key, stage, number, make_fingerprint(chapter, template, openai_service.model, 0.7), angle)
+
+        units = {"summary": unit(f"summary:{chapter_id}", "summary", summary_task)}
+        if combined_angles:
+            units["all"] = unit(f"qa:{chapter_id}:all", "qa", all_angles_task, "全部角度")
+        else:
+            # 按角度文本的哈希区分，修改或新增一个角度只会让该角度过期
+            for angle in ANGLES:
+                units[angle] = unit(f"qa:{chapter_id}:{hash_text(angle)[:8]}", "qa", angle_task(angle),
+                                    angle.split('，')[0])
+        return units
+
+    chapter_unit_maps = [chapter_units(index, chapter) for index, chapter in enumerate(chapters)]
+    plan = Plan([unit for units in chapter_unit_maps for unit in units.values()], checkpoint)
+    if plan_only:
+        return plan
+
+    async def process_chapter(index: int, chapter, units: dict):
+        number, content = chapter_content(index, chapter)
+
+        if any(plan.is_stale(unit.key) for unit in units.values()):
             print(f"正在处理第 {index + 1} 章，内容长度：{len(content)} 字符")
-            try:
-                # 请求生成章节摘要
-                summary_response = await openai_service.request(
-                    messages=[{
-                        "role": "system",
-                        "content": f"""你是一个专业的小说内容分析专家，请根据小说《道诡异仙》的基本介绍和给定待分析章节内容进行总结。
-    《道诡异仙》是一部融合了玄幻、修真、恐怖和心理悬疑元素的小说，主角李火旺分不清大傩世界和现实世界，讲述了李火旺在一个诡异而扭曲的大傩世界与现实世界中不断穿梭挣扎求生的故事。
-    通过李火旺的经历，探讨了现实与幻觉、人性与邪恶、生存与反抗等主题。小说充满了恐怖和悬疑的氛围，情节紧凑，充满了反转和意外。作者通过细腻的心理描写和诡异的世界观构建，成功营造了一个令人毛骨悚然的故事世界观。
-
-    总结生成的要求如下：
-    1. 纯文本总结，多个方面的内容用换行隔开
-    2. 总结包括多个方面，分别是主要剧情发展、人物关系概括、人物心理变化
-    3. 模仿章节内容的中的描述手法和风格
-    4. 注意区分大傩世界和现实世界
-    """
-                        }, {
-                        "role": "user",
-                        "content": f"待分析章节内容：\n{content}"
-                    }],
-                    temp=0.7
+
+        async def request_summary():
+            # 请求生成章节摘要
+            messages = build_messages(content, summary_task)
+            return await run_checkpointed(
+                checkpoint, units["summary"],
+                lambda: openai_service.request(
+                    messages=messages,
+                    temp=0.7,
+                    tag="summary",
+                ),
+            )
+
+        async def request_angle(angle: str):
+            messages = build_messages(content, angle_task(angle))
+            response_json = await run_checkpointed(
+                checkpoint, units[angle],
+                lambda: openai_service.request_json(
+                    messages=messages,
+                    temp=0.7,
+                    validator_callback=validate_response,
+                    tag=f"qa:{angle.split('，')[0]}",
+                ),
+            )
+            return response_json["conversations"]
+
+        async def request_all_angles():
+            messages = build_messages(content, all_angles_task)
+            response_json = await run_checkpointed(
+                checkpoint, units["all"],
+                lambda: openai_service.request_json(
+                    messages=messages,
+                    temp=0.7,
+                    validator_callback=validate_combined_response,
+                    tag="qa:all",
+                ),
+            )
+            conversations = []
+            for group in response_json["angles"]:
+                conversations.extend(group["conversations"])
+            return conversations
+
+        try:
+            if combined_angles:
+                labels = ["全部角度"]
+                angle_requests = [request_all_angles()]
+            else:
+                labels = [angle.split('，')[0] for angle in ANGLES]
+                angle_requests = [request_angle(angle) for angle in ANGLES]
+            if warm_prefix:
+                # 先发摘要请求写入前缀缓存，再并发请求各个角度
+                summary_response, = await asyncio.gather(request_summary(), return_exceptions=True)
+                angle_results = await asyncio.gather(*angle_requests, return_exceptions=True)
+            else:
+                # 摘要和各个角度同时请求，互不等待
+                summary_response, *angle_results = await asyncio.gather(
+                    request_summary(), *angle_requests, return_exceptions=True
                 )
-                all_conversations = []
-                for angle in ANGLES:
-                    messages = [system_message, {
-                        "role": "user",
-                        "content": f"提问角度：{angle}"
-                    }]
-                    
-                    response_json = await openai_service.request_json(
-                        messages=messages,
-                        temp=0.7,
-                        validator_callback=validate_response,
-                    )
-                    # 合并所有角度的对话
-                    all_conversations.extend(response_json["conversations"])
-                
-                # print("all_conversations", all_conversations)
-                # 返回合并后的结果
-                # 直接修改 all_conversations 中的数据
-                for conv_pair in all_conversations:
-                    for conv in conv_pair:
-                        # 过滤value中的特定字符串
-                        conv["value"] = conv["value"]\
-                            .replace("在章节中", "")\
-                            .replace("章节中", "")\
-                            .replace("在《道诡异仙》中", "")\
-                            .replace("在《道诡异仙》的", "")\
-                            .replace("《道诡异仙》中", "")\
-                            .replace("《道诡异仙》的", "")
-                
-                response_json = {
-                    "summary": summary_response,
-                    "conversations": all_conversations
-                }
-                response_json["chapter"] = index  # 添加章节索引
-                return response_json
-            except Exception as e:
-                print(f"Error processing chapter {index}: {str(e)}")
-                return None
 
-    # 创建所有章节的处理任务
-    for index, chapter in enumerate(chapters):
-        tasks.append(process_chapter(index, chapter))
-        
-    # 并行执行所有任务
-    results = await asyncio.gather(*tasks)
-    # 过滤掉失败的结果
-    return [result for result in results if result is not None]
+            if isinstance(summary_response, Exception):
+                print(f"第 {index + 1} 章摘要失败: {str(summary_response)}")
+                summary_response = None
+
+            all_conversations = []
+            for label, result in zip(labels, angle_results):
+                if isinstance(result, Exception):
+                    print(f"第 {index + 1} 章提问角度「{label}」失败: {str(result)}")
+                    continue
+                # 合并所有角度的对话
+                all_conversations.extend(result)
 
-async def summarize_qa_and_save(novel_path: str, conv_output_path: str, summary_output_path: str, openai_service: OpenAIHandler, force: bool = False):
+            if summary_response is None and not all_conversations:
+                return None
+            
+            # print("all_conversations", all_conversations)
+            # 返回合并后的结果
+            # 直接修改 all_conversations 中的数据
+            for conv_pair in all_conversations:
+                for conv in conv_pair:
+                    # 过滤value中的特定字符串
+                    conv["value"] = conv["value"]\
+                        .replace("在章节中", "")\
+                        .replace("章节中", "")\
+                        .replace("在《道诡异仙》中", "")\
+                        .replace("在《道诡异仙》的", "")\
+                        .replace("《道诡异仙》中", "")\
+                        .replace("《道诡异仙》的", "")
+            
+            response_json = {
+                "summary": summary_response,
+                "conversations": all_conversations
+            }
+            response_json["chapter"] = index  # 添加章节索引
+            response_json["chapter_number"] = number
+            return response_json
+        except Exception as e:
+            print(f"Error processing chapter {index}: {str(e)}")
+            return None
+
+    # 有界工作队列按需取章节，每章同时发出摘要和各个角度的请求，结果按章节顺序收集
+    results = []
+
+    def collect(index: int, result):
+        # 过滤掉失败的结果
+        if result is not None:
+            results.append(result)
+
+    await run_queue(
+        enumerate(chapters),
+        lambda entry: process_chapter(entry[0], entry[1], chapter_unit_maps[entry[0]]),
+        sink=collect,
+        concurrency=concurrency or openai_service.worker_concurrency(1 + (1 if combined_angles else len(ANGLES))),
+        ordered=True,
+    )
+    return results
+
+async def summarize_qa_and_save(novel_path: str, conv_output_path: str, summary_output_path: str, openai_service: OpenAIHandler, force: bool = False, combined_angles: bool = False, warm_prefix: bool = False, checkpoint_path: str = None, dry_run: bool = False):
     """
     总结小说内容并保存为两个JSON文件
     :param novel_path: 小说文件路径
     :param conv_output_path: 对话数据集输出路径
     :param summary_output_path: 总结数据集输出路径
     :param openai_service: OpenAI服务实例
-    :param force: 是否强制重新生成，即使文件已存在
+    :param force: 是否强制重新生成全部内容(清空断点)
+    :param combined_angles: 是否在一次请求中生成所有提问角度的问答
+    :param warm_prefix: 是否先请求摘要预热前缀缓存，再请求各个角度
+    :param checkpoint_path: 断点路径，默认 .cache/checkpoints/<对话数据集文件名>.jsonl，中断后重新运行只请求缺失或失败的部分，
+                            章节内容、提示词、模型或温度变化时只重新生成受影响的 (章节, 摘要/角度)，再用断点中的结果重建输出文件
+    :param dry_run: 只打印需要重新生成的计划，不发请求
     """
+    checkpoint_path = checkpoint_path or default_checkpoint_path(conv_output_path)
     try:
-        # 如果文件已存在且不强制重新生成，则跳过
-        if os.path.exists(conv_output_path) and os.path.exists(summary_output_path) and not force:
-            print(f"文件 {conv_output_path} 和 {summary_output_path} 已存在，跳过生成")
-            return
-        
-        # 获取所有章节内容
-        chapters = extract_chapters(novel_path)
-        
-        # 随机选择一个起始索引，确保能取到连续3章
-        # start_index = random.randint(0, len(chapters) - 20)
-        # 获取连续3章内容
-        # summarized_data = await summarize_qa(chapters[start_index:start_index+20], openai_service)
-        # 调用总结函数（全量）
-        summarized_data = await summarize_qa(chapters, openai_service)
+        # 获取所有章节，内容在请求时才从映射的文件中读取；每个摘要/角度完成后立即写入断点
+        with Checkpoint(checkpoint_path) as checkpoint, ChapterStore.open(novel_path) as chapters:
+            if force and not dry_run:
+                checkpoint.clear()
+            plan = await summarize_qa(chapters[:], openai_service, combined_angles=combined_angles, checkpoint=checkpoint, plan_only=True)
+            print(plan.format_report())
+            if dry_run:
+                return
+            if os.path.exists(conv_output_path) and os.path.exists(summary_output_path) and not force:
+                if not len(checkpoint):
+                    # 没有断点时无法判断已有文件是否过期(如旧版本生成的文件)，保持跳过
+                    print(f"文件 {conv_output_path} 和 {summary_output_path} 已存在且没有断点，跳过生成，需要重新生成请使用 force")
+                    return
+                if not plan.stale:
+                    print(f"文件 {conv_output_path} 和 {summary_output_path} 已是最新，跳过生成")
+                    # 更新修改时间，否则流水线会因为输入(如 services/novel.py)更新而每次都重新执行本阶段和下游阶段
+                    os.utime(conv_output_path)
+                    os.utime(summary_output_path)
+                    return
+            # 随机选择一个起始索引，确保能取到连续3章
+            # start_index = random.randint(0, len(chapters) - 20)
+            # 获取连续3章内容
+            # summarized_data = await summarize_qa(chapters[start_index:start_index+20], openai_service, checkpoint=checkpoint)
+            # 调用总结函数（全量）
+            summarized_data = await summarize_qa(chapters[:], openai_service, combined_angles=combined_angles, warm_prefix=warm_prefix, checkpoint=checkpoint)
+            # 清理不再对应任何工作单元的旧记录
+            checkpoint.compact(unit.key for unit in plan.units)
 
         # 创建datasets目录（如果不存在）
         os.makedirs(os.path.dirname(conv_output_path), exist_ok=True)
@@ -449,15 +651,20 @@ async def summarize_qa_and_save(novel_path: str, conv_output_path: str, summary_
             for conv_group in item["conversations"]:
                 conv_data.append({
                     "conversations": conv_group,  # 每组对话作为一个独立条目
-                    "chapter": item["chapter"]    # 保留章节信息
+                    "chapter": item["chapter"],   # 保留章节信息
+                    "chapter_number": item["chapter_number"]
                 })
         
         # 处理总结数据集
         summary_data = []
         for item in summarized_data:
+            # 摘要请求失败的章节只保留问答
+            if item["summary"] is None:
+                continue
             summary_data.append({
                 "summary": item["summary"],
-                "chapter": item["chapter"]
+                "chapter": item["chapter"],
+                "chapter_number": item["chapter_number"]
             })
         
         # 保存对话数据集
@@ -468,8 +675,13 @@ async def summarize_qa_and_save(novel_path: str, conv_output_path: str, summary_
         with open(summary_output_path, "w", encoding="utf-8") as f:
             json.dump(summary_data, f, ensure_ascii=False, indent=2)
         
+    except asyncio.CancelledError:
+        print(f"已中断，已完成的结果保存在断点 {checkpoint_path}，重新运行会从断点继续")
+        raise
     except Exception as e:
+        # 继续抛出，流水线据此把本阶段标记为失败，不再执行依赖它的下游阶段
         print(f"Error: {str(e)}")
+        raise
 
 
 
@@ -1,24 +1,145 @@
 import asyncio
 import json
+import math
+import time
 import aiohttp
 
+from services.cache import ResponseCache
+from services.endpoints import Endpoint, EndpointPool
+from services.limiter import AdaptiveLimiter, RateLimiter
+from services.metrics import MetricsRecorder, merge_usage
+from services.retry import (
+    APIConnectionError,
+    APIError,
+    BadRequestError,
+    RateLimitError,
+    ResponseValidationError,
+    RetryPolicy,
+    ServerError,
+    error_for_status,
+    parse_retry_after,
+)
+from services.tokens import estimate_messages_tokens
+
 class OpenAIHandler:
-    def __init__(self, model: str, openai_url: str, openai_key: str, max_retries: int = 5, retry_delay: float = 1.0):
+    is_batch = False
+
+    def __init__(self, model: str, openai_url: str = None, openai_key: str = None, max_retries: int = 5, retry_delay: float = 1.0,
+                 pool_limit: int = 200, pool_limit_per_host: int = 200, keepalive_timeout: float = 60.0,
+                 dns_cache_ttl: int = 300, timeout: float = 60.0, cache: ResponseCache = None,
+                 cache_bypass: bool = False, limiter: AdaptiveLimiter = None, rate_limiter: RateLimiter = None,
+                 expected_completion_tokens: int = 1024, retry_policy: RetryPolicy = None, endpoints: list = None,
+                 metrics: MetricsRecorder = None):
         """
         初始化 OpenAIHandler
+
+        连接池在第一次请求时惰性创建并在多次请求间复用，用完后需调用 close()，
+        或者直接 `async with OpenAIHandler(...) as handler:` 使用
         
         Args:
             model: 默认模型名称
-            openai_url: OpenAI API 地址
-            openai_key: OpenAI API 密钥
-            max_retries: 最大重试次数，默认5次
-            retry_delay: 初始重试延迟(秒)，默认1秒
+            openai_url: OpenAI API 地址(未指定 endpoints 时使用)
+            openai_key: OpenAI API 密钥(未指定 endpoints 时使用)
+            max_retries: 最大重试次数，默认5次(未指定 retry_policy 时生效)
+            retry_delay: 初始重试延迟(秒)，默认1秒(未指定 retry_policy 时生效)
+            pool_limit: 连接池总连接数上限，默认200
+            pool_limit_per_host: 单个主机的连接数上限，默认200
+            keepalive_timeout: 空闲连接保活时间(秒)，默认60秒
+            dns_cache_ttl: DNS 缓存时间(秒)，默认300秒
+            timeout: 单次请求超时时间(秒)，默认60秒
+            cache: 可选的响应缓存，命中时直接返回缓存内容而不请求网络
+            cache_bypass: 为True时跳过缓存读取(仍会写入新结果)，用于强制刷新
+            limiter: 可选的自适应并发限制器，默认初始并发50、上限为 pool_limit_per_host(未指定 endpoints 时使用)
+            rate_limiter: 可选的 RPM/TPM 限速器，发送前预扣估算的 token 数(未指定 endpoints 时使用)
+            expected_completion_tokens: 预扣时为每次请求预留的 completion token 数，默认1024
+            retry_policy: 可选的重试策略，默认按 max_retries/retry_delay 做指数退避 + 全抖动
+            endpoints: 可选的 Endpoint 列表，指定后请求会在多个地址/密钥间负载均衡，每个端点有独立的
+                并发限制、限速和熔断
+            metrics: 可选的指标记录器，记录每次调用的延迟、token 用量、重试次数和费用
         """
         self.model = model
         self.openai_url = openai_url
         self.openai_key = openai_key
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+        self.cache = cache
+        self.cache_bypass = cache_bypass
+        if not endpoints:
+            endpoints = [Endpoint(
+                openai_url,
+                openai_key,
+                max_concurrency=pool_limit_per_host,
+                limiter=limiter,
+                rate_limiter=rate_limiter,
+            )]
+        self.pool = EndpointPool(endpoints)
+        self.metrics = metrics
+        self.expected_completion_tokens = expected_completion_tokens
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=max_retries, base_delay=retry_delay)
+        self._session = None
+
+    async def __aenter__(self):
+        await self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """
+        获取共享的 ClientSession，不存在或已关闭时重新创建
+
+        Returns:
+            aiohttp.ClientSession: 带连接池的会话
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        """
+        关闭共享会话并释放连接池，提交响应缓存中累计的访问时间
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self.cache is not None:
+            self.cache.flush()
+
+    @property
+    def concurrency_limit(self) -> int:
+        """当前自适应并发上限(所有端点之和)"""
+        return self.pool.concurrency_limit
+
+    def worker_concurrency(self, requests_per_item: int = 1) -> int:
+        """
+        上游工作队列(services.workqueue)建议的并发数：刚好能让所有端点的并发上限跑满，
+        再多的输入只会在限制器前排队占用内存
+
+        Args:
+            requests_per_item: 每个输入同时发出的请求数，如一章同时请求摘要和4个提问角度为5
+
+        Returns:
+            int: 并发数
+        """
+        total = sum(endpoint.limiter.max_limit for endpoint in self.pool.endpoints)
+        return max(1, math.ceil(total / requests_per_item))
+
     def get_config(self) -> dict:
         """
         获取当前配置
@@ -32,7 +153,8 @@ class OpenAIHandler:
             "openai_key": self.openai_key,
         }
 
-    async def request(self, messages: list, model: str = None, temp: float = 0.7, validator_callback=None, seed: int = 0) -> str:
+    async def request(self, messages: list, model: str = None, temp: float = 0.7, validator_callback=None, seed: int = 0,
+                      use_cache: bool = True, tag: str = None) -> str:
         """
         异步发送请求到OpenAI API
         
@@ -42,23 +164,17 @@ class OpenAIHandler:
             temp: 温度参数,控制随机性,默认0.7
             validator_callback: 可选的验证回调函数 (对响应内容进行验证)
             seed: 随机种子,默认为0表示不设置
+            use_cache: 是否使用响应缓存,默认True
+            tag: 指标标签，标记请求属于哪个流水线阶段
             
         Returns:
             str: OpenAI的响应文本
             
         Raises:
-            Exception: 当API调用失败或验证失败时抛出异常
+            APIError: 当API调用失败或验证失败时抛出异常
         """
-        url = f"{self.openai_url}/v1/chat/completions"
-        model = model or self.model
-        
-        headers = {
-            "Authorization": f"Bearer {self.openai_key}",
-            "Content-Type": "application/json"
-        }
-        
         data = {
-            "model": model,
+            "model": model or self.model,
             "messages": messages,
             "temperature": temp
         }
@@ -66,32 +182,16 @@ class OpenAIHandler:
         # 如果设置了seed，则添加到请求数据中
         if seed != 0:
             data["seed"] = seed
-        
-        retry_delay = self.retry_delay
-        
-        async with aiohttp.ClientSession() as session:
-            for attempt in range(self.max_retries):
-                try:
-                    async with session.post(url, headers=headers, json=data, timeout=60) as response:
-                        result = await response.json()
-
-                        if "error" in result:
-                            raise Exception(f"OpenAI API错误: {result['error']}")
 
-                        content = result["choices"][0]["message"]["content"]
+        def parse(content: str) -> str:
+            if validator_callback:
+                validator_callback(content)
+            return content
 
-                        if validator_callback:
-                            validator_callback(content)
+        return await self._chat(data, parse, use_cache, "openai request", "请求OpenAI失败", tag)
 
-                        return content
-
-                except Exception as e:
-                    print(f"openai request 第 {attempt + 1} 次重试，错误信息: {str(e)}")
-                    if attempt == self.max_retries - 1:  # 最后一次重试
-                        raise Exception(f"请求OpenAI失败(重试{self.max_retries}次): {str(e)}")
-                    await asyncio.sleep(retry_delay)
-
-    async def request_json(self, messages: list, model: str = None, temp: float = 0.7, validator_callback=None, seed: int = 0) -> dict:
+    async def request_json(self, messages: list, model: str = None, temp: float = 0.7, validator_callback=None, seed: int = 0,
+                           use_cache: bool = True, tag: str = None) -> dict:
         """
         异步发送JSON模式的请求到OpenAI API
         
@@ -101,23 +201,17 @@ class OpenAIHandler:
             temp: 温度参数,控制随机性,默认0.7
             validator_callback: 可选的JSON验证回调函数
             seed: 随机种子,默认为0表示不设置
+            use_cache: 是否使用响应缓存,默认True
+            tag: 指标标签，标记请求属于哪个流水线阶段
             
         Returns:
             dict: OpenAI的JSON响应
             
         Raises:
-            Exception: 当API调用失败或JSON验证失败时抛出异常
+            APIError: 当API调用失败或JSON验证失败时抛出异常
         """
-        url = f"{self.openai_url}/v1/chat/completions"
-        model = model or self.model
-        
-        headers = {
-            "Authorization": f"Bearer {self.openai_key}",
-            "Content-Type": "application/json"
-        }
-        
         data = {
-            "model": model,
+            "model": model or self.model,
             "messages": messages,
             "temperature": temp,
             "response_format": { "type": "json_object" }
@@ -126,33 +220,250 @@ class OpenAIHandler:
         # 如果设置了seed，则添加到请求数据中
         if seed != 0:
             data["seed"] = seed
+
+        def parse(json_response_str: str) -> dict:
+            try:
+                json_response = json.loads(json_response_str)
+            except json.JSONDecodeError as e:
+                raise Exception(f"解析 OpenAI JSON 响应失败: {str(e)}: {json_response_str}")
+
+            # 如果提供了验证回调,则进行验证
+            if validator_callback:
+                validator_callback(json_response)
+
+            return json_response
+
+        return await self._chat(data, parse, use_cache, "openai json request", "请求OpenAI JSON失败", tag)
+
+    async def _chat(self, data: dict, parse, use_cache: bool, log_prefix: str, error_prefix: str, tag: str = None):
+        """
+        发送 chat completions 请求，负责缓存读写、重试和指标记录
+
+        Args:
+            data: 请求体
+            parse: 解析并校验响应文本的函数，校验失败时抛出异常
+            use_cache: 是否使用响应缓存
+            log_prefix: 重试日志前缀
+            error_prefix: 最终失败时的错误信息前缀
+            tag: 指标标签
+
+        Returns:
+            parse 的返回值
+        """
+        start = time.monotonic()
+        cache_key, hit, parsed = self._cache_lookup(data, parse, use_cache, log_prefix)
+        if hit:
+            self._record(tag, data, "cache_hit", time.monotonic() - start, {})
+            return parsed
+
+        trace = {"usage": {}, "ttfb": None, "attempts": 0}
+        outcome = "ok"
+        try:
+            return await self._chat_attempts(data, parse, cache_key, log_prefix, error_prefix, trace)
+        except APIError as e:
+            outcome = type(e.__cause__ or e).__name__
+            raise
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            self._record(tag, data, outcome, time.monotonic() - start, trace)
+
+    def _record(self, tag: str, data: dict, outcome: str, latency: float, trace: dict):
+        if self.metrics is None:
+            return
+        self.metrics.record(
+            stage=tag,
+            # 端点可能覆盖模型名称，按实际请求的模型统计和计费
+            model=trace.get("model") or data["model"],
+            outcome=outcome,
+            latency=latency,
+            ttfb=trace.get("ttfb"),
+            retries=max(0, trace.get("attempts", 0) - 1),
+            usage=trace.get("usage"),
+            batch=self.is_batch,
+        )
+
+    async def _chat_attempts(self, data: dict, parse, cache_key: str, log_prefix: str, error_prefix: str, trace: dict):
+        """
+        按重试策略逐次尝试，直到拿到通过校验的响应
+
+        Args:
+            data: 请求体
+            parse: 解析并校验响应文本的函数
+            cache_key: 缓存键，None 表示不写缓存
+            log_prefix: 重试日志前缀
+            error_prefix: 最终失败时的错误信息前缀
+            trace: 记录尝试次数、累计 usage、首字节时间和实际请求的模型的字典
+
+        Returns:
+            parse 的返回值
+        """
+        policy = self.retry_policy
+        temperature = data["temperature"]
+        validation_failures = 0
+        estimated_tokens = estimate_messages_tokens(data["messages"]) + self.expected_completion_tokens
         
-        retry_delay = self.retry_delay
-        
-        async with aiohttp.ClientSession() as session:
-            for attempt in range(self.max_retries):
+        session = await self._get_session()
+        attempt = 0
+        while True:
+            endpoint, probe = await self.pool.acquire()
+            trace["attempts"] += 1
+            try:
+                content = await self._send(session, endpoint, data, estimated_tokens, trace)
                 try:
-                    async with session.post(url, headers=headers, json=data, timeout=60) as response:
-                        result = await response.json()
+                    parsed = parse(content)
+                except Exception as e:
+                    raise ResponseValidationError(str(e)) from e
 
-                        if "error" in result:
-                            raise Exception(f"OpenAI API错误: {result['error']}")
+                # 只缓存通过校验的响应
+                if cache_key is not None:
+                    self.cache.set(cache_key, content)
 
-                        json_response_str = result["choices"][0]["message"]["content"]
+                return parsed
 
-                        try:
-                            json_response = json.loads(json_response_str)
+            except APIError as e:
+                print(f"{log_prefix} [{endpoint.name}] 第 {attempt + 1} 次请求失败，{type(e).__name__}: {str(e)}")
+                if not policy.should_retry(e, attempt):
+                    raise APIError(f"{error_prefix}(重试{attempt + 1}次): {str(e)}", e.status) from e
 
-                            # 如果提供了验证回调,则进行验证
-                            if validator_callback:
-                                validator_callback(json_response)
+                if isinstance(e, ResponseValidationError):
+                    validation_failures += 1
+                    data = {**data, "temperature": policy.get_temperature(temperature, validation_failures)}
+                delay = policy.get_delay(e, attempt)
 
-                            return json_response
-                        except json.JSONDecodeError as e:
-                            raise Exception(f"解析 OpenAI JSON 响应失败: {str(e)}: {json_response_str}")
+            finally:
+                await self.pool.release(endpoint, probe)
 
-                except Exception as e:
-                    print(f"openai json request 第 {attempt + 1} 次重试，错误信息: {str(e)}")
-                    if attempt == self.max_retries - 1:  # 最后一次重试
-                        raise Exception(f"请求OpenAI JSON失败(重试{self.max_retries}次): {str(e)}")
-                    await asyncio.sleep(retry_delay)
+            # 先归还端点名额再等待，退避期间不占用并发
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _cache_lookup(self, data: dict, parse, use_cache: bool, log_prefix: str):
+        """
+        查询响应缓存
+
+        Args:
+            data: 请求体
+            parse: 解析并校验响应文本的函数
+            use_cache: 是否使用响应缓存
+            log_prefix: 日志前缀
+
+        Returns:
+            tuple: (缓存键, 是否命中, 命中时 parse 的返回值)；不使用缓存时缓存键为 None
+        """
+        if self.cache is None or not use_cache:
+            return None, False, None
+
+        cache_key = ResponseCache.make_key(
+            data["model"], data["messages"], data["temperature"], data.get("seed", 0), data.get("response_format")
+        )
+        cached = None if self.cache_bypass else self.cache.get(cache_key)
+        if cached is not None:
+            try:
+                return cache_key, True, parse(cached)
+            except Exception as e:
+                # 缓存内容不再通过校验(例如校验规则变了)，丢弃后重新请求
+                print(f"{log_prefix} 缓存内容校验失败，重新请求: {str(e)}")
+                self.cache.delete(cache_key)
+        return cache_key, False, None
+
+    async def _send(self, session: aiohttp.ClientSession, endpoint: Endpoint, data: dict, estimated_tokens: int,
+                    trace: dict) -> str:
+        """
+        向指定端点发送一次请求，并把结果反馈给该端点的限速器、并发限制器和熔断器
+
+        Args:
+            session: 共享会话
+            endpoint: 目标端点
+            data: 请求体
+            estimated_tokens: 预扣的 token 数
+            trace: 记录累计 usage、首字节时间和实际请求的模型的字典
+
+        Returns:
+            str: 响应的 message content
+
+        Raises:
+            APIError: 请求失败时抛出对应的子类
+        """
+        url = f"{endpoint.url}/v1/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {endpoint.key}",
+            "Content-Type": "application/json"
+        }
+        if endpoint.model:
+            data = {**data, "model": endpoint.model}
+        trace["model"] = data["model"]
+
+        # 先按估算值预扣 RPM/TPM，再占用并发名额，避免排队限速时占着名额
+        reserved = await endpoint.rate_limiter.reserve(estimated_tokens) if endpoint.rate_limiter else 0
+        async with endpoint.limiter:
+            start = time.monotonic()
+            try:
+                async with session.post(url, headers=headers, json=data) as response:
+                    trace["ttfb"] = time.monotonic() - start
+                    # 429/5xx 说明服务端已过载，其余状态码视为健康响应
+                    if response.status == 429 or response.status >= 500:
+                        endpoint.limiter.on_overload()
+                    else:
+                        endpoint.limiter.on_success(time.monotonic() - start)
+                    result = await self._read_result(response)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                endpoint.limiter.on_overload()
+                endpoint.breaker.record_failure()
+                raise APIConnectionError(f"连接OpenAI失败: {type(e).__name__} {str(e)}") from e
+            except RateLimitError:
+                # 限流只说明需要降速，交给并发限制器处理，不算端点故障
+                endpoint.breaker.record_success()
+                raise
+            except BadRequestError as e:
+                # 鉴权/权限错误说明这个端点不可用，直接熔断；其他 4xx 是请求本身的问题
+                if e.status in (401, 403, 404):
+                    endpoint.breaker.record_failure(trip=True)
+                else:
+                    endpoint.breaker.record_success()
+                raise
+            except APIError:
+                endpoint.breaker.record_failure()
+                raise
+
+        endpoint.breaker.record_success()
+        endpoint.record_latency(time.monotonic() - start)
+
+        # 按实际用量结算预扣，失败的尝试同样计费，所以 usage 按所有尝试累计
+        usage = result.get("usage")
+        merge_usage(trace["usage"], usage)
+        if endpoint.rate_limiter and usage and "total_tokens" in usage:
+            endpoint.rate_limiter.settle(reserved, usage["total_tokens"])
+
+        try:
+            return result["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise ServerError(f"OpenAI 响应缺少内容: {str(result)[:200]}") from e
+
+    @staticmethod
+    async def _read_result(response: aiohttp.ClientResponse) -> dict:
+        """
+        读取响应体并按状态码分类错误，兼容非 JSON 的错误响应
+
+        Args:
+            response: aiohttp 响应
+
+        Returns:
+            dict: 解析后的响应 JSON
+
+        Raises:
+            APIError: 状态码异常、响应体不是 JSON 或包含 error 字段时抛出对应的子类
+        """
+        text = await response.text()
+        try:
+            result = json.loads(text)
+        except ValueError:
+            result = None
+
+        if response.status >= 400 or not isinstance(result, dict) or "error" in result:
+            message = result.get("error") if isinstance(result, dict) and "error" in result else text[:200]
+            status = response.status if response.status >= 400 else 500
+            raise error_for_status(status, f"OpenAI API错误: {message}", parse_retry_after(response.headers))
+
+        return result
@@ -0,0 +1,78 @@
+import itertools
+import multiprocessing
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def default_workers() -> int:
+    """
+    默认进程数：PARALLEL_WORKERS 环境变量，未配置时为 CPU 核数
+    """
+    return int(os.getenv("PARALLEL_WORKERS") or 0) or os.cpu_count() or 1
+
+
+def iter_chunks(records, chunk_size: int):
+    """
+    把可迭代对象按 chunk_size 惰性切块
+    """
+    iterator = iter(records)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_chunks(process_chunk, records, chunk_size: int = 1000, workers: int = None, stats=None,
+               **kwargs):
+    """
+    把记录按块分给进程池处理，按输入顺序逐条产出结果，合并各块的统计
+
+    process_chunk(chunk, chunk_index, **kwargs) 返回 (结果列表, 统计)，必须是模块级函数(可以被 pickle)，
+    统计按块的顺序用 stats.update 合并，可以是 Counter 或其他有 update 方法的对象。
+    需要随机数时应按 chunk_index 生成种子，这样结果与进程数、调度顺序无关，单进程和多进程的输出相同。
+
+    同时在途的块不超过 workers × 2，输入可以是生成器，内存占用与数据集大小无关。
+    只有一块或 workers 为 1 时在当前进程中执行，不启动进程池
+
+    Args:
+        process_chunk: 处理一块记录的函数
+        records: 记录的可迭代对象
+        chunk_size: 每块的记录数
+        workers: 进程数，为 None 时见 default_workers
+        stats: 合并各块统计的对象，默认为 Counter
+        kwargs: 传给 process_chunk 的参数
+
+    Yields:
+        处理后的记录
+    """
+    workers = workers or default_workers()
+    stats = stats if stats is not None else Counter()
+    chunks = iter_chunks(records, chunk_size)
+
+    first = next(chunks, None)
+    if first is None:
+        return
+    second = next(chunks, None)
+    if second is None or workers <= 1:
+        for index, chunk in enumerate(itertools.chain([first], [second] if second else [], chunks)):
+            results, chunk_stats = process_chunk(chunk, index, **kwargs)
+            stats.update(chunk_stats)
+            yield from results
+        return
+
+    # 调用方可能在线程中运行(如 asyncio.to_thread)，fork 多线程进程可能死锁，子进程使用 spawn 启动
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending = deque()
+        indexed = enumerate(itertools.chain([first, second], chunks))
+        for index, chunk in itertools.islice(indexed, workers * 2):
+            pending.append(executor.submit(process_chunk, chunk, index, **kwargs))
+        while pending:
+            results, chunk_stats = pending.popleft().result()
+            # 取走一块再提交一块，保持在途的块数
+            for index, chunk in itertools.islice(indexed, 1):
+                pending.append(executor.submit(process_chunk, chunk, index, **kwargs))
+            stats.update(chunk_stats)
+            yield from results
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import time
+
+
+def path_mtime(path: str):
+    """
+    文件的修改时间，目录取其中最新文件的修改时间(如 Dataset.save_to_disk 的输出)
+
+    Args:
+        path: 文件或目录路径
+
+    Returns:
+        float | None: 修改时间，不存在时返回 None
+    """
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    mtimes = [
+        os.path.getmtime(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    ]
+    return max(mtimes) if mtimes else None
+
+
+class Stage:
+    def __init__(self, name: str, run, inputs=(), outputs=(), after=(), always: bool = False):
+        """
+        流水线中的一个阶段
+
+        Args:
+            name: 阶段名称，也是命令行中的目标名
+            run: 无参数的协程函数
+            inputs: 输入文件，其他阶段的输出文件会自动成为依赖
+            outputs: 输出文件，全部存在且都比输入新时跳过该阶段
+            after: 额外依赖的阶段名称(没有文件关系但需要先执行的阶段)
+            always: 为True时不检查文件，每次都执行
+        """
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.always = always
+
+    def is_up_to_date(self) -> bool:
+        """
+        输出文件是否都存在且比所有输入文件新
+        """
+        if self.always or not self.outputs:
+            return False
+        output_mtimes = [path_mtime(path) for path in self.outputs]
+        if any(mtime is None for mtime in output_mtimes):
+            return False
+        input_mtimes = [mtime for mtime in (path_mtime(path) for path in self.inputs) if mtime is not None]
+        return not input_mtimes or min(output_mtimes) >= max(input_mtimes)
+
+    def __repr__(self) -> str:
+        return f"Stage({self.name!r})"
+
+
+class Pipeline:
+    def __init__(self):
+        """
+        由阶段组成的有向无环图：阶段声明输入和输出文件，依赖关系由文件自动推导，
+        互不依赖的阶段并发执行(LLM 请求共用同一个 OpenAIHandler 的并发和速率限制)，
+        总耗时接近最长的依赖链而不是所有阶段之和
+        """
+        self.stages = {}
+
+    def add(self, name: str, run, inputs=(), outputs=(), after=(), always: bool = False) -> Stage:
+        """
+        添加阶段，参数同 Stage
+
+        Returns:
+            Stage: 添加的阶段
+        """
+        if name in self.stages:
+            raise ValueError(f"阶段 {name} 已存在")
+        stage = Stage(name, run, inputs, outputs, after, always)
+        self.stages[name] = stage
+        return stage
+
+    def dependencies(self, stage: Stage) -> list:
+        """
+        阶段直接依赖的阶段名称：产出其输入文件的阶段和 after 中声明的阶段
+        """
+        producers = {}
+        for other in self.stages.values():
+            for path in other.outputs:
+                producers[os.path.normpath(path)] = other.name
+        names = list(stage.after)
+        for path in stage.inputs:
+            producer = producers.get(os.path.normpath(path))
+            if producer is not None and producer != stage.name and producer not in names:
+                names.append(producer)
+        for name in names:
+            if name not in self.stages:
+                raise ValueError(f"阶段 {stage.name} 依赖的阶段 {name} 不存在")
+        return names
+
+    def select(self, targets=None) -> list:
+        """
+        计算要执行的阶段：目标阶段及其所有上游，按拓扑顺序返回
+
+        Args:
+            targets: 目标阶段名称列表，为空时执行全部阶段
+
+        Returns:
+            list: 阶段名称列表
+        """
+        targets = list(targets or self.stages)
+        for target in targets:
+            if target not in self.stages:
+                raise ValueError(f"未知的目标 {target}，可选: {', '.join(self.stages)}")
+
+        order = []
+        visiting = set()
+
+        def visit(name: str):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"阶段 {name} 存在循环依赖")
+            visiting.add(name)
+            for dependency in self.dependencies(self.stages[name]):
+                visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+
+        for target in targets:
+            visit(target)
+        return order
+
+    async def run(self, targets=None, force: bool = False, dry_run: bool = False) -> dict:
+        """
+        执行目标阶段，每个阶段在其依赖全部完成后立即开始
+
+        上游失败时下游不执行，其他分支不受影响；全部结束后如有失败则抛出异常
+
+        Args:
+            targets: 目标阶段名称列表，为空时执行全部阶段
+            force: 为True时忽略文件时间，全部执行
+            dry_run: 只打印执行计划(依赖关系和是否已是最新)，不执行
+
+        Returns:
+            dict: {阶段名称: ok / skipped / failed / blocked}
+        """
+        names = self.select(targets)
+        if dry_run:
+            for name in names:
+                stage = self.stages[name]
+                dependencies = self.dependencies(stage)
+                state = "最新" if stage.is_up_to_date() and not force else "需要执行"
+                print(f"[pipeline] {name}: {state}" + (f"，依赖 {', '.join(dependencies)}" if dependencies else ""))
+            return {}
+
+        results = {}
+        tasks = {}
+        started_at = time.monotonic()
+
+        async def run_stage(name: str):
+            stage = self.stages[name]
+            dependencies = self.dependencies(stage)
+            if dependencies:
+                await asyncio.gather(*(tasks[dependency] for dependency in dependencies))
+            blocked = [dependency for dependency in dependencies if results[dependency] in ("failed", "blocked")]
+            if blocked:
+                print(f"[pipeline] {name}: 上游 {', '.join(blocked)} 失败，跳过")
+                results[name] = "blocked"
+                return
+            if not force and stage.is_up_to_date():
+                print(f"[pipeline] {name}: 输出已是最新，跳过")
+                results[name] = "skipped"
+                return
+
+            print(f"[pipeline] {name}: 开始")
+            stage_started_at = time.monotonic()
+            try:
+                await stage.run()
+                missing = [path for path in stage.outputs if not os.path.exists(path)]
+                if missing:
+                    raise Exception(f"没有生成输出文件 {', '.join(missing)}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[pipeline] {name}: 失败，{type(e).__name__}: {str(e)}")
+                results[name] = "failed"
+                return
+            results[name] = "ok"
+            print(f"[pipeline] {name}: 完成，耗时 {time.monotonic() - stage_started_at:.1f}s")
+
+        # 按拓扑顺序创建任务，保证依赖的任务已经存在
+        for name in names:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        print(f"[pipeline] 全部结束，耗时 {time.monotonic() - started_at:.1f}s，"
+              + "，".join(f"{name} {state}" for name, state in results.items()))
+        failed = [name for name, state in results.items() if state == "failed"]
+        if failed:
+            raise Exception(f"阶段 {', '.join(failed)} 执行失败")
+        return results
@@ -0,0 +1,157 @@
+import hashlib
+from collections import Counter, defaultdict
+
+# 指纹中的各个字段，比较时按此顺序给出第一个变化的原因
+FINGERPRINT_FIELDS = {
+    "chapter": "章节内容变化",
+    "prompt": "提示词变化",
+    "model": "模型变化",
+    "temperature": "温度变化",
+}
+
+
+def hash_text(text: str) -> str:
+    """
+    计算文本的哈希，用于提示词模板等
+
+    Args:
+        text: 文本
+
+    Returns:
+        str: 16 位十六进制哈希
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def chapter_hash(chapter) -> str:
+    """
+    章节内容的哈希：Chapter 直接使用索引中记录的 sha1(不读取正文)，字符串现算
+
+    Args:
+        chapter: ChapterStore 中的 Chapter 或章节内容字符串
+
+    Returns:
+        str: sha1 十六进制哈希
+    """
+    if isinstance(chapter, str):
+        return hashlib.sha1(chapter.encode("utf-8")).hexdigest()
+    return chapter.sha1
+
+
+def make_fingerprint(chapter, template: str, model: str, temperature: float) -> dict:
+    """
+    计算一个工作单元的输入指纹，任一字段变化时该单元的结果即视为过期
+
+    Args:
+        chapter: Chapter 或章节内容字符串
+        template: 除章节内容外的全部提示词(系统提示、任务说明、提问角度等)
+        model: 模型名称
+        temperature: 温度
+
+    Returns:
+        dict: {chapter, prompt, model, temperature}
+    """
+    return {
+        "chapter": chapter_hash(chapter),
+        "prompt": hash_text(template),
+        "model": model,
+        "temperature": temperature,
+    }
+
+
+def stale_reason(record: dict, fingerprint: dict):
+    """
+    判断断点记录相对当前指纹是否过期
+
+    Args:
+        record: 断点中的记录，没有时为 None
+        fingerprint: 当前的指纹
+
+    Returns:
+        str | None: 过期原因(missing、legacy 或变化的字段名)，未过期时返回 None
+    """
+    if record is None:
+        return "missing"
+    previous = record.get("fingerprint")
+    if not previous:
+        return "legacy"
+    for field in FINGERPRINT_FIELDS:
+        if previous.get(field) != fingerprint.get(field):
+            return field
+    return None
+
+
+class WorkUnit:
+    __slots__ = ("key", "stage", "chapter_number", "angle", "fingerprint")
+
+    def __init__(self, key: str, stage: str, chapter_number: int, fingerprint: dict, angle: str = None):
+        """
+        一次 LLM 请求对应的工作单元，如某章的摘要或某章某个角度的问答
+
+        Args:
+            key: 断点中的标识，如 summary:12、qa:12:3fa9c0d1，章节号重复时为 summary:12#305
+            stage: 阶段，如 dialogue、summary、qa
+            chapter_number: 章节号，只用于展示，可能重复
+            fingerprint: 输入指纹，见 make_fingerprint
+            angle: 提问角度名称，其他阶段为 None
+        """
+        self.key = key
+        self.stage = stage
+        self.chapter_number = chapter_number
+        self.fingerprint = fingerprint
+        self.angle = angle
+
+    def __repr__(self) -> str:
+        return f"WorkUnit(key={self.key!r}, stage={self.stage!r})"
+
+
+class Plan:
+    def __init__(self, units: list, checkpoint):
+        """
+        对比断点中的记录和当前指纹，找出需要重新生成的最小工作单元集合
+
+        Args:
+            units: WorkUnit 列表，key 必须唯一
+            checkpoint: 断点，为 None 时所有单元都需要生成
+
+        Raises:
+            Exception: key 重复，多个单元会在断点中互相覆盖
+        """
+        duplicates = [key for key, count in Counter(unit.key for unit in units).items() if count > 1]
+        if duplicates:
+            raise Exception(f"工作单元 key 重复: {', '.join(duplicates[:5])}")
+        self.units = units
+        self.stale = {}
+        for unit in units:
+            record = checkpoint.get(unit.key) if checkpoint is not None else None
+            reason = stale_reason(record, unit.fingerprint)
+            if reason is not None:
+                self.stale[unit.key] = reason
+
+    def is_stale(self, key: str) -> bool:
+        """
+        该单元是否需要重新生成
+        """
+        return key in self.stale
+
+    def format_report(self) -> str:
+        """
+        按阶段汇总的计划，如 `[plan] qa: 共 400 个单元，最新 300 个，需要生成 100 个(缺失 96，章节内容变化 4)`
+        """
+        totals = Counter()
+        reasons = defaultdict(Counter)
+        for unit in self.units:
+            stage = f"{unit.stage}:{unit.angle}" if unit.angle else unit.stage
+            totals[stage] += 1
+            if unit.key in self.stale:
+                reasons[stage][self.stale[unit.key]] += 1
+
+        names = {"missing": "缺失", "legacy": "缺少指纹", **FINGERPRINT_FIELDS}
+        lines = []
+        for stage, total in totals.items():
+            stale = sum(reasons[stage].values())
+            line = f"[plan] {stage}: 共 {total} 个单元，最新 {total - stale} 个，需要生成 {stale} 个"
+            if stale:
+                line += "(" + "，".join(f"{names[reason]} {count}" for reason, count in reasons[stage].items()) + ")"
+            lines.append(line)
+        return "\n".join(lines) if lines else "[plan] 没有工作单元"
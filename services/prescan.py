@@ -0,0 +1,180 @@
+import json
+import os
+import re
+from collections import Counter
+
+# 主角的称呼，与 summarize_chapters 提示词中的别名一致，长的在前保证「李火旺」不会先被「火旺」匹配
+PROTAGONIST_ALIASES = ("李火旺", "李师兄", "火旺", "红中", "耳玖")
+
+# 其他角色，取自 summarize_chapters 提示词中的角色关系
+OTHER_CHARACTERS = (
+    "李建成", "孙晓琴", "杨娜", "王韦", "易东来", "吴成", "清旺来", "钱福", "陈红瑜", "赵雷", "赵霜点",
+    "巴楠旭", "巴晟清", "五琦", "狗娃", "白灵淼", "赵五", "高志坚", "春小满", "杨小孩", "李岁", "吕秀才", "诸葛渊",
+)
+
+# 成对的引号，不跨行，过长的视为引号不配对
+_QUOTE_PATTERN = re.compile(r"“([^“”\n]{1,500})”|「([^「」\n]{1,500})」|\"([^\"\n]{1,500})\"")
+_ALIAS_PATTERN = re.compile("|".join(PROTAGONIST_ALIASES))
+_NAME_PATTERN = re.compile("|".join(PROTAGONIST_ALIASES + OTHER_CHARACTERS))
+# 说话人归属只看引号前后同一句中的文字，遇到句末标点或其他引语为止
+_SENTENCE_BREAK = re.compile(r"[。！？!?\n“”「」\"]")
+_ATTRIBUTION_WINDOW = 30
+
+# 决策对应的模型名称占位，写入指纹后关闭预扫描或调整阈值时被跳过的章节会重新生成
+SKIPPED_MODEL = "prescan:skip"
+
+
+def extract_quotes(text: str) -> list:
+    """
+    提取引号中的话
+
+    Args:
+        text: 章节内容
+
+    Returns:
+        list: [(起始位置, 结束位置, 引号中的内容), ...]，位置包含引号本身
+    """
+    return [
+        (match.start(), match.end(), next(group for group in match.groups() if group is not None))
+        for match in _QUOTE_PATTERN.finditer(text)
+    ]
+
+
+def attribute_speaker(text: str, start: int, end: int) -> str:
+    """
+    推测一段引语的说话人：引号前同一句中第一个出现的角色(一般是主语，如「李火旺看着杨娜说：」)，
+    没有时取引号后同一句中的第一个角色(如「……”李火旺道。」)
+
+    Args:
+        text: 章节内容
+        start: 引号起始位置
+        end: 引号结束位置
+
+    Returns:
+        str: protagonist / other / unknown
+    """
+    before = text[max(0, start - _ATTRIBUTION_WINDOW):start]
+    breaks = list(_SENTENCE_BREAK.finditer(before))
+    if breaks:
+        before = before[breaks[-1].end():]
+    after = text[end:end + _ATTRIBUTION_WINDOW]
+    match = _SENTENCE_BREAK.search(after)
+    if match:
+        after = after[:match.start()]
+
+    for window in (before, after):
+        name = _NAME_PATTERN.search(window)
+        if name:
+            return "protagonist" if name.group() in PROTAGONIST_ALIASES else "other"
+    return "unknown"
+
+
+class ChapterScan:
+    __slots__ = ("number", "chars", "quotes", "protagonist", "addressed", "unknown", "other", "mentions",
+                 "score", "decision", "model")
+
+    def __init__(self, number: int, chars: int, counts: Counter, mentions: int, score: float, decision: str,
+                 model: str):
+        """
+        一章的预扫描结果
+
+        Args:
+            number: 章节号
+            chars: 章节字数
+            counts: 各类引语的数量 {quotes, protagonist, addressed, unknown, other}
+            mentions: 主角称呼出现的次数
+            score: 主角说话的可能性评分
+            decision: full / cheap / skip
+            model: 请求使用的模型，跳过时为 SKIPPED_MODEL
+        """
+        self.number = number
+        self.chars = chars
+        self.quotes = counts["quotes"]
+        self.protagonist = counts["protagonist"]
+        self.addressed = counts["addressed"]
+        self.unknown = counts["unknown"]
+        self.other = counts["other"]
+        self.mentions = mentions
+        self.score = score
+        self.decision = decision
+        self.model = model
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class DialoguePrescan:
+    def __init__(self, model: str, threshold: float = 0.5, cheap_model: str = None):
+        """
+        对话提取前的本地预扫描：提取引语并按主角别名推测说话人，给每章打分，
+        低于阈值的章节不再发送全文给模型(跳过，或者配置了 cheap_model 时改用低价模型)
+
+        评分 = 归属主角的引语数 + 0.5 × (说话人不明的引语数 + 称呼主角的引语数)，
+        章节中完全没有出现主角称呼时说话人不明的引语不计分。默认阈值 0.5 只跳过没有引语、
+        主角没有出场或所有引语都明确属于其他角色的章节
+
+        Args:
+            model: 完整模型名称
+            threshold: 评分阈值
+            cheap_model: 低价模型名称，为空时低于阈值的章节直接跳过(结果为空对话)
+        """
+        self.model = model
+        self.threshold = threshold
+        self.cheap_model = cheap_model
+
+    def scan(self, number: int, text: str) -> ChapterScan:
+        """
+        扫描一章
+
+        Args:
+            number: 章节号
+            text: 章节内容
+
+        Returns:
+            ChapterScan: 扫描结果和决策
+        """
+        counts = Counter(quotes=0, protagonist=0, addressed=0, unknown=0, other=0)
+        mentions = len(_ALIAS_PATTERN.findall(text))
+        for start, end, quote in extract_quotes(text):
+            counts["quotes"] += 1
+            speaker = attribute_speaker(text, start, end)
+            counts[speaker] += 1
+            if speaker != "protagonist" and any(alias in quote for alias in PROTAGONIST_ALIASES):
+                counts["addressed"] += 1
+
+        score = counts["protagonist"] + 0.5 * counts["addressed"]
+        if mentions:
+            score += 0.5 * counts["unknown"]
+
+        if score >= self.threshold:
+            decision, model = "full", self.model
+        elif self.cheap_model:
+            decision, model = "cheap", self.cheap_model
+        else:
+            decision, model = "skip", SKIPPED_MODEL
+        return ChapterScan(number, len(text), counts, mentions, score, decision, model)
+
+    @staticmethod
+    def format_report(scans: list) -> str:
+        """
+        如 `[prescan] 共 1200 章，完整模型 900 章，低价模型 0 章，跳过 300 章(少请求 25.0%)`
+        """
+        decisions = Counter(scan.decision for scan in scans)
+        saved = (decisions["skip"] / len(scans)) if scans else 0
+        return (f"[prescan] 共 {len(scans)} 章，完整模型 {decisions['full']} 章，"
+                f"低价模型 {decisions['cheap']} 章，跳过 {decisions['skip']} 章(少请求 {saved:.1%})")
+
+    @staticmethod
+    def write_log(scans: list, path: str):
+        """
+        把每章的评分和决策写入 JSONL 日志，便于抽查被跳过的章节
+
+        Args:
+            scans: ChapterScan 列表
+            path: 日志路径
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for scan in scans:
+                f.write(json.dumps(scan.to_dict(), ensure_ascii=False) + "\n")
@@ -0,0 +1,226 @@
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+from services.chapters import detect_encoding
+from services.tokens import estimate_text_tokens
+
+# 句末标点，后面可以跟右引号/右括号
+SENTENCE_PATTERN = re.compile(r".*?[。！？!?…；;]+[”’」』\"')）]*|.+$")
+
+
+def load_tokenizer(name: str = None):
+    """
+    加载用于计算 token 数的函数
+
+    Args:
+        name: None 使用 estimate_text_tokens 粗略估算；"chars" 按字符数计算；
+              其他值作为 transformers 的模型名称或本地路径加载分词器，如 Qwen/Qwen2.5-7B-Instruct
+
+    Returns:
+        callable: 输入文本返回 token 数
+    """
+    if not name:
+        return estimate_text_tokens
+    if name == "chars":
+        return len
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        raise Exception("使用指定的分词器需要先安装 transformers: pip install transformers")
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def split_sentences(line: str) -> list:
+    """
+    按句末标点把一行切分为句子，标点和后面的引号留在句子末尾
+
+    Args:
+        line: 一行文本
+
+    Returns:
+        list: 句子列表
+    """
+    return [sentence for sentence in SENTENCE_PATTERN.findall(line) if sentence]
+
+
+def _iter_units(novel_path: str, count_tokens, target_tokens: int, snap: str):
+    """
+    逐行读取小说，产出 (文本, token 数) 作为切分的最小单位
+
+    snap 为 line 时一行是一个单位；为 sentence 时一句是一个单位，超过 target_tokens 的句子按字符硬切
+    """
+    with open(novel_path, "r", encoding=detect_encoding(novel_path), errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if snap == "line":
+                yield line, count_tokens(line)
+                continue
+            for sentence in split_sentences(line):
+                tokens = count_tokens(sentence)
+                if tokens <= target_tokens:
+                    yield sentence, tokens
+                    continue
+                parts = math.ceil(tokens / target_tokens)
+                size = math.ceil(len(sentence) / parts)
+                for start in range(0, len(sentence), size):
+                    part = sentence[start:start + size]
+                    yield part, count_tokens(part)
+
+
+def _overlap_tail(units: list, overlap: int) -> list:
+    """
+    取 units 末尾 token 数之和不超过 overlap 的若干单位，作为下一块的开头
+    """
+    tail = []
+    total = 0
+    for text, tokens in reversed(units):
+        if total + tokens > overlap:
+            break
+        tail.append((text, tokens))
+        total += tokens
+    tail.reverse()
+    return tail
+
+
+def _greedy_segments(units, target_tokens: int):
+    """
+    贪心切分：加入下一个单位后更接近目标长度就加入，否则结束当前块
+    """
+    segment = []
+    total = 0
+    for text, tokens in units:
+        if segment and abs(total + tokens - target_tokens) >= abs(total - target_tokens):
+            yield segment
+            segment = []
+            total = 0
+        segment.append((text, tokens))
+        total += tokens
+    if segment:
+        yield segment
+
+
+def _optimal_partition(units: list, target_tokens: int, max_tokens: int, final: bool = True) -> list:
+    """
+    动态规划求一组单位的最优切分，使各块长度与目标长度之差的平方和最小
+
+    Args:
+        units: (文本, token 数) 列表
+        target_tokens: 目标 token 数
+        max_tokens: 单块 token 数上限(单个单位超过上限时单独成块)
+        final: 是否是最后一组单位。不是时末尾不超过 max_tokens 的部分可以不切分，留给下一组重新计算
+
+    Returns:
+        list: 各块的边界下标，相邻两个下标之间为一块
+    """
+    sizes = np.fromiter((tokens for _, tokens in units), dtype=np.float64, count=len(units))
+    prefix = np.concatenate(([0.0], np.cumsum(sizes)))
+    cost = np.full(len(units) + 1, np.inf)
+    cost[0] = 0.0
+    back = np.zeros(len(units) + 1, dtype=np.int64)
+    for end in range(1, len(units) + 1):
+        # 块长度不超过 max_tokens，但至少包含一个单位
+        first = min(int(np.searchsorted(prefix, prefix[end] - max_tokens, side="left")), end - 1)
+        candidates = cost[first:end] + (prefix[end] - prefix[first:end] - target_tokens) ** 2
+        best = int(np.argmin(candidates))
+        cost[end] = candidates[best]
+        back[end] = first + best
+
+    end = len(units)
+    if not final:
+        first = int(np.searchsorted(prefix, prefix[end] - max_tokens, side="left"))
+        end = first + int(np.argmin(cost[first:end + 1]))
+    bounds = [end]
+    while end > 0:
+        end = int(back[end])
+        bounds.append(end)
+    bounds.reverse()
+    return bounds
+
+
+def _optimal_segments(units, target_tokens: int, block_units: int):
+    """
+    分组做最优切分：每组末尾未切分的部分并入下一组重新计算，内存只与 block_units 有关
+    """
+    max_tokens = target_tokens * 2
+    buffer = []
+    for unit in units:
+        buffer.append(unit)
+        if len(buffer) < block_units:
+            continue
+        bounds = _optimal_partition(buffer, target_tokens, max_tokens, final=False)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield buffer[start:end]
+        buffer = buffer[bounds[-1]:]
+    if buffer:
+        bounds = _optimal_partition(buffer, target_tokens, max_tokens)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield buffer[start:end]
+
+
+def iter_pretrain_chunks(novel_paths, target_tokens: int = 1200, tokenizer=None, overlap: int = 0,
+                         snap: str = "line", optimal: bool = False, block_units: int = 4096):
+    """
+    流式地把小说切分为预训练数据块，逐行读取文件，内存占用与小说大小无关
+
+    Args:
+        novel_paths: 小说文件路径或路径列表，数据块不会跨文件
+        target_tokens: 每块的目标 token 数
+        tokenizer: 计算 token 数的函数，默认 estimate_text_tokens，见 load_tokenizer
+        overlap: 相邻块之间重叠的 token 数上限(按整句/整行重叠，不计入目标长度)
+        snap: 切分位置，line 只在行尾切分；sentence 可以在句末切分，更接近目标长度
+        optimal: 为True时用动态规划求与目标长度偏差平方和最小的切分，否则贪心切分
+        block_units: 最优切分时每次计算的单位数
+
+    Yields:
+        dict: {text: string}
+    """
+    if snap not in ("line", "sentence"):
+        raise ValueError("snap 只能是 line 或 sentence")
+    count_tokens = tokenizer or estimate_text_tokens
+    if isinstance(novel_paths, str):
+        novel_paths = [novel_paths]
+
+    for novel_path in novel_paths:
+        units = _iter_units(novel_path, count_tokens, target_tokens, snap)
+        if optimal:
+            segments = _optimal_segments(units, target_tokens, block_units)
+        else:
+            segments = _greedy_segments(units, target_tokens)
+
+        previous = []
+        for segment in segments:
+            head = _overlap_tail(previous, overlap) if overlap else []
+            yield {"text": "".join(text for text, _ in head + segment)}
+            previous = segment
+
+
+def write_pretrain_jsonl(novel_paths, output_path: str, **kwargs) -> int:
+    """
+    切分小说并逐条写入 JSONL 文件，写完后再替换目标文件
+
+    Args:
+        novel_paths: 小说文件路径或路径列表
+        output_path: 输出 JSONL 文件路径
+        其余参数同 iter_pretrain_chunks
+
+    Returns:
+        int: 写入的数据块数
+    """
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for chunk in iter_pretrain_chunks(novel_paths, **kwargs):
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, output_path)
+    return count
@@ -0,0 +1,217 @@
+import math
+from collections import Counter, defaultdict
+
+from services.dedup import normalize_text
+from services.prescan import attribute_speaker, extract_quotes
+from services.tokens import estimate_text_tokens
+
+
+def tokenize(text: str) -> list:
+    """
+    检索用的分词：中文不做词典分词，去掉标点后按字切成二元组(bigram)，不足两个字时取单字
+
+    Args:
+        text: 文本
+
+    Returns:
+        list: 词项列表(含重复)
+    """
+    text = normalize_text(text)
+    if len(text) < 2:
+        return list(text)
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+def split_passages(text: str, max_chars: int = 300) -> list:
+    """
+    按行把长文本合并为不超过 max_chars 字的段落，单行超长时单独成段
+
+    Args:
+        text: 文本
+        max_chars: 每段的最大字数
+
+    Returns:
+        list: 段落列表
+    """
+    passages = []
+    current = []
+    length = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if current and length + len(line) > max_chars:
+            passages.append("\n".join(current))
+            current = []
+            length = 0
+        current.append(line)
+        length += len(line)
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+def iter_speech_passages(text: str, max_chars: int = 300, context_lines: int = 1):
+    """
+    从章节中找出主角说话的片段：含有归属主角的引语的行，连同前面 context_lines 行的上下文，相邻的片段合并
+
+    Args:
+        text: 章节内容
+        max_chars: 每个片段的最大字数，超出时截掉前面的上下文
+        context_lines: 引语前带上的行数
+
+    Yields:
+        str: 片段
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    speaking = [
+        index for index, line in enumerate(lines)
+        if any(attribute_speaker(line, start, end) == "protagonist" for start, end, _ in extract_quotes(line))
+    ]
+
+    # 合并重叠或相邻的区间
+    spans = []
+    for index in speaking:
+        start = max(0, index - context_lines)
+        if spans and start <= spans[-1][1] + 1:
+            spans[-1][1] = index
+        else:
+            spans.append([start, index])
+
+    for start, end in spans:
+        passage = "\n".join(lines[start:end + 1])
+        yield passage[-max_chars:]
+
+
+class Document:
+    __slots__ = ("id", "kind", "text", "source", "length", "tokens")
+
+    def __init__(self, id: int, kind: str, text: str, source: str = None):
+        """
+        索引中的一个文档
+
+        Args:
+            id: 文档序号
+            kind: 类型，如 note(人物、势力设定)、excerpt(小说节选)
+            text: 文档内容，检索命中后原样放进提示词
+            source: 出处，如 第12章
+        """
+        self.id = id
+        self.kind = kind
+        self.text = text
+        self.source = source
+        terms = tokenize(text)
+        self.length = len(terms)
+        self.tokens = estimate_text_tokens(text)
+
+    def __repr__(self) -> str:
+        return f"Document({self.id}, {self.kind!r}, {self.text[:20]!r})"
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        本地的 BM25 倒排索引，不依赖外部检索服务，文档和查询都按字二元组分词
+
+        Args:
+            k1: 词频饱和参数
+            b: 文档长度归一化参数
+        """
+        self.k1 = k1
+        self.b = b
+        self.documents = []
+        # 词项 -> [(文档序号, 词频), ...]
+        self.postings = defaultdict(list)
+        self.idf = {}
+        self.average_length = 0
+
+    def add(self, text: str, kind: str = "excerpt", source: str = None) -> Document:
+        """
+        添加文档，添加后需要调用 build 才能检索
+
+        Returns:
+            Document: 添加的文档
+        """
+        document = Document(len(self.documents), kind, text, source)
+        self.documents.append(document)
+        for term, frequency in Counter(tokenize(text)).items():
+            self.postings[term].append((document.id, frequency))
+        return document
+
+    def build(self) -> "BM25Index":
+        """
+        计算 idf 和平均文档长度
+        """
+        count = len(self.documents)
+        self.average_length = sum(document.length for document in self.documents) / count if count else 0
+        self.idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+        return self
+
+    def search(self, query: str, limit: int = 10, kind: str = None) -> list:
+        """
+        检索与查询最相关的文档
+
+        Args:
+            query: 查询文本
+            limit: 返回的文档数
+            kind: 只返回该类型的文档，为 None 时不限
+
+        Returns:
+            list: [(得分, Document), ...]，按得分降序
+        """
+        scores = defaultdict(float)
+        average_length = self.average_length or 1
+        for term, query_frequency in Counter(tokenize(query)).items():
+            idf = self.idf.get(term)
+            if not idf:
+                continue
+            for document_id, frequency in self.postings[term]:
+                document = self.documents[document_id]
+                if kind is not None and document.kind != kind:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * document.length / average_length)
+                scores[document_id] += query_frequency * idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores.items(), key=lambda entry: entry[1], reverse=True)[:limit]
+        return [(score, self.documents[document_id]) for document_id, score in ranked]
+
+    def select(self, query: str, token_budget: int, limits: dict = None) -> list:
+        """
+        为查询挑选上下文：各类型分别取最相关的文档，在 token 预算内按得分从高到低装入，内容重复的只取一次
+
+        Args:
+            query: 查询文本
+            token_budget: 所选文档的 token 总预算
+            limits: 每种类型最多选几个，如 {"note": 4, "excerpt": 3}，为 None 时不分类型
+
+        Returns:
+            list: 选中的 Document，同类型的排在一起，类型按 limits 的顺序
+        """
+        if limits is None:
+            limits = {None: len(self.documents)}
+
+        # 各类型取最相关的 limit 个，内容相同的文档(如小说中重复出现的台词)只取一次
+        candidates = []
+        seen = set()
+        for kind, limit in limits.items():
+            taken = 0
+            for score, document in self.search(query, limit=limit * 4, kind=kind):
+                if taken >= limit:
+                    break
+                if document.text not in seen:
+                    seen.add(document.text)
+                    candidates.append((score, document))
+                    taken += 1
+
+        selected = []
+        remaining = token_budget
+        for _, document in sorted(candidates, key=lambda entry: entry[0], reverse=True):
+            if document.tokens <= remaining:
+                selected.append(document)
+                remaining -= document.tokens
+
+        order = {kind: position for position, kind in enumerate(limits)}
+        return sorted(selected, key=lambda document: order.get(document.kind, 0))
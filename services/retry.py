@@ -0,0 +1,164 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+
+class APIError(Exception):
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        """
+        OpenAI 接口调用错误的基类
+
+        Args:
+            message: 错误信息
+            status: HTTP 状态码，没有时为 None
+            retry_after: 服务端要求的重试等待时间(秒)，没有时为 None
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RateLimitError(APIError):
+    """HTTP 429，请求过多"""
+
+
+class ServerError(APIError):
+    """HTTP 5xx/408/409 或服务端返回了无法解析的响应"""
+
+
+class APIConnectionError(APIError):
+    """连接失败或请求超时"""
+
+
+class BadRequestError(APIError):
+    """其他 4xx 错误(鉴权失败、参数错误等)，重试也不会成功"""
+
+
+class ResponseValidationError(APIError):
+    """响应内容无法解析为 JSON 或没有通过校验回调"""
+
+
+def parse_retry_after(headers) -> float:
+    """
+    从响应头中解析重试等待时间
+
+    支持 `retry-after-ms`、秒数形式和 HTTP 日期形式的 `Retry-After`
+
+    Args:
+        headers: 响应头
+
+    Returns:
+        float | None: 等待秒数，没有或无法解析时返回 None
+    """
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_for_status(status: int, message: str, retry_after: float = None) -> APIError:
+    """
+    根据 HTTP 状态码构造对应的错误类型
+
+    Args:
+        status: HTTP 状态码
+        message: 错误信息
+        retry_after: 服务端要求的重试等待时间(秒)
+
+    Returns:
+        APIError: 对应的错误实例
+    """
+    if status == 429:
+        return RateLimitError(message, status, retry_after)
+    if status >= 500 or status in (408, 409):
+        return ServerError(message, status, retry_after)
+    if status >= 400:
+        return BadRequestError(message, status, retry_after)
+    return ServerError(message, status, retry_after)
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 validation_temperatures: list = None):
+        """
+        重试策略：指数退避 + 全抖动，遵循 Retry-After，并按错误类型区别对待
+
+        - BadRequestError 直接失败，不重试
+        - ResponseValidationError 立即重试，可选地换一个温度
+        - RateLimitError/ServerError 有 Retry-After 时按其等待，否则指数退避
+        - APIConnectionError 指数退避
+
+        Args:
+            max_retries: 最大尝试次数
+            base_delay: 退避的基础延迟(秒)
+            max_delay: 退避延迟的上限(秒)
+            validation_temperatures: 校验失败后依次使用的温度，None 表示沿用原温度
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.validation_temperatures = validation_temperatures
+
+    def should_retry(self, error: Exception, attempt: int) -> bool:
+        """
+        判断是否继续重试
+
+        Args:
+            error: 本次尝试的错误
+            attempt: 本次尝试的序号(从0开始)
+
+        Returns:
+            bool: 是否重试
+        """
+        if isinstance(error, BadRequestError):
+            return False
+        return attempt + 1 < self.max_retries
+
+    def get_delay(self, error: Exception, attempt: int) -> float:
+        """
+        计算下一次重试前的等待时间
+
+        Args:
+            error: 本次尝试的错误
+            attempt: 本次尝试的序号(从0开始)
+
+        Returns:
+            float: 等待秒数
+        """
+        if isinstance(error, ResponseValidationError):
+            return 0.0
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            # 加一点抖动，避免同时被限流的请求在同一时刻一起重试
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def get_temperature(self, temperature: float, validation_failures: int) -> float:
+        """
+        计算校验失败后重试使用的温度
+
+        Args:
+            temperature: 原始温度
+            validation_failures: 已经发生的校验失败次数
+
+        Returns:
+            float: 下一次请求使用的温度
+        """
+        if not self.validation_temperatures or validation_failures <= 0:
+            return temperature
+        index = min(validation_failures, len(self.validation_temperatures)) - 1
+        return self.validation_temperatures[index]
@@ -0,0 +1,289 @@
+class SchemaError(Exception):
+    def __init__(self, path: str, reason: str):
+        """
+        响应不符合 schema
+
+        Args:
+            path: 出错位置，如 $.conversations[3][1].from
+            reason: 原因
+        """
+        super().__init__(f"{path}: {reason}")
+        self.path = path
+        self.reason = reason
+
+
+class SalvageReport:
+    def __init__(self):
+        """一次校验中可挽救数组的保留和丢弃情况"""
+        self.kept = 0
+        self.rejected = []
+
+    @property
+    def total(self) -> int:
+        return self.kept + len(self.rejected)
+
+    @property
+    def yield_rate(self) -> float:
+        """保留比例，没有可挽救的条目时为1"""
+        return self.kept / self.total if self.total else 1.0
+
+    def summary(self, limit: int = 3) -> str:
+        """
+        如 `保留 29/30，丢弃 1 条: $.conversations[7][1].from: 取值应为 ['gpt']`
+        """
+        reasons = "; ".join(str(error) for error in self.rejected[:limit])
+        more = " 等" if len(self.rejected) > limit else ""
+        return f"保留 {self.kept}/{self.total}，丢弃 {len(self.rejected)} 条: {reasons}{more}"
+
+
+def compile_spec(spec: dict):
+    """
+    把声明式的 schema 编译为校验函数，类型判断、必填字段等都在编译时展开成闭包，校验时不再解释 spec
+
+    支持的写法(JSON Schema 的一个子集)：
+        {"type": "string", "enum": [...], "min_length": 1}    min_length 按去掉首尾空白后的长度计算
+        {"type": "integer", "minimum": 1, "maximum": 10, "coerce": True}    coerce 时接受 "3" 这样的数字字符串
+        {"type": "object", "properties": {...}, "required": [...]}
+        {"type": "array", "items": {...}, "min_items": 1, "max_items": 10, "salvage": True}
+        {"type": "array", "items": [{...}, {...}]}    按位置校验的定长数组
+    salvage 为True的数组中不合格的元素会被移除并记入 SalvageReport，而不是让整个响应失败
+
+    Args:
+        spec: schema
+
+    Returns:
+        callable: check(value, path, report) -> 校验(和规范化)后的值，不合格时抛出 SchemaError
+    """
+    kind = spec["type"]
+
+    if kind == "string":
+        enum = spec.get("enum")
+        min_length = spec.get("min_length", 0)
+
+        def check_string(value, path, report):
+            if not isinstance(value, str):
+                raise SchemaError(path, "应为字符串")
+            if enum is not None and value not in enum:
+                raise SchemaError(path, f"取值应为 {enum}")
+            if min_length and len(value.strip()) < min_length:
+                raise SchemaError(path, f"长度应至少为 {min_length}")
+            return value
+        return check_string
+
+    if kind == "integer":
+        minimum = spec.get("minimum")
+        maximum = spec.get("maximum")
+        coerce = spec.get("coerce", False)
+
+        def check_integer(value, path, report):
+            if coerce and isinstance(value, str) and value.strip().isdigit():
+                value = int(value)
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise SchemaError(path, "应为整数")
+            if minimum is not None and value < minimum:
+                raise SchemaError(path, f"应不小于 {minimum}")
+            if maximum is not None and value > maximum:
+                raise SchemaError(path, f"应不大于 {maximum}")
+            return value
+        return check_integer
+
+    if kind == "object":
+        properties = [(key, compile_spec(sub)) for key, sub in spec.get("properties", {}).items()]
+        required = spec.get("required", [])
+
+        def check_object(value, path, report):
+            if not isinstance(value, dict):
+                raise SchemaError(path, "应为对象")
+            for key in required:
+                if key not in value:
+                    raise SchemaError(f"{path}.{key}", "缺少字段")
+            for key, check in properties:
+                if key in value:
+                    value[key] = check(value[key], f"{path}.{key}", report)
+            return value
+        return check_object
+
+    if kind == "array":
+        min_items = spec.get("min_items", 0)
+        max_items = spec.get("max_items")
+        salvage = spec.get("salvage", False)
+        items = spec.get("items")
+
+        if isinstance(items, list):
+            positional = [compile_spec(sub) for sub in items]
+
+            def check_tuple(value, path, report):
+                if not isinstance(value, list):
+                    raise SchemaError(path, "应为数组")
+                if len(value) != len(positional):
+                    raise SchemaError(path, f"长度应为 {len(positional)}")
+                for index, check in enumerate(positional):
+                    value[index] = check(value[index], f"{path}[{index}]", report)
+                return value
+            return check_tuple
+
+        check_item = compile_spec(items) if items else None
+
+        def check_array(value, path, report):
+            if not isinstance(value, list):
+                raise SchemaError(path, "应为数组")
+            if check_item is not None:
+                if salvage:
+                    kept = []
+                    for index, item in enumerate(value):
+                        try:
+                            kept.append(check_item(item, f"{path}[{index}]", report))
+                        except SchemaError as e:
+                            report.rejected.append(e)
+                    report.kept += len(kept)
+                    value[:] = kept
+                else:
+                    for index, item in enumerate(value):
+                        value[index] = check_item(item, f"{path}[{index}]", report)
+            if len(value) < min_items:
+                raise SchemaError(path, f"应至少有 {min_items} 个元素")
+            if max_items is not None and len(value) > max_items:
+                raise SchemaError(path, f"应至多有 {max_items} 个元素")
+            return value
+        return check_array
+
+    raise ValueError(f"不支持的 schema 类型: {kind}")
+
+
+class Schema:
+    def __init__(self, spec: dict, name: str = "response", min_yield: float = 1.0):
+        """
+        编译好的响应校验器，可以直接作为 request_json 的 validator_callback
+
+        校验会原地移除可挽救数组中不合格的元素，request_json 返回的就是清理后的结果。
+        保留比例低于 min_yield 时抛出异常，由 request_json 按校验失败重试；
+        否则只打印丢弃的条目，不再为少数坏元素重新生成整个响应
+
+        Args:
+            spec: 声明式 schema，见 compile_spec
+            name: 日志中的名称
+            min_yield: 可挽救数组的最低保留比例，1 表示任何不合格的元素都会触发重试
+        """
+        self.spec = spec
+        self.name = name
+        self.min_yield = min_yield
+        self._check = compile_spec(spec)
+
+    def validate(self, value) -> SalvageReport:
+        """
+        校验并清理响应
+
+        Args:
+            value: 解析后的 JSON
+
+        Returns:
+            SalvageReport: 保留和丢弃情况
+
+        Raises:
+            SchemaError: 结构不合格或保留比例低于 min_yield
+        """
+        report = SalvageReport()
+        self._check(value, "$", report)
+        if report.yield_rate < self.min_yield:
+            raise SchemaError("$", f"合格比例 {report.yield_rate:.0%} 低于 {self.min_yield:.0%}，{report.summary()}")
+        return report
+
+    def __call__(self, value):
+        report = self.validate(value)
+        if report.rejected:
+            print(f"[schema] {self.name}: {report.summary()}")
+
+
+# 对话中的一条消息
+MESSAGE = {
+    "type": "object",
+    "properties": {
+        "from": {"type": "string", "enum": ["gpt", "human"]},
+        "value": {"type": "string"},
+    },
+    "required": ["from", "value"],
+}
+
+# 一问一答：human -> gpt
+QA_PAIR = {
+    "type": "array",
+    "items": [
+        {**MESSAGE, "properties": {**MESSAGE["properties"], "from": {"type": "string", "enum": ["human"]}}},
+        {**MESSAGE, "properties": {**MESSAGE["properties"], "from": {"type": "string", "enum": ["gpt"]}}},
+    ],
+}
+
+# summarize_qa 单个角度的响应 {"conversations": [[human, gpt], ...]}
+QA_PAIRS_RESPONSE = {
+    "type": "object",
+    "properties": {
+        "conversations": {"type": "array", "items": QA_PAIR, "salvage": True},
+    },
+    "required": ["conversations"],
+}
+
+
+def qa_angles_response(angle_count: int) -> dict:
+    """
+    summarize_qa 合并角度的响应 {"angles": [{"angle": 1, "conversations": [...]}, ...]}
+
+    Args:
+        angle_count: 提问角度数，angle 的取值范围为 1 ~ angle_count
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "angles": {
+                "type": "array",
+                "salvage": True,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "angle": {"type": "integer", "minimum": 1, "maximum": angle_count, "coerce": True},
+                        "conversations": {"type": "array", "items": QA_PAIR, "salvage": True},
+                    },
+                    "required": ["angle", "conversations"],
+                },
+            },
+        },
+        "required": ["angles"],
+    }
+
+
+# summarize_chapters 的响应 {"conversations": [{"talk": [message, ...]}, ...]}
+SHAREGPT_DIALOGUE_RESPONSE = {
+    "type": "object",
+    "properties": {
+        "conversations": {
+            "type": "array",
+            "salvage": True,
+            "items": {
+                "type": "object",
+                "properties": {"talk": {"type": "array", "items": MESSAGE}},
+                "required": ["talk"],
+            },
+        },
+    },
+    "required": ["conversations"],
+}
+
+# generate-dpo.py 的响应 {"data": [{"id": 1, "chosen": "...", "rejected": "..."}, ...]}
+DPO_DATA_RESPONSE = {
+    "type": "object",
+    "properties": {
+        "data": {
+            "type": "array",
+            "salvage": True,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer", "minimum": 1, "coerce": True},
+                    "chosen": {"type": "string", "min_length": 1},
+                    "rejected": {"type": "string", "min_length": 1},
+                },
+                "required": ["id", "chosen", "rejected"],
+            },
+        },
+    },
+    "required": ["data"],
+}
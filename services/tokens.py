@@ -0,0 +1,46 @@
+def estimate_text_tokens(text: str) -> float:
+    """
+    按 DeepSeek 官方给出的经验值估算文本的 token 数：1 个中文字符约 0.6 个 token，1 个英文字符约 0.3 个 token
+
+    不取整，多段文本的估算值可以直接相加
+
+    Args:
+        text: 待估算的文本
+
+    Returns:
+        float: 估算的 token 数
+    """
+    cjk = 0
+    other = 0
+    for ch in text:
+        if ord(ch) > 0x2E7F:
+            cjk += 1
+        elif not ch.isspace():
+            other += 1
+    return cjk * 0.6 + other * 0.3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的 token 数，不依赖具体的分词器
+
+    Args:
+        text: 待估算的文本
+
+    Returns:
+        int: 估算的 token 数
+    """
+    return int(estimate_text_tokens(text)) + 1
+
+
+def estimate_messages_tokens(messages: list) -> int:
+    """
+    估算 chat 消息列表的 prompt token 数
+
+    Args:
+        messages: 消息列表
+
+    Returns:
+        int: 估算的 token 数(含每条消息约 4 个 token 的格式开销)
+    """
+    return sum(estimate_tokens(message.get("content") or "") + 4 for message in messages)
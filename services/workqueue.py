@@ -0,0 +1,120 @@
+import asyncio
+import inspect
+
+# 输入耗尽 / 工作协程退出的标记
+_DONE = object()
+
+
+async def iter_results(items, worker, concurrency: int = 32, ordered: bool = False, window: int = None,
+                       return_exceptions: bool = False):
+    """
+    有界的生产者/消费者工作池：按需从 items 中取输入交给 concurrency 个工作协程处理，按完成顺序产出结果
+
+    与「先为每个输入创建协程再 asyncio.gather」不同，同一时刻最多只有 window 个输入被取出
+    (处理中 + 等待按序产出)，内存占用只与并发数有关，与输入总数无关
+
+    Args:
+        items: 输入的可迭代对象或异步可迭代对象，会被惰性读取(如逐行读文件的生成器)
+        worker: 处理单个输入的协程函数 worker(item)
+        concurrency: 工作协程数
+        ordered: 为True时按输入顺序产出结果，先完成的结果在缓冲区中等待前面的输入
+        window: 已取出但尚未产出的输入数上限，默认 concurrency 的2倍；按序产出时慢的输入会让读取暂停
+        return_exceptions: 为True时 worker 抛出的异常作为结果产出，否则取消其余任务并抛出
+
+    Yields:
+        tuple: (输入序号, 结果)，序号从0开始，可用于恢复原始顺序
+    """
+    window = max(window or concurrency * 2, concurrency)
+    slots = asyncio.Semaphore(window)
+    inputs = asyncio.Queue(maxsize=concurrency)
+    outputs = asyncio.Queue()
+
+    async def produce():
+        try:
+            index = 0
+            if hasattr(items, "__aiter__"):
+                async for item in items:
+                    await slots.acquire()
+                    await inputs.put((index, item))
+                    index += 1
+            else:
+                for item in items:
+                    await slots.acquire()
+                    await inputs.put((index, item))
+                    index += 1
+        except Exception as e:
+            # 读取输入失败，交给消费方抛出
+            outputs.put_nowait((None, False, e))
+        finally:
+            for _ in range(concurrency):
+                await inputs.put(_DONE)
+
+    async def consume():
+        while True:
+            entry = await inputs.get()
+            if entry is _DONE:
+                break
+            index, item = entry
+            try:
+                result = await worker(item)
+            except Exception as e:
+                outputs.put_nowait((index, False, e))
+                continue
+            outputs.put_nowait((index, True, result))
+        outputs.put_nowait(_DONE)
+
+    producer = asyncio.ensure_future(produce())
+    workers = [asyncio.ensure_future(consume()) for _ in range(concurrency)]
+    buffered = {}
+    next_index = 0
+    running = concurrency
+    try:
+        while running:
+            entry = await outputs.get()
+            if entry is _DONE:
+                running -= 1
+                continue
+            index, ok, value = entry
+            if index is None or (not ok and not return_exceptions):
+                raise value
+            if not ordered:
+                slots.release()
+                yield index, value
+                continue
+            buffered[index] = value
+            while next_index in buffered:
+                slots.release()
+                yield next_index, buffered.pop(next_index)
+                next_index += 1
+    finally:
+        producer.cancel()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(producer, *workers, return_exceptions=True)
+
+
+async def run_queue(items, worker, sink=None, concurrency: int = 32, ordered: bool = False, window: int = None,
+                    return_exceptions: bool = False) -> int:
+    """
+    用有界工作池处理所有输入，每个结果产出后立即交给 sink，参数同 iter_results
+
+    Args:
+        sink: 接收结果的函数 sink(index, result)，可以是协程函数，如逐行写文件；为 None 时丢弃结果
+
+    Returns:
+        int: 处理的输入数
+    """
+    count = 0
+    results = iter_results(items, worker, concurrency=concurrency, ordered=ordered, window=window,
+                           return_exceptions=return_exceptions)
+    try:
+        async for index, result in results:
+            count += 1
+            if sink is None:
+                continue
+            outcome = sink(index, result)
+            if inspect.isawaitable(outcome):
+                await outcome
+    finally:
+        await results.aclose()
+    return count